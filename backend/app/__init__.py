@@ -7,14 +7,45 @@ def create_app():
     app = Flask(__name__)
     # Final attempt at a very explicit, permissive CORS configuration
     from flask_cors import CORS
-    CORS(app, origins="http://localhost:8080", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"], headers=["Content-Type"], supports_credentials=True)
+    CORS(app, origins="http://localhost:8080", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"], headers=["Content-Type"], supports_credentials=True)
 
     # Configure database
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:////data/metallobox.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
     # Define an absolute path for uploads inside the container
-    app.config['UPLOAD_FOLDER'] = '/app/uploads'
+    app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', '/app/uploads')
+
+    # Segmentation runs in a process pool per web worker; 0 segments inline in the request.
+    # Both limits apply per web worker; gunicorn.conf.py divides the defaults between its workers.
+    app.config['SEGMENTATION_WORKERS'] = int(os.environ.get('SEGMENTATION_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+    app.config['SEGMENTATION_MAX_PENDING'] = int(os.environ.get('SEGMENTATION_MAX_PENDING', 32))
+
+    # Images accepted by one bulk upload, across all archives and files.
+    app.config['BULK_UPLOAD_MAX_FILES'] = int(os.environ.get('BULK_UPLOAD_MAX_FILES', 1000))
+    # Uncompressed bytes one bulk upload may extract, across all of its archives.
+    app.config['BULK_UPLOAD_MAX_BYTES'] = int(os.environ.get('BULK_UPLOAD_MAX_BYTES', 8 * 1024 * 1024 * 1024))
+
+    # Rendered ASTM comparison charts, evicted least-recently-used beyond the size limit.
+    app.config['ASTM_CHART_CACHE_FOLDER'] = os.environ.get('ASTM_CHART_CACHE_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], 'astm-charts'))
+    app.config['ASTM_CHART_CACHE_MAX_BYTES'] = int(os.environ.get('ASTM_CHART_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+    # Per-process budget for memory-mapped decoded images; the maps themselves live in the page cache.
+    app.config['DECODED_IMAGE_CACHE_MAX_BYTES'] = int(os.environ.get('DECODED_IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    from .image_cache import configure as configure_image_cache
+    configure_image_cache(app.config['DECODED_IMAGE_CACHE_MAX_BYTES'])
+
+    # Requests slower than this are logged (0 disables); with a profile directory each one also gets a cProfile dump.
+    app.config['SLOW_REQUEST_THRESHOLD_S'] = float(os.environ.get('SLOW_REQUEST_THRESHOLD_S', 0))
+    app.config['SLOW_REQUEST_PROFILE_DIR'] = os.environ.get('SLOW_REQUEST_PROFILE_DIR')
+
+    # JSON responses at least this large are compressed; brotli needs the optional brotli package, gzip is the fallback.
+    app.config['COMPRESSION_MIN_BYTES'] = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+    app.config['COMPRESSION_GZIP_LEVEL'] = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 5))
+    app.config['COMPRESSION_BROTLI_QUALITY'] = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 4))
+
+    # Schema upgrades at startup; production runs `flask upgrade-db` once before starting the workers instead.
+    app.config['MIGRATE_ON_START'] = os.environ.get('MIGRATE_ON_START', '1') == '1'
 
     # Ensure the upload folder exists
     if not os.path.exists(app.config['UPLOAD_FOLDER']):
@@ -22,8 +53,21 @@ def create_app():
 
     db.init_app(app)
 
+    from . import metrics
+    metrics.init_app(app)
+
+    # Registered after metrics, so its after_request hook runs first and the size metric sees compressed bodies.
+    from . import compression
+    compression.init_app(app)
+
+    from .astm_charts import warm_astm_charts_command
+    app.cli.add_command(warm_astm_charts_command)
+    from .migrations import upgrade, upgrade_db_command
+    app.cli.add_command(upgrade_db_command)
+
     with app.app_context():
         from . import routes
-        db.create_all()
+        if app.config['MIGRATE_ON_START']:
+            upgrade()
 
     return app
@@ -0,0 +1,235 @@
+"""ASTM E112 comparison chart rendering and its disk cache."""
+import hashlib
+import itertools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .contours import PackedContours
+from .measurement import polygon_moments
+from .metrics import stage
+
+# Bump whenever the rendered output changes so stale cache entries are not served.
+CHART_RENDERER_VERSION = 2
+
+# Limits keep a single request from asking for an arbitrarily large render.
+MAX_CHART_DIMENSION_PX = 10000
+MIN_G, MAX_G = 1, 14
+
+
+def _count_per_region(mask, offsets):
+    """Number of True entries of a per-vertex mask within each packed region (empty regions allowed)."""
+    counts = np.zeros(len(mask) + 1, dtype=np.int64)
+    np.cumsum(mask, out=counts[1:])
+    return counts[offsets[1:]] - counts[offsets[:-1]]
+
+
+def _voronoi_regions(vor):
+    """
+    Flattens the Voronoi region of every input point into a packed vertex
+    buffer. Returns (vertices, offsets, closed), where ``closed`` is False for
+    unbounded or empty regions.
+    """
+    regions = [vor.regions[r] for r in vor.point_region]
+    lengths = np.fromiter(map(len, regions), dtype=np.int64, count=len(regions))
+    indices = np.fromiter(itertools.chain.from_iterable(regions), dtype=np.int64, count=lengths.sum())
+    offsets = np.zeros(len(regions) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    # Index -1 marks the vertex at infinity of an open region.
+    closed = (lengths > 0) & (_count_per_region(indices < 0, offsets) == 0)
+    return vor.vertices[indices], offsets, closed
+
+
+def lloyds_relaxation(points, bounds, iterations=5):
+    """Applies Lloyd's algorithm to a set of points, moving every point to its region's centroid at once."""
+    from scipy.spatial import Voronoi
+
+    for _ in range(iterations):
+        vertices, offsets, closed = _voronoi_regions(Voronoi(points))
+        # Open regions, and regions reaching outside the bounds, keep their point.
+        outside = (vertices[:, 0] < 0) | (vertices[:, 0] > bounds[0]) | (vertices[:, 1] < 0) | (vertices[:, 1] > bounds[1])
+        idx = np.flatnonzero(closed & (_count_per_region(outside, offsets) == 0))
+        regions = PackedContours(vertices, offsets).take(idx)
+        moments = polygon_moments(regions.points, regions.offsets)
+        # Zero-area regions keep their point as well.
+        nonzero = moments['area'] != 0
+        points = points.copy()
+        points[idx[nonzero], 0] = moments['cx'][nonzero]
+        points[idx[nonzero], 1] = moments['cy'][nonzero]
+    return points
+
+
+def relaxed_voronoi_cells(num_points, width_px, height_px, rng, iterations=3):
+    """
+    Places ``num_points`` random points, relaxes them with Lloyd's algorithm
+    and returns their Voronoi cells as a packed (vertices, offsets) pair.
+    Every cell is closed, including those reaching past the image border.
+    """
+    from scipy.spatial import Voronoi
+
+    points = rng.random((num_points, 2)) * np.array([width_px, height_px])
+    points = lloyds_relaxation(points, (width_px, height_px), iterations=iterations)
+    # Far guard points close every point's region; their own regions are dropped.
+    span = 4 * max(width_px, height_px)
+    guards = np.array([[-span, -span], [span, -span], [-span, span], [span, span]], dtype=np.float64)
+    vertices, offsets, _ = _voronoi_regions(Voronoi(np.vstack([points, guards])))
+    return vertices[:offsets[num_points]], offsets[:num_points + 1]
+
+
+# Matches the former 1.5 pt matplotlib boundary lines at 100 dpi.
+BOUNDARY_THICKNESS_PX = 2
+# Fixed-point bits for sub-pixel polygon coordinates in cv2 drawing calls.
+DRAW_SHIFT = 4
+# Grain fill levels are quantised so each level is one cv2.fillPoly call.
+GRAY_LEVELS = 32
+
+
+def render_astm_chart(G, magnification, width_px, height_px, seed=0):
+    """
+    Renders the visual comparison chart for ASTM grain size ``G``, sized to
+    match the original image, and returns it as PNG bytes. The same inputs
+    always produce the same chart.
+    """
+    with stage('chart_render'):
+        return _render_astm_chart(G, magnification, width_px, height_px, seed)
+
+
+def _render_astm_chart(G, magnification, width_px, height_px, seed):
+    import cv2
+
+    rng = np.random.default_rng(seed)
+
+    N_A_100x = 2**(G - 1)
+    point_density = N_A_100x * (magnification / 100.0)**2
+    num_points = int(point_density * (width_px * height_px) / (1000**2))
+
+    if num_points < 4: num_points = 4
+    if num_points > 2000: num_points = 2000
+
+    vertices, offsets = relaxed_voronoi_cells(num_points, width_px, height_px, rng)
+    vertices = np.round(vertices * (1 << DRAW_SHIFT)).astype(np.int32)
+    polygons = [vertices[offsets[i]:offsets[i + 1]] for i in range(num_points)]
+
+    img = np.empty((height_px, width_px), dtype=np.uint8)
+    # Random light gray per grain in the 0.6-0.9 range of the former charts.
+    gray = np.round(rng.uniform(0.6, 0.9, num_points) * (GRAY_LEVELS - 1)).astype(np.int64)
+    img.fill(255)
+    for level in np.unique(gray):
+        members = [polygons[i] for i in np.flatnonzero(gray == level)]
+        cv2.fillPoly(img, members, int(level * 255 / (GRAY_LEVELS - 1)), cv2.LINE_AA, DRAW_SHIFT)
+    cv2.polylines(img, polygons, True, 0, BOUNDARY_THICKNESS_PX, cv2.LINE_AA, DRAW_SHIFT)
+
+    ok, png = cv2.imencode('.png', img)
+    if not ok:
+        # Raised before ChartCache writes anything, so a failed encode is never cached.
+        raise OSError(f'Could not encode the G{G} chart as PNG.')
+    return png.tobytes()
+
+
+def render_astm_charts(g_values, magnification, width_px, height_px, seed=0):
+    """Renders several charts in parallel threads; qhull and the cv2 drawing calls release the GIL."""
+    with ThreadPoolExecutor(max_workers=min(len(g_values), os.cpu_count() or 1) or 1) as pool:
+        pngs = pool.map(lambda G: render_astm_chart(G, magnification, width_px, height_px, seed), g_values)
+        return dict(zip(g_values, pngs))
+
+
+class ChartCache:
+    """
+    Size-bounded disk cache of rendered charts. Files are named by a hash of
+    the render inputs; hits refresh the file's mtime and the least recently
+    used files are evicted once the directory exceeds ``max_bytes``.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(G, magnification, width_px, height_px, seed):
+        params = [CHART_RENDERER_VERSION, int(G), float(magnification), int(width_px), int(height_px), int(seed)]
+        return hashlib.sha256(json.dumps(params).encode()).hexdigest()[:32]
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.png')
+
+    def get_or_render(self, G, magnification, width_px, height_px, seed=0):
+        """Returns the path of the cached chart, rendering it first on a miss."""
+        return self.get_or_render_many([G], magnification, width_px, height_px, seed)[G]
+
+    def get_or_render_many(self, g_values, magnification, width_px, height_px, seed=0):
+        """Returns {G: path} for several charts, rendering all misses in parallel."""
+        paths = {G: self.path(self.key(G, magnification, width_px, height_px, seed)) for G in g_values}
+        missing = []
+        for G, path in paths.items():
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                missing.append(G)
+        if missing:
+            for G, png in render_astm_charts(missing, magnification, width_px, height_px, seed).items():
+                tmp_path = f'{paths[G]}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(png)
+                os.replace(tmp_path, paths[G])
+            self.evict()
+        return paths
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.png'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def get_chart_cache():
+    return ChartCache(current_app.config['ASTM_CHART_CACHE_FOLDER'], current_app.config['ASTM_CHART_CACHE_MAX_BYTES'])
+
+
+def chart_url(G, magnification, width_px, height_px, seed=0):
+    # repr round-trips the float, so the GET parses the magnification that ChartCache.key hashed.
+    return f'/api/astm-charts/{G}/{float(magnification)!r}/{width_px}x{height_px}/{seed}.png'
+
+
+# Common microscope magnifications and camera resolutions.
+DEFAULT_WARM_MAGNIFICATIONS = '50,100,200,500'
+DEFAULT_WARM_SIZES = '1280x960,1600x1200,2048x1536,2560x1920'
+
+
+@click.command('warm-astm-charts')
+@click.option('--magnifications', default=DEFAULT_WARM_MAGNIFICATIONS, show_default=True,
+              help='Comma-separated magnifications.')
+@click.option('--sizes', default=DEFAULT_WARM_SIZES, show_default=True,
+              help='Comma-separated WIDTHxHEIGHT image sizes in pixels.')
+@click.option('--g-values', default=','.join(str(g) for g in range(MIN_G, MAX_G + 1)), show_default=True,
+              help='Comma-separated ASTM G values.')
+@click.option('--seed', default=0, show_default=True)
+@with_appcontext
+def warm_astm_charts_command(magnifications, sizes, g_values, seed):
+    """Pre-renders ASTM comparison charts into the chart cache."""
+    cache = get_chart_cache()
+    magnifications = [float(m) for m in magnifications.split(',')]
+    sizes = [tuple(int(v) for v in size.split('x')) for size in sizes.split(',')]
+    g_values = [int(g) for g in g_values.split(',')]
+    total = len(magnifications) * len(sizes) * len(g_values)
+    done = 0
+    for magnification in magnifications:
+        for width_px, height_px in sizes:
+            cache.get_or_render_many(g_values, magnification, width_px, height_px, seed)
+            done += len(g_values)
+        click.echo(f'{done}/{total} charts ready')
@@ -0,0 +1,122 @@
+"""Bulk sample uploads from ZIP archives or multipart batches.
+
+Archives are streamed to disk and their members copied to the upload folder
+one at a time, so nothing larger than a copy buffer is held in memory.
+"""
+import os
+import shutil
+import tempfile
+import uuid
+import zipfile
+import zlib
+
+from werkzeug.utils import secure_filename
+
+COPY_CHUNK_SIZE = 1 << 20
+ZIP_MIMETYPES = ('application/zip', 'application/x-zip-compressed')
+
+
+class BulkUploadError(Exception):
+    pass
+
+
+def is_zip(filename, mimetype=None):
+    return mimetype in ZIP_MIMETYPES or filename.lower().endswith('.zip')
+
+
+def save_stream(stream, directory):
+    """Copies ``stream`` to a new temporary file in ``directory`` and returns its path."""
+    fd, path = tempfile.mkstemp(suffix='.zip', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(stream, f, COPY_CHUNK_SIZE)
+    return path
+
+
+def _copy_limited(src, dst, max_bytes, name):
+    """Copies ``src`` to ``dst`` like shutil.copyfileobj, raising BulkUploadError past ``max_bytes``."""
+    copied = 0
+    while chunk := src.read(COPY_CHUNK_SIZE):
+        copied += len(chunk)
+        if copied > max_bytes:
+            raise BulkUploadError(f'{name} is larger than its declared size.')
+        dst.write(chunk)
+
+
+def store_upload(fileobj, original_name, upload_folder, max_bytes=None):
+    """
+    Copies one uploaded image under a unique name, at most ``max_bytes`` of it
+    when given. Returns a dict with the original ``filename`` and either
+    ``image_filename`` or ``error``.
+    """
+    import cv2
+
+    name = os.path.basename(original_name.replace('\\', '/'))
+    ext = os.path.splitext(secure_filename(name))[1]
+    image_filename = f"{uuid.uuid4()}{ext}"
+    filepath = os.path.join(upload_folder, image_filename)
+    try:
+        with open(filepath, 'wb') as f:
+            if max_bytes is None:
+                shutil.copyfileobj(fileobj, f, COPY_CHUNK_SIZE)
+            else:
+                _copy_limited(fileobj, f, max_bytes, name)
+    except BaseException:
+        os.remove(filepath)
+        raise
+    # Only the header is checked here; decoding and segmentation happen in the job.
+    if not cv2.haveImageReader(filepath):
+        os.remove(filepath)
+        return {'filename': name, 'error': 'Could not read image file.'}
+    return {'filename': name, 'image_filename': image_filename}
+
+
+def _archive_members(archive):
+    """File members of an archive, skipping directories and metadata such as __MACOSX/ and dot files."""
+    for info in archive.infolist():
+        name = info.filename.replace('\\', '/')
+        basename = os.path.basename(name)
+        if info.is_dir() or not basename or basename.startswith('.') or name.startswith('__MACOSX/'):
+            continue
+        yield info
+
+
+def extract_archive(path, upload_folder, max_files, max_bytes):
+    """
+    Stores every image of the ZIP archive at ``path`` and returns the entries
+    with the number of bytes extracted. The declared uncompressed sizes must fit
+    in ``max_bytes``, and no member is copied past its declared size, so a
+    compression bomb is rejected before it fills the upload folder. Raises
+    BulkUploadError, having removed whatever the archive already stored.
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            members = list(_archive_members(archive))
+            if len(members) > max_files:
+                raise BulkUploadError(f'Archive holds {len(members)} files, the limit is {max_files}.')
+            total_bytes = sum(info.file_size for info in members)
+            if total_bytes > max_bytes:
+                raise BulkUploadError(f'Archive expands to {total_bytes} bytes, the limit is {max_bytes}.')
+            entries = []
+            try:
+                for info in members:
+                    # Encrypted members raise RuntimeError, unsupported compression NotImplementedError.
+                    with archive.open(info) as member:
+                        entries.append(store_upload(member, info.filename, upload_folder, info.file_size))
+            except BulkUploadError:
+                remove_stored(entries, upload_folder)
+                raise
+            except (zipfile.BadZipFile, zlib.error, NotImplementedError, RuntimeError, OSError):
+                remove_stored(entries, upload_folder)
+                raise BulkUploadError(f'Could not extract {info.filename} from the archive.')
+            return entries, total_bytes
+    except zipfile.BadZipFile:
+        raise BulkUploadError('Invalid ZIP archive.')
+
+
+def remove_stored(entries, upload_folder):
+    """Deletes the files stored for ``entries``, when a batch is rejected as a whole."""
+    for entry in entries:
+        if 'image_filename' in entry:
+            filepath = os.path.join(upload_folder, entry['image_filename'])
+            if os.path.exists(filepath):
+                os.remove(filepath)
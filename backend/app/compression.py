@@ -0,0 +1,53 @@
+"""gzip and brotli compression of JSON responses.
+
+Sample payloads carry whole contour and measurement arrays, which shrink
+several times over when compressed. Responses are encoded with brotli when
+the client accepts it and the ``brotli`` package is installed, and with gzip
+otherwise; streamed exports, binary files and small bodies are sent as they
+are. Compression runs after the response is built, so it is not part of the
+json_serialize stage, and the response size metric records compressed bytes.
+"""
+import gzip
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json',)
+
+
+def _encoding():
+    offered = ('br', 'gzip') if brotli is not None else ('gzip',)
+    return request.accept_encodings.best_match(offered)
+
+
+def init_app(app):
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough or response.is_streamed
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES
+                or 'Content-Encoding' in response.headers):
+            return response
+        # Caches must keep the encodings apart even when this response goes out uncompressed.
+        response.vary.add('Accept-Encoding')
+        if response.content_length is None or response.content_length < app.config['COMPRESSION_MIN_BYTES']:
+            return response
+        encoding = _encoding()
+        if encoding is None:
+            return response
+        data = response.get_data()
+        if encoding == 'br':
+            data = brotli.compress(data, quality=app.config['COMPRESSION_BROTLI_QUALITY'])
+        else:
+            data = gzip.compress(data, compresslevel=app.config['COMPRESSION_GZIP_LEVEL'], mtime=0)
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        # The bytes now differ per encoding, so a strong validator would be wrong.
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
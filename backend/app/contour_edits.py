@@ -0,0 +1,219 @@
+"""Incremental contour edits.
+
+An edit is a list of operations against one version of a sample's contours:
+
+    {"op": "add", "contour": [[x, y], ...]}
+    {"op": "delete", "id": 12}
+    {"op": "replace", "id": 12, "contour": [[x, y], ...]}
+    {"op": "merge", "ids": [12, 13], "gap_px": 8}
+    {"op": "split", "id": 12, "line": [[x, y], ...]}
+
+Grain ids are the 1-based contour indices of that version, in every
+operation, and each grain can be edited once per request. Surviving and
+replaced grains keep their order and are renumbered to close the gaps of
+removed ones; grains created by add, merge and split are appended in
+operation order.
+"""
+import numpy as np
+
+from .contours import PackedContours
+
+OPERATIONS = ('add', 'delete', 'replace', 'merge', 'split')
+# Segmented grains are separated by their boundary, so merging closes gaps up to this width.
+DEFAULT_MERGE_GAP_PX = 8.0
+MAX_MERGE_GAP_PX = 50.0
+SPLIT_LINE_WIDTH_PX = 0.001
+
+
+class ContourEditError(ValueError):
+    pass
+
+
+def to_polygon(contour):
+    """A valid shapely polygon for a contour in OpenCV or nested-list form."""
+    from shapely.geometry import Polygon
+
+    points = np.asarray(contour, dtype=np.float64).reshape(-1, 2)
+    if len(points) < 3:
+        raise ContourEditError('Contours need at least 3 points.')
+    polygon = Polygon(points)
+    if not polygon.is_valid:
+        # Contours touching themselves, as findContours can produce, are repaired into their largest part.
+        polygon = _largest(polygon.buffer(0))
+    return polygon
+
+
+def polygon_contour(polygon):
+    """Integer (k, 2) contour of a polygon's exterior, without the repeated closing point."""
+    return np.round(np.asarray(polygon.exterior.coords)[:-1]).astype(np.int32)
+
+
+def _largest(geometry):
+    from shapely.geometry import MultiPolygon, Polygon
+
+    polygons = list(geometry.geoms) if isinstance(geometry, MultiPolygon) else [geometry]
+    polygons = [p for p in polygons if isinstance(p, Polygon) and not p.is_empty]
+    if not polygons:
+        raise ContourEditError('Contour has no area.')
+    return max(polygons, key=lambda p: p.area)
+
+
+def split_polygon(polygon, line):
+    """The parts of ``polygon`` on either side of the polyline ``line``."""
+    from shapely.geometry import LineString
+
+    parts = polygon.difference(LineString(line).buffer(SPLIT_LINE_WIDTH_PX))
+    if parts.is_empty:
+        return []
+    return [parts] if parts.geom_type == 'Polygon' else [p for p in parts.geoms if p.geom_type == 'Polygon']
+
+
+def merge_polygons(polygons, gap_px):
+    """
+    The union of ``polygons``, closing gaps up to ``gap_px`` wide between them.
+    Raises ContourEditError if they do not form one region.
+    """
+    from shapely.geometry import Polygon
+    from shapely.ops import unary_union
+
+    radius = gap_px / 2.0
+    merged = unary_union([p.buffer(radius, join_style='mitre') for p in polygons]).buffer(-radius, join_style='mitre')
+    if merged.geom_type != 'Polygon' or merged.is_empty:
+        raise ContourEditError(f'Grains to merge must be at most {gap_px:g} px apart.')
+    # Holes would be lost by the exterior-only contour storage, so they are filled.
+    return Polygon(merged.exterior)
+
+
+def _grain_index(value, count):
+    if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= count:
+        raise ContourEditError(f'Unknown grain id {value!r}.')
+    return value - 1
+
+
+def _contour(value):
+    try:
+        contour = np.asarray(value, dtype=np.int32).reshape(-1, 2)
+    except (ValueError, TypeError):
+        raise ContourEditError('Contours must be lists of [x, y] points.')
+    if len(contour) < 3:
+        raise ContourEditError('Contours need at least 3 points.')
+    return contour
+
+
+class ContourEdit:
+    """
+    The result of applying operations: the edited ``contours``, the old index
+    of every grain now at each position (``survivors``), and the new indices
+    whose geometry changed.
+    """
+
+    def __init__(self, contours, survivors, changed, created, removed):
+        self.contours = contours
+        self.survivors = survivors
+        self.changed = changed
+        # New grain ids created by each operation, and the old ids removed.
+        self.created = created
+        self.removed = removed
+
+
+def apply_edits(contours, operations):
+    """Applies edit operations to PackedContours. Raises ContourEditError on invalid operations."""
+    count = len(contours)
+    touched = set()
+    removed = set()
+    replaced = {}
+    appended = []
+    # Per operation: ('old', index) for replacements, ('new', position in appended) for new grains.
+    created = []
+
+    def claim(index):
+        if index in touched:
+            raise ContourEditError(f'Grain {index + 1} is edited more than once.')
+        touched.add(index)
+        return index
+
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+            raise ContourEditError(f"Operations must have an op among {', '.join(OPERATIONS)}.")
+        kind = operation['op']
+        try:
+            if kind == 'add':
+                created.append([('new', len(appended))])
+                appended.append(_contour(operation['contour']))
+            elif kind == 'delete':
+                removed.add(claim(_grain_index(operation['id'], count)))
+                created.append([])
+            elif kind == 'replace':
+                index = claim(_grain_index(operation['id'], count))
+                replaced[index] = _contour(operation['contour'])
+                created.append([('old', index)])
+            elif kind == 'merge':
+                ids = operation['ids']
+                if not isinstance(ids, list) or len(ids) < 2:
+                    raise ContourEditError('Merge needs at least two grain ids.')
+                indices = [claim(_grain_index(i, count)) for i in ids]
+                gap_px = float(operation.get('gap_px', DEFAULT_MERGE_GAP_PX))
+                if not 0 <= gap_px <= MAX_MERGE_GAP_PX:
+                    raise ContourEditError(f'gap_px must be between 0 and {MAX_MERGE_GAP_PX:g}.')
+                merged = merge_polygons([to_polygon(contours[i]) for i in indices], gap_px)
+                removed.update(indices)
+                created.append([('new', len(appended))])
+                appended.append(polygon_contour(merged))
+            elif kind == 'split':
+                index = claim(_grain_index(operation['id'], count))
+                line = np.asarray(operation['line'], dtype=np.float64).reshape(-1, 2)
+                if len(line) < 2:
+                    raise ContourEditError('Split lines need at least 2 points.')
+                parts = split_polygon(to_polygon(contours[index]), line)
+                if len(parts) < 2:
+                    raise ContourEditError(f'The line does not split grain {index + 1}.')
+                removed.add(index)
+                created.append([('new', len(appended) + k) for k in range(len(parts))])
+                appended.extend(polygon_contour(p) for p in parts)
+        except ContourEditError:
+            raise
+        except KeyError as e:
+            raise ContourEditError(f'{kind} operation is missing {e.args[0]!r}.')
+        except (ValueError, TypeError):
+            raise ContourEditError(f'Invalid {kind} operation.')
+
+    alive = np.ones(count, dtype=bool)
+    alive[list(removed)] = False
+    survivors = np.flatnonzero(alive)
+    # New index of every surviving old index.
+    position = np.cumsum(alive) - 1
+    replaced = {int(position[i]): contour for i, contour in replaced.items()}
+    edited = _rebuild(contours, survivors, replaced, appended)
+
+    def new_id(ref):
+        kind, value = ref
+        return (int(position[value]) if kind == 'old' else len(survivors) + value) + 1
+
+    changed = sorted(replaced) + list(range(len(survivors), len(survivors) + len(appended)))
+    return ContourEdit(edited, survivors, changed,
+                       [[new_id(ref) for ref in refs] for refs in created], sorted(i + 1 for i in removed))
+
+
+def _rebuild(contours, survivors, replaced, appended):
+    """Packs the surviving contours, with ``replaced`` ({new position: contour}) swapped in, then ``appended``."""
+    lengths = np.concatenate([contours.lengths[survivors], [len(c) for c in appended]]).astype(np.int64)
+    for position, contour in replaced.items():
+        lengths[position] = len(contour)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    points = np.empty((offsets[-1], 2), dtype=np.int32)
+
+    # Unchanged survivors are copied in one gather, like PackedContours.take.
+    kept = np.ones(len(survivors), dtype=bool)
+    kept[list(replaced)] = False
+    kept = np.flatnonzero(kept)
+    source = contours.take(survivors[kept])
+    destination = np.repeat(offsets[kept] - source.offsets[:-1], source.lengths) + np.arange(source.offsets[-1])
+    points[destination] = source.points
+
+    for position, contour in replaced.items():
+        points[offsets[position]:offsets[position + 1]] = contour
+    for k, contour in enumerate(appended):
+        position = len(survivors) + k
+        points[offsets[position]:offsets[position + 1]] = contour
+    return PackedContours(points, offsets)
@@ -0,0 +1,81 @@
+"""Packed contour storage.
+
+A sample's contours are kept as one flat int32 ``(N, 2)`` point buffer plus an
+int64 ``offsets`` array of length ``count + 1``: contour ``i`` is
+``points[offsets[i]:offsets[i + 1]]``. Both buffers load zero-copy with
+``np.frombuffer`` and each contour slice is a view in the ``(k, 1, 2)`` layout
+OpenCV expects.
+"""
+import io
+
+import numpy as np
+
+
+class PackedContours:
+    def __init__(self, points, offsets):
+        self.points = points.reshape(-1, 2)
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, contours):
+        """Packs OpenCV contours or their nested-list JSON form."""
+        arrays = [np.asarray(c, dtype=np.int32).reshape(-1, 2) for c in contours]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        if arrays:
+            np.cumsum([len(a) for a in arrays], out=offsets[1:])
+            points = np.concatenate(arrays)
+        else:
+            points = np.empty((0, 2), dtype=np.int32)
+        return cls(points, offsets)
+
+    @classmethod
+    def from_bytes(cls, points, offsets):
+        return cls(np.frombuffer(points, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.points[self.offsets[i]:self.offsets[i + 1]].reshape(-1, 1, 2)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def take(self, indices):
+        """Packs the contours at ``indices`` into a new PackedContours."""
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Position of every output point in the source buffer.
+        source = np.repeat(self.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return PackedContours(self.points[source], offsets)
+
+    def keys(self):
+        """Content keys of each contour, for matching unchanged contours between edits."""
+        points = np.ascontiguousarray(self.points, dtype=np.int32)
+        offsets = self.offsets.tolist()
+        return [points[offsets[i]:offsets[i + 1]].tobytes() for i in range(len(self))]
+
+    def to_bytes(self):
+        return (np.ascontiguousarray(self.points, dtype=np.int32).tobytes(),
+                np.ascontiguousarray(self.offsets, dtype=np.int64).tobytes())
+
+    def to_json(self):
+        """Nested ``[[[x, y]], ...]`` lists, the historical API shape."""
+        points = self.points.tolist()
+        offsets = self.offsets.tolist()
+        return [[[p] for p in points[offsets[i]:offsets[i + 1]]] for i in range(len(self))]
+
+    def to_flat_json(self):
+        """``{"points": [x0, y0, x1, y1, ...], "offsets": [...]}``, much cheaper to build and parse than to_json."""
+        return {'points': self.points.ravel().tolist(), 'offsets': self.offsets.tolist()}
+
+    def to_npz(self):
+        buffer = io.BytesIO()
+        np.savez(buffer, points=self.points, offsets=self.offsets)
+        return buffer.getvalue()
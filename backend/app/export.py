@@ -0,0 +1,165 @@
+"""Streaming measurement exports.
+
+Measurement rows are read one sample at a time and written out in chunks,
+so memory stays flat however many samples and grains an export covers.
+"""
+import csv
+import io
+import os
+import tempfile
+
+from sqlalchemy import select
+
+from .measurement import MEASUREMENT_FIELDS
+from .models import db, Measurement, Sample
+
+EXPORT_COLUMNS = ('sample_id', 'sample_name') + MEASUREMENT_FIELDS
+# Rows buffered per Parquet row group.
+PARQUET_ROW_GROUP_ROWS = 65536
+PARQUET_COMPRESSION = 'zstd'
+# Excel's row limit per sheet, including the header row.
+XLSX_MAX_ROWS = 1048576
+FILE_CHUNK_SIZE = 1 << 20
+
+
+def iter_sample_measurements(sample_ids):
+    """
+    Yields (sample_id, sample_name, rows) for every measured sample, where
+    rows are MEASUREMENT_FIELDS tuples, reading one sample at a time.
+    """
+    columns = [Measurement.__table__.c[field] for field in MEASUREMENT_FIELDS]
+    for sample_id in sample_ids:
+        sample = db.session.execute(
+            select(Sample.id, Sample.name, Sample.measurement_count).where(Sample.id == sample_id)
+        ).one_or_none()
+        if sample is None or not sample.measurement_count:
+            continue
+        rows = db.session.execute(
+            select(*columns).where(Measurement.sample_id == sample_id).order_by(Measurement.grain_id)
+        ).all()
+        yield sample.id, sample.name, rows
+
+
+def project_sample_ids(project_id):
+    return db.session.execute(
+        select(Sample.id).where(Sample.project_id == project_id).order_by(Sample.id)
+    ).scalars().all()
+
+
+def _rows(sample_id, sample_name, measurements):
+    prefix = (sample_id, sample_name)
+    for row in measurements:
+        yield prefix + tuple(row)
+
+
+def stream_csv(samples, with_sample=True):
+    """
+    Streams the rows as CSV. Without with_sample the sample_id and sample_name
+    columns are left out, which keeps single-sample exports in their
+    original MEASUREMENT_FIELDS layout.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(EXPORT_COLUMNS if with_sample else MEASUREMENT_FIELDS)
+    for sample_id, sample_name, measurements in samples:
+        writer.writerows(_rows(sample_id, sample_name, measurements) if with_sample else measurements)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object collecting written bytes until they are drained."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_parquet(samples):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('sample_id', pa.int64()), ('sample_name', pa.string()), ('grain_id', pa.int64()),
+        ('area_px', pa.float64()), ('area_mm2', pa.float64()), ('perimeter_mm', pa.float64()),
+        ('equiv_diameter_mm', pa.float64()), ('orientation_deg', pa.float64()),
+        ('center_x_px', pa.float64()), ('center_y_px', pa.float64()),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression=PARQUET_COMPRESSION)
+    rows = []
+
+    def flush():
+        columns = list(zip(*rows))
+        writer.write_table(pa.table([pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                                    schema=schema))
+        rows.clear()
+
+    for sample in samples:
+        rows.extend(_rows(*sample))
+        if len(rows) >= PARQUET_ROW_GROUP_ROWS:
+            flush()
+            yield sink.drain()
+    if rows:
+        flush()
+    writer.close()
+    yield sink.drain()
+
+
+def stream_xlsx(samples):
+    """
+    Writes the workbook in openpyxl's write-only mode, which keeps rows in a
+    temporary file rather than in memory. The XLSX container can only be
+    finished once every row is written, so it is streamed from disk afterwards.
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = None
+    sheet_rows = XLSX_MAX_ROWS
+    for sample in samples:
+        for row in _rows(*sample):
+            if sheet_rows == XLSX_MAX_ROWS:
+                sheet = workbook.create_sheet(f'Measurements {len(workbook.worksheets) + 1}')
+                sheet.append(EXPORT_COLUMNS)
+                sheet_rows = 1
+            sheet.append(row)
+            sheet_rows += 1
+    if sheet is None:
+        workbook.create_sheet('Measurements 1').append(EXPORT_COLUMNS)
+
+    fd, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    try:
+        workbook.save(path)
+        with open(path, 'rb') as f:
+            while chunk := f.read(FILE_CHUNK_SIZE):
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+EXPORT_FORMATS = {
+    'csv': (stream_csv, 'text/csv'),
+    'parquet': (stream_parquet, 'application/vnd.apache.parquet'),
+    'xlsx': (stream_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
@@ -0,0 +1,156 @@
+"""Decoded grayscale images shared between requests, workers and jobs.
+
+Decoding a compressed PNG or TIFF often costs more than the analysis that
+follows, so the first decode of an upload writes a raw ``.npy`` sidecar to
+``<UPLOAD_FOLDER>/decoded/``. Later reads memory-map the sidecar, which lets
+every gunicorn worker and pool process share one copy through the page cache.
+Each process also keeps its most recently used maps, bounded by their size.
+Uploads are never modified in place, so a sidecar is valid until its upload is deleted.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .metrics import stage
+from .segmentation import read_grayscale
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# TIFFs with at least this many pixels are decoded strip by strip (or tile by tile) straight into the sidecar.
+STREAMING_DECODE_MIN_PIXELS = 1 << 26
+
+
+def sidecar_path(filepath):
+    directory, filename = os.path.split(filepath)
+    return os.path.join(directory, 'decoded', f'{filename}.npy')
+
+
+def _gray_uint8(data):
+    """Converts a decoded (rows, cols, samples) TIFF segment to 8-bit grayscale as cv2.imread would."""
+    import cv2
+
+    if data.dtype == np.uint16:
+        data = (data >> 8).astype(np.uint8)
+    elif data.dtype != np.uint8:
+        data = np.clip(data, 0, 255).astype(np.uint8)
+    if data.shape[-1] >= 3:
+        return cv2.cvtColor(np.ascontiguousarray(data[..., :3]), cv2.COLOR_RGB2GRAY)
+    return data[..., 0]
+
+
+def _large_tiff_page(tif):
+    """The first page of an open TIFF if it is large and can be decoded segment by segment, else None."""
+    import tifffile
+
+    page = tif.pages[0]
+    if page.imagelength * page.imagewidth < STREAMING_DECODE_MIN_PIXELS:
+        return None
+    if page.samplesperpixel > 1 and page.planarconfig != tifffile.PLANARCONFIG.CONTIG:
+        return None
+    return page
+
+
+def _stream_tiff(filepath, path):
+    """
+    Decodes a large TIFF into an .npy file at ``path`` one strip or tile at a
+    time, so images beyond cv2's size limits decode in bounded memory.
+    Returns False if the file is not such a TIFF.
+    """
+    import tifffile
+
+    try:
+        tif = tifffile.TiffFile(filepath)
+    except (tifffile.TiffFileError, OSError):
+        return False
+    with tif:
+        page = _large_tiff_page(tif)
+        if page is None:
+            return False
+        height, width = page.imagelength, page.imagewidth
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width))
+        for segment, index, _ in page.segments():
+            if segment is None:
+                continue
+            # Edge segments are padded to the full strip or tile size.
+            y, x = index[-3], index[-2]
+            data = _gray_uint8(segment[0])[:height - y, :width - x]
+            out[y:y + data.shape[0], x:x + data.shape[1]] = data
+        out.flush()
+        del out
+    return True
+
+
+class DecodedImageCache:
+    """Per-process LRU of memory-mapped sidecars, evicted once their total size exceeds ``max_bytes``."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, filepath):
+        """The read-only grayscale image of ``filepath``, or None if it cannot be decoded."""
+        with self._lock:
+            img = self._images.get(filepath)
+            if img is not None:
+                self._images.move_to_end(filepath)
+                return img
+        img = self._load(filepath)
+        if img is None:
+            return None
+        with self._lock:
+            if filepath not in self._images:
+                self._images[filepath] = img
+                self._bytes += img.nbytes
+            while self._bytes > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self._bytes -= evicted.nbytes
+        return img
+
+    def _load(self, filepath):
+        path = sidecar_path(filepath)
+        try:
+            return np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name so other processes never map a partial file.
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with stage('decode'):
+            if not (filepath.lower().endswith(('.tif', '.tiff')) and _stream_tiff(filepath, tmp_path)):
+                img = read_grayscale(filepath)
+                if img is None:
+                    return None
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, img)
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
+    def discard(self, filepath):
+        """Forgets ``filepath`` and deletes its sidecar."""
+        with self._lock:
+            img = self._images.pop(filepath, None)
+            if img is not None:
+                self._bytes -= img.nbytes
+        try:
+            os.remove(sidecar_path(filepath))
+        except FileNotFoundError:
+            pass
+
+
+_cache = DecodedImageCache()
+
+
+def configure(max_bytes):
+    _cache.max_bytes = max_bytes
+
+
+def load_grayscale(filepath):
+    """Reads an upload as a grayscale uint8 array through the shared decoded-image cache."""
+    return _cache.get(filepath)
+
+
+def discard_decoded(filepath):
+    _cache.discard(filepath)
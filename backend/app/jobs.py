@@ -0,0 +1,298 @@
+"""Background segmentation jobs.
+
+Uploads are segmented in a bounded process pool so that a large micrograph
+never blocks a web worker. Job state lives in the ``segmentation_job`` table
+so any web worker can report progress or cancel a job, and the pool workers
+write their progress and results straight to the database. The pool and the
+queue limit belong to one web worker, so a server with several workers runs
+that many pools.
+"""
+import multiprocessing
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import create_engine, select, update
+
+from .contours import PackedContours
+from .image_cache import load_grayscale, discard_decoded
+from .metrics import stage, collect_stages, record_stages, observe_grain_count
+from .models import db, Measurement, Sample, SampleContours, SegmentationJob
+from .tiles import pyramid_dir
+
+
+class QueueFullError(Exception):
+    pass
+
+
+_executor = None
+_executor_lock = threading.Lock()
+# Request threads add futures and the pool's callback thread removes them.
+_futures = {}
+_futures_lock = threading.Lock()
+
+# One engine per pool process, created lazily on first use.
+_engines = {}
+
+
+def _get_executor(max_workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Web workers run request threads, and forking a threaded process can leave a lock held in the child.
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(start_method))
+        return _executor
+
+
+def _get_engine(db_url):
+    engine = _engines.get(db_url)
+    if engine is None:
+        engine = _engines[db_url] = create_engine(db_url)
+    return engine
+
+
+def _pending_count():
+    with _futures_lock:
+        return sum(1 for f in _futures.values() if not f.done())
+
+
+def _set_job_state(engine, job_id, only_if_status=None, **values):
+    values['updated_at'] = datetime.utcnow()
+    stmt = update(SegmentationJob.__table__).where(SegmentationJob.__table__.c.id == job_id)
+    if only_if_status:
+        stmt = stmt.where(SegmentationJob.__table__.c.status.in_(only_if_status))
+    with engine.begin() as conn:
+        return conn.execute(stmt.values(**values)).rowcount
+
+
+def _is_cancelled(engine, job_id):
+    table = SegmentationJob.__table__
+    with engine.connect() as conn:
+        status = conn.execute(select(table.c.status).where(table.c.id == job_id)).scalar()
+    return status in (None, 'cancelled')
+
+
+def _discard_sample(engine, sample_id, filepath, tiles_dir):
+    """Removes a sample whose image could not be segmented, as a failed upload leaves nothing behind."""
+    jobs = SegmentationJob.__table__
+    samples = Sample.__table__
+    with engine.begin() as conn:
+        conn.execute(update(jobs).where(jobs.c.sample_id == sample_id).values(sample_id=None))
+        conn.execute(samples.delete().where(samples.c.id == sample_id))
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    discard_decoded(filepath)
+    shutil.rmtree(tiles_dir, ignore_errors=True)
+
+
+def run_segmentation_job(db_url, job_id, sample_id, filepath, tiles_dir, params=None, refine=False):
+    """
+    Entry point executed inside a pool process. Returns the stage timings and
+    the grain count for the web worker to record, as metrics recorded here would be lost.
+    """
+    with collect_stages() as timings:
+        grain_count = _segment_sample(db_url, job_id, sample_id, filepath, tiles_dir, params, refine)
+    return {'stages': timings, 'grain_count': grain_count}
+
+
+def _record_job_metrics(result):
+    if result:
+        record_stages(result['stages'])
+        if result['grain_count'] is not None:
+            observe_grain_count('segment', result['grain_count'])
+
+
+def _segment_sample(db_url, job_id, sample_id, filepath, tiles_dir, params=None, refine=False):
+    """
+    Segments, tiles and saves one sample. Returns the grain count, or None if
+    the job did not finish. With ``refine`` the sample, segmented before, is
+    refined in place: its contours are replaced and its measurements cleared,
+    while its histogram, pyramid and other results are kept.
+    """
+    import cv2
+    from .multiphase import image_histogram
+    from .segmentation import DEFAULT_PARAMS, segment_grains
+    from .tiled_segmentation import segment_grains_tiled, TILED_SEGMENTATION_MIN_PIXELS
+    from .tiles import build_pyramid
+
+    engine = _get_engine(db_url)
+    jobs = SegmentationJob.__table__
+    samples = Sample.__table__
+    params = params or DEFAULT_PARAMS
+    try:
+        if not _set_job_state(engine, job_id, only_if_status=('queued',),
+                              status='running', stage='decoding', progress=0.05):
+            return
+        img = load_grayscale(filepath)
+        if img is None:
+            _set_job_state(engine, job_id, status='failed', stage=None, error='Could not read image file.')
+            if not refine:
+                _discard_sample(engine, sample_id, filepath, tiles_dir)
+            return
+        image_height_px, image_width_px = img.shape
+
+        if _is_cancelled(engine, job_id):
+            return
+        _set_job_state(engine, job_id, stage='segmenting', progress=0.3)
+        large = img.size >= TILED_SEGMENTATION_MIN_PIXELS
+        if large and params != DEFAULT_PARAMS:
+            raise ValueError(f'Custom segmentation parameters are limited to images under {TILED_SEGMENTATION_MIN_PIXELS} pixels.')
+        histogram = None
+        if large:
+            with stage('segment_tiled'):
+                contours, histogram = segment_grains_tiled(img)
+        else:
+            contours = segment_grains(img, params)
+            if not refine:
+                with stage('histogram'):
+                    histogram = image_histogram(img)
+
+        if not refine:
+            if _is_cancelled(engine, job_id):
+                return
+            _set_job_state(engine, job_id, stage='tiling', progress=0.6)
+            # Large images are beyond cv2.imread, so their viewer pyramid is built from the grayscale map.
+            with stage('pyramid'):
+                tiles = build_pyramid(img if large else cv2.imread(filepath, cv2.IMREAD_COLOR), tiles_dir)
+        del img
+
+        if _is_cancelled(engine, job_id):
+            return
+        _set_job_state(engine, job_id, stage='saving', progress=0.9)
+        packed = PackedContours.from_list(contours)
+        points, offsets = packed.to_bytes()
+        with stage('save'), engine.begin() as conn:
+            # The status guard makes a concurrent cancellation win over a late result.
+            finished = conn.execute(
+                update(jobs)
+                .where(jobs.c.id == job_id, jobs.c.status == 'running')
+                .values(status='done', stage=None, progress=1.0, updated_at=datetime.utcnow())
+            ).rowcount
+            if finished and refine:
+                _save_refined(conn, sample_id, params, len(packed), points, offsets)
+            elif finished:
+                results = {
+                    'image_width_px': image_width_px,
+                    'image_height_px': image_height_px,
+                    'tiles': tiles,
+                    'histogram': histogram,
+                    'segmentation': params
+                }
+                # Keeps results other routes wrote while the job was queued, such as an ASTM comparison.
+                stored = conn.execute(select(samples.c.results).where(samples.c.id == sample_id)).scalar()
+                if isinstance(stored, dict):
+                    results = {**stored, **results}
+                conn.execute(update(samples).where(samples.c.id == sample_id).values(
+                    results=results, revision=samples.c.revision + 1, modified_at=datetime.utcnow()))
+                conn.execute(SampleContours.__table__.insert().values(
+                    sample_id=sample_id, count=len(packed), points=points, offsets=offsets))
+        return len(packed) if finished else None
+    except Exception as e:
+        if _set_job_state(engine, job_id, only_if_status=('queued', 'running'),
+                          status='failed', stage=None, error=str(e)) and not refine:
+            _discard_sample(engine, sample_id, filepath, tiles_dir)
+        raise
+
+
+def _save_refined(conn, sample_id, params, count, points, offsets):
+    """Replaces a segmented sample's contours and clears its measurements, which no longer match them."""
+    samples = Sample.__table__
+    contours = SampleContours.__table__
+    measurements = Measurement.__table__
+    # Re-read under the write lock, so results written while the job ran are kept.
+    results = dict(conn.execute(select(samples.c.results).where(samples.c.id == sample_id)).scalar() or {})
+    results.pop('contours', None)
+    results['segmentation'] = params
+    conn.execute(measurements.delete().where(measurements.c.sample_id == sample_id))
+    conn.execute(update(samples).where(samples.c.id == sample_id).values(
+        results=results, measurement_count=None, measurement_revision=samples.c.measurement_revision + 1,
+        revision=samples.c.revision + 1, modified_at=datetime.utcnow()))
+    # Bumping the version makes edits based on the old contours fail as stale.
+    replaced = conn.execute(update(contours).where(contours.c.sample_id == sample_id).values(
+        count=count, points=points, offsets=offsets, version=contours.c.version + 1)).rowcount
+    if not replaced:
+        conn.execute(contours.insert().values(sample_id=sample_id, count=count, points=points, offsets=offsets))
+
+
+def _on_job_done(db_url, job_id, future):
+    with _futures_lock:
+        _futures.pop(job_id, None)
+    if future.cancelled():
+        return
+    exc = future.exception()
+    if exc is not None:
+        # Covers failures the job could not record itself, e.g. a crashed pool process.
+        _set_job_state(_get_engine(db_url), job_id, only_if_status=('queued', 'running'),
+                       status='failed', stage=None, error=str(exc))
+        return
+    _record_job_metrics(future.result())
+
+
+def submit_segmentation(sample, params=None, refine=False):
+    """
+    Commits a new job for ``sample`` and queues its segmentation, with the
+    pipeline parameters ``params`` or the defaults. ``refine`` re-segments a
+    segmented sample in place instead of setting up a new upload.
+    """
+    return submit_segmentations([sample], params=params, refine=refine)[0]
+
+
+def submit_segmentations(samples, batch_id=None, filenames=None, params=None, refine=False):
+    """
+    Commits a job for every sample in one transaction, together with any
+    samples still pending in the session, and queues their segmentation.
+    A batch is accepted as a whole as long as the queue is not already full.
+    """
+    max_workers = current_app.config['SEGMENTATION_WORKERS']
+    if max_workers and _pending_count() >= current_app.config['SEGMENTATION_MAX_PENDING']:
+        raise QueueFullError()
+
+    filenames = filenames or [None] * len(samples)
+    jobs = [
+        SegmentationJob(id=str(uuid.uuid4()), sample=sample, status='queued', progress=0.0,
+                        batch_id=batch_id, filename=filename)
+        for sample, filename in zip(samples, filenames)
+    ]
+    db.session.add_all(jobs)
+    # Pool processes read the job rows, so they must be committed before submission.
+    db.session.commit()
+
+    db_url = db.engine.url.render_as_string(hide_password=False)
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    for sample, job in zip(samples, jobs):
+        filepath = os.path.join(upload_folder, sample.image_filename)
+        tiles_dir = pyramid_dir(upload_folder, sample.image_filename)
+        args = (db_url, job.id, sample.id, filepath, tiles_dir, params, refine)
+        if not max_workers:
+            # Synchronous mode, used for development and in-process benchmarks.
+            try:
+                _record_job_metrics(run_segmentation_job(*args))
+            except Exception as e:
+                current_app.logger.error(f"Segmentation job {job.id} failed: {e}")
+            continue
+
+        future = _get_executor(max_workers).submit(run_segmentation_job, *args)
+        with _futures_lock:
+            _futures[job.id] = future
+        future.add_done_callback(lambda f, job_id=job.id: _on_job_done(db_url, job_id, f))
+    if not max_workers:
+        db.session.expire_all()
+    return jobs
+
+
+def cancel_job(job):
+    """Cancels a queued or running job. Running jobs stop at their next stage boundary."""
+    if job.is_finished:
+        return False
+    with _futures_lock:
+        future = _futures.get(job.id)
+    if future is not None:
+        future.cancel()
+    job.status = 'cancelled'
+    job.stage = None
+    return True
@@ -0,0 +1,174 @@
+"""Measurement rows: bulk writes, incremental updates and cached statistics.
+
+Measurements live in the Measurement table, one typed row per grain, so
+statistics read single columns instead of parsing the results blob. Every
+write bumps ``Sample.measurement_revision``, which keys the per-process
+statistics cache together with the sample's upload name; a contour edit
+therefore invalidates the statistics of its sample and project without any
+explicit purge, and a new sample that reuses a deleted sample's id never
+gets its numbers.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import bindparam, delete, insert, select, update
+
+from .measurement import MEASUREMENT_FIELDS, columns_to_records, measure_grains
+from .models import db, Measurement, Sample
+
+DEFAULT_HISTOGRAM_BINS = 20
+MAX_HISTOGRAM_BINS = 1000
+DEFAULT_PERCENTILES = (10, 25, 50, 75, 90)
+STATS_CACHE_SIZE = 256
+
+_table = Measurement.__table__
+
+
+def records_to_columns(records):
+    return {field: [m[field] for m in records] for field in MEASUREMENT_FIELDS}
+
+
+def _insert(sample_id, columns):
+    """Bulk-inserts columnar measurements; returns the number of rows."""
+    lists = [np.asarray(columns[field]).tolist() for field in MEASUREMENT_FIELDS]
+    rows = [dict(zip(MEASUREMENT_FIELDS, row), sample_id=sample_id) for row in zip(*lists)]
+    if rows:
+        db.session.execute(insert(_table), rows)
+    return len(rows)
+
+
+def _written(sample, count):
+    sample.measurement_count = count
+    sample.measurement_revision = (sample.measurement_revision or 0) + 1
+
+
+def write_measurements(sample, columns):
+    """Replaces all measurements of ``sample`` with columnar ``columns``."""
+    db.session.execute(delete(_table).where(_table.c.sample_id == sample.id))
+    _written(sample, _insert(sample.id, columns))
+
+
+def clear_measurements(sample):
+    """Drops the measurements of ``sample``, which then counts as not measured."""
+    if sample.measurement_count is None:
+        return
+    db.session.execute(delete(_table).where(_table.c.sample_id == sample.id))
+    _written(sample, None)
+
+
+def apply_edit(sample, edit, scale):
+    """
+    Updates the rows of a measured sample after a ContourEdit: rows of
+    removed and replaced grains are deleted, surviving rows are renumbered,
+    and only the changed grains are measured. Returns the new rows as records.
+    """
+    changed = np.zeros(len(edit.survivors), dtype=bool)
+    changed[[i for i in edit.changed if i < len(edit.survivors)]] = True
+    stale = edit.removed + (edit.survivors[changed] + 1).tolist()
+    deleted = 0
+    if stale:
+        deleted = db.session.execute(
+            delete(_table).where(_table.c.sample_id == sample.id, _table.c.grain_id.in_(stale))).rowcount
+
+    new_ids = np.flatnonzero(~changed) + 1
+    old_ids = edit.survivors[~changed] + 1
+    moved = old_ids != new_ids
+    if moved.any():
+        # Ids only ever decrease, so renumbering in ascending order never collides with a row still to move.
+        db.session.execute(
+            update(_table).where(_table.c.sample_id == sample.id, _table.c.grain_id == bindparam('old_id'))
+            .values(grain_id=bindparam('new_id')),
+            [{'old_id': old, 'new_id': new} for old, new in zip(old_ids[moved].tolist(), new_ids[moved].tolist())])
+
+    fresh = measure_grains(edit.contours, scale, edit.changed)
+    _written(sample, sample.measurement_count - deleted + _insert(sample.id, fresh))
+    return columns_to_records(fresh)
+
+
+def sample_values(sample_id, field):
+    return np.fromiter(db.session.execute(
+        select(_table.c[field]).where(_table.c.sample_id == sample_id)).scalars(), dtype=np.float64)
+
+
+class _StatsCache:
+    """Small LRU of computed statistics; keys embed the upload names and measurement revisions they were computed from."""
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return value
+
+
+_stats_cache = _StatsCache(STATS_CACHE_SIZE)
+
+
+def _summary(values, percentiles):
+    if not len(values):
+        return {'count': 0, 'mean': None, 'std': None, 'min': None, 'max': None,
+                'percentiles': {f'{p:g}': None for p in percentiles}}
+    return {
+        'count': int(len(values)),
+        'mean': float(values.mean()),
+        'std': float(values.std(ddof=1)) if len(values) > 1 else 0.0,
+        'min': float(values.min()),
+        'max': float(values.max()),
+        'percentiles': {f'{p:g}': float(v) for p, v in zip(percentiles, np.percentile(values, percentiles))},
+    }
+
+
+def sample_histogram(sample, field, bins, value_range=None):
+    def compute():
+        values = sample_values(sample.id, field)
+        counts, edges = np.histogram(values, bins=bins, range=value_range)
+        return {'field': field, 'count': int(len(values)), 'edges': edges.tolist(), 'counts': counts.tolist()}
+    key = ('histogram', sample.id, sample.image_filename, sample.measurement_revision, field, bins, value_range)
+    return _stats_cache.get_or_compute(key, compute)
+
+
+def sample_statistics(sample, field, percentiles=DEFAULT_PERCENTILES):
+    key = ('statistics', sample.id, sample.image_filename, sample.measurement_revision, field, tuple(percentiles))
+    return _stats_cache.get_or_compute(
+        key, lambda: dict(_summary(sample_values(sample.id, field), percentiles), field=field))
+
+
+def project_summary(project_id, field, percentiles=DEFAULT_PERCENTILES):
+    """Per-sample statistics of ``field`` over every measured sample of a project."""
+    samples = db.session.execute(
+        select(Sample.id, Sample.name, Sample.image_filename, Sample.measurement_revision)
+        .where(Sample.project_id == project_id, Sample.measurement_count.isnot(None))
+        .order_by(Sample.id)
+    ).all()
+
+    def compute():
+        # One column read ordered by sample; every sample's statistics come from its slice.
+        rows = db.session.execute(
+            select(_table.c.sample_id, _table.c[field])
+            .join(Sample, Sample.id == _table.c.sample_id)
+            .where(Sample.project_id == project_id)
+            .order_by(_table.c.sample_id)
+        ).all()
+        ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        values = np.fromiter((r[1] for r in rows), dtype=np.float64, count=len(rows))
+        starts = np.searchsorted(ids, [s.id for s in samples], side='left')
+        ends = np.searchsorted(ids, [s.id for s in samples], side='right')
+        summaries = []
+        for s, start, end in zip(samples, starts, ends):
+            summaries.append(dict(_summary(values[start:end], percentiles), sample_id=s.id, sample_name=s.name))
+        return {'field': field, 'samples': summaries,
+                'overall': _summary(values, percentiles)}
+
+    key = ('project', project_id, tuple(tuple(s) for s in samples), field, tuple(percentiles))
+    return _stats_cache.get_or_compute(key, compute)
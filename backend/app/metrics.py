@@ -0,0 +1,169 @@
+"""Request and processing-stage instrumentation, exported in Prometheus format.
+
+``stage(name)`` times a block of work. Segmentation runs in pool processes,
+so the job collects its stage timings with ``collect_stages()`` and returns
+them, and the web worker records them when the job finishes. With several
+gunicorn workers, set PROMETHEUS_MULTIPROC_DIR so /metrics aggregates all of them.
+
+Requests slower than SLOW_REQUEST_THRESHOLD_S are logged. If
+SLOW_REQUEST_PROFILE_DIR is also set, every request runs under cProfile and
+the profiles of slow ones are written there.
+"""
+import contextvars
+import cProfile
+import os
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import g, request
+from flask.json.provider import DefaultJSONProvider
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram,
+                               generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+_SIZE_BUCKETS = tuple(4 ** i for i in range(3, 16))
+_COUNT_BUCKETS = (0, 10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000)
+
+REQUEST_DURATION = Histogram('metallobox_request_duration_seconds', 'HTTP request duration.',
+                             ['method', 'endpoint', 'status'])
+STAGE_DURATION = Histogram('metallobox_stage_duration_seconds', 'Duration of a processing stage.', ['stage'])
+REQUEST_BYTES = Histogram('metallobox_request_bytes', 'HTTP request body size.', ['endpoint'], buckets=_SIZE_BUCKETS)
+RESPONSE_BYTES = Histogram('metallobox_response_bytes', 'HTTP response body size, for non-streamed responses.',
+                           ['endpoint'], buckets=_SIZE_BUCKETS)
+GRAIN_COUNT = Histogram('metallobox_grain_count', 'Grains per segmented or measured sample.', ['operation'],
+                        buckets=_COUNT_BUCKETS)
+
+# Set while a segmentation job collects its own stage timings.
+_collected = contextvars.ContextVar('collected_stages', default=None)
+
+
+@contextmanager
+def stage(name):
+    """Times the enclosed block as processing stage ``name``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        collected = _collected.get()
+        if collected is None:
+            STAGE_DURATION.labels(name).observe(elapsed)
+        else:
+            collected[name] = collected.get(name, 0.0) + elapsed
+
+
+@contextmanager
+def collect_stages():
+    """Collects stage timings into the yielded dict instead of recording them, for use in other processes."""
+    collected = {}
+    token = _collected.set(collected)
+    try:
+        yield collected
+    finally:
+        _collected.reset(token)
+
+
+def record_stages(timings):
+    for name, elapsed in timings.items():
+        STAGE_DURATION.labels(name).observe(elapsed)
+
+
+def observe_grain_count(operation, count):
+    GRAIN_COUNT.labels(operation).observe(count)
+
+
+def metrics_response():
+    """Body and content type of the /metrics endpoint."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Times JSON response serialization as its own stage."""
+
+    def response(self, *args, **kwargs):
+        with stage('json_serialize'):
+            return super().response(*args, **kwargs)
+
+
+def _before_commit(session):
+    session.info['commit_started'] = time.perf_counter()
+
+
+def _after_commit(session):
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        STAGE_DURATION.labels('db_commit').observe(time.perf_counter() - started)
+
+
+def _after_rollback(session):
+    session.info.pop('commit_started', None)
+
+
+def _endpoint():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def init_app(app):
+    app.json_provider_class = TimedJSONProvider
+    app.json = TimedJSONProvider(app)
+    if not event.contains(Session, 'before_commit', _before_commit):
+        event.listen(Session, 'before_commit', _before_commit)
+        event.listen(Session, 'after_commit', _after_commit)
+        event.listen(Session, 'after_rollback', _after_rollback)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.profiler = None
+        if app.config['SLOW_REQUEST_THRESHOLD_S'] and app.config['SLOW_REQUEST_PROFILE_DIR']:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another request on this interpreter is already being profiled.
+                return
+            g.profiler = profiler
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        endpoint = _endpoint()
+        REQUEST_DURATION.labels(request.method, endpoint, str(response.status_code)).observe(elapsed)
+        if request.content_length:
+            REQUEST_BYTES.labels(endpoint).observe(request.content_length)
+        if not response.is_streamed and response.content_length is not None:
+            RESPONSE_BYTES.labels(endpoint).observe(response.content_length)
+
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+        threshold = app.config['SLOW_REQUEST_THRESHOLD_S']
+        if threshold and elapsed >= threshold:
+            message = f'Slow request: {request.method} {request.full_path} took {elapsed:.3f}s'
+            if profiler is not None:
+                profile_dir = app.config['SLOW_REQUEST_PROFILE_DIR']
+                os.makedirs(profile_dir, exist_ok=True)
+                name = re.sub(r'[^A-Za-z0-9.-]+', '_', endpoint).strip('_')
+                path = os.path.join(profile_dir, f'{datetime.utcnow():%Y%m%dT%H%M%S%f}-{request.method}-{name}.prof')
+                profiler.dump_stats(path)
+                message += f', profile written to {path}'
+            app.logger.warning(message)
+        return response
+
+    @app.teardown_request
+    def stop_profiler(exc):
+        # Requests that raised never reach after_request.
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
@@ -0,0 +1,82 @@
+"""Idempotent schema upgrades for existing databases.
+
+Run them with ``flask --app run upgrade-db`` before starting the server. With
+MIGRATE_ON_START (the default outside the Docker image), create_app also runs
+them, which is convenient for development but repeats the work in every
+process that creates the app.
+"""
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, select, text, update
+
+from .models import db, AppliedMigration, Measurement, Sample
+
+# Samples whose results blobs a data migration loads at once.
+MIGRATION_BATCH_SIZE = 100
+
+
+def _add_missing_columns():
+    """Adds model columns missing from existing tables. New columns must be nullable or have a server default."""
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=db.engine.dialect)}'
+                if column.server_default is not None:
+                    ddl += f' DEFAULT {column.server_default.arg}'
+                conn.execute(text(ddl))
+
+
+def _move_measurements_to_table():
+    """
+    Moves measurements still stored in the results blob into the Measurement
+    table. Recorded in AppliedMigration once done, so later starts cost a
+    single row lookup.
+    """
+    from .measurement import MEASUREMENT_FIELDS
+
+    measurements = Measurement.__table__
+    samples = Sample.__table__
+    applied = AppliedMigration.__table__
+    name = 'measurements_table'
+    with db.engine.begin() as conn:
+        if conn.execute(select(applied.c.name).where(applied.c.name == name)).first() is not None:
+            return
+        # Blobs are loaded a batch at a time and checked here, which works on any database.
+        sample_ids = conn.execute(select(samples.c.id).where(samples.c.results.isnot(None))).scalars().all()
+        for start in range(0, len(sample_ids), MIGRATION_BATCH_SIZE):
+            batch = sample_ids[start:start + MIGRATION_BATCH_SIZE]
+            for sample_id, results in conn.execute(
+                    select(samples.c.id, samples.c.results).where(samples.c.id.in_(batch))).all():
+                if not isinstance(results, dict) or 'measurements' not in results:
+                    continue
+                records = results.pop('measurements')
+                if records:
+                    conn.execute(measurements.insert(), [
+                        dict({field: m.get(field) for field in MEASUREMENT_FIELDS}, sample_id=sample_id) for m in records])
+                conn.execute(update(samples).where(samples.c.id == sample_id).values(
+                    results=results, measurement_count=len(records),
+                    measurement_revision=samples.c.measurement_revision + 1))
+        conn.execute(applied.insert().values(name=name))
+
+
+def upgrade():
+    """Creates missing tables, columns and indexes. Safe to run on every start."""
+    db.create_all()
+    _add_missing_columns()
+    _move_measurements_to_table()
+    # create_all only creates indexes together with new tables.
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db_command():
+    """Creates or upgrades the database schema."""
+    upgrade()
+    click.echo('Database schema is up to date.')
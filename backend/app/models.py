@@ -1,5 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import flag_modified
 from datetime import datetime
+from .contours import PackedContours
+from .measurement import MEASUREMENT_FIELDS
 
 db = SQLAlchemy()
 
@@ -7,19 +12,31 @@ class Project(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
     description = db.Column(db.Text, nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     samples = db.relationship('Sample', backref='project', lazy=True, cascade="all, delete-orphan")
 
-    def to_dict(self):
+    @classmethod
+    def query_with_sample_counts(cls):
+        """Query yielding (project, sample_count) rows from a single GROUP BY."""
+        return (db.session.query(cls, db.func.count(Sample.id))
+                .outerjoin(Sample, Sample.project_id == cls.id)
+                .group_by(cls.id))
+
+    def to_dict(self, sample_count=None):
+        if sample_count is None:
+            sample_count = db.session.query(db.func.count(Sample.id)).filter(Sample.project_id == self.id).scalar()
         return {
             'id': self.id,
             'name': self.name,
             'description': self.description,
             'created_at': self.created_at.isoformat(),
-            'sample_count': len(self.samples)
+            'sample_count': sample_count
         }
 
 class Sample(db.Model):
+    # Serves the per-project listing, which filters on project_id and orders by created_at.
+    __table_args__ = (db.Index('ix_sample_project_id_created_at', 'project_id', 'created_at'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     image_filename = db.Column(db.String(200), nullable=False, unique=True)
@@ -28,14 +45,204 @@ class Sample(db.Model):
 
     scale_pixels_per_mm = db.Column(db.Float, nullable=True)
     results = db.Column(db.JSON, nullable=True)
+    # Rows in the Measurement table; None until the sample is measured.
+    measurement_count = db.Column(db.Integer, nullable=True)
+    # Bumped by every measurement write, to key cached statistics.
+    measurement_revision = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Bumped, with modified_at, by every write to the sample or its contours; validates HTTP caching.
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    modified_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+    jobs = db.relationship('SegmentationJob', backref='sample', lazy=True)
+    packed_contours = db.relationship('SampleContours', uselist=False, lazy=True, cascade="all, delete-orphan")
 
-    def to_dict(self):
-        return {
+    def get_contours(self):
+        """Returns the sample's contours as PackedContours, or None before segmentation."""
+        if self.packed_contours is not None:
+            return self.packed_contours.unpack()
+        # Samples segmented before packed storage keep their contours in the results blob.
+        if self.results and 'contours' in self.results:
+            return PackedContours.from_list(self.results['contours'])
+        return None
+
+    @property
+    def contours_version(self):
+        """Version of the stored contours; 0 for contours still kept in the results blob."""
+        return self.packed_contours.version if self.packed_contours is not None else 0
+
+    def set_contours(self, contours):
+        points, offsets = contours.to_bytes()
+        if self.packed_contours is None:
+            self.packed_contours = SampleContours(count=len(contours), points=points, offsets=offsets)
+        else:
+            self.packed_contours.count = len(contours)
+            self.packed_contours.points = points
+            self.packed_contours.offsets = offsets
+        if self.results and 'contours' in self.results:
+            del self.results['contours']
+            flag_modified(self, 'results')
+
+    @property
+    def is_segmented(self):
+        # Only a finished segmentation stores the image dimensions; other routes may write results before that.
+        return isinstance(self.results, dict) and 'image_width_px' in self.results
+
+    @property
+    def has_measurements(self):
+        return self.measurement_count is not None
+
+    def get_measurement_records(self):
+        """The sample's measurements as dicts ordered by grain id, or None before measuring."""
+        if self.measurement_count is None:
+            return None
+        columns = [Measurement.__table__.c[field] for field in MEASUREMENT_FIELDS]
+        rows = db.session.execute(
+            db.select(*columns).where(Measurement.sample_id == self.id).order_by(Measurement.grain_id)
+        ).all()
+        return [dict(zip(MEASUREMENT_FIELDS, row)) for row in rows]
+
+    SUMMARY_FIELDS = ('id', 'name', 'image_filename', 'created_at', 'project_id', 'scale_pixels_per_mm')
+
+    @classmethod
+    def parse_fields(cls, spec):
+        """
+        Parses a ``fields=`` query value into a set of field names, defaulting to the
+        summary fields. Besides the summary columns, ``results`` selects the whole
+        results object and ``results.<key>`` selects single entries of it.
+        Raises ValueError on unknown fields.
+        """
+        if not spec:
+            return set(cls.SUMMARY_FIELDS)
+        fields = {f.strip() for f in spec.split(',') if f.strip()}
+        unknown = [f for f in fields if f not in cls.SUMMARY_FIELDS and f != 'results' and not f.startswith('results.')]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        return fields
+
+    @staticmethod
+    def needs_results(fields):
+        return fields is None or any(f == 'results' or f.startswith('results.') for f in fields)
+
+    def _results_dict(self, keys=None):
+        if self.results is None and self.packed_contours is None and self.measurement_count is None:
+            return None
+        results = dict(self.results or {})
+        if keys is not None:
+            results = {k: results[k] for k in keys if k in results}
+        if (keys is None or 'measurements' in keys) and self.measurement_count is not None:
+            results['measurements'] = self.get_measurement_records()
+        if keys is None or 'contours' in keys:
+            contours = self.get_contours()
+            if contours is not None:
+                results['contours'] = contours.to_json()
+                results['contours_version'] = self.contours_version
+        return results
+
+    def to_dict(self, fields=None):
+        data = {
             'id': self.id,
             'name': self.name,
             'image_filename': self.image_filename,
             'created_at': self.created_at.isoformat(),
             'project_id': self.project_id,
             'scale_pixels_per_mm': self.scale_pixels_per_mm,
-            'results': self.results
         }
+        if fields is None:
+            data['results'] = self._results_dict()
+            return data
+        data = {k: v for k, v in data.items() if k in fields}
+        if 'results' in fields:
+            data['results'] = self._results_dict()
+        else:
+            keys = [f[len('results.'):] for f in fields if f.startswith('results.')]
+            if keys:
+                data['results'] = self._results_dict(keys)
+        return data
+
+class SampleContours(db.Model):
+    """Packed contour buffers of a sample, kept out of the results JSON blob."""
+    sample_id = db.Column(db.Integer, db.ForeignKey('sample.id'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    points = db.Column(db.LargeBinary, nullable=False)
+    offsets = db.Column(db.LargeBinary, nullable=False)
+    # Bumped by every ORM update; an update based on a stale version raises StaleDataError.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+
+    def unpack(self):
+        return PackedContours.from_bytes(self.points, self.offsets)
+
+class Measurement(db.Model):
+    """One measured grain of a sample; the columns are MEASUREMENT_FIELDS."""
+    sample_id = db.Column(db.Integer, db.ForeignKey('sample.id'), primary_key=True)
+    grain_id = db.Column(db.Integer, primary_key=True)
+    area_px = db.Column(db.Float, nullable=False)
+    area_mm2 = db.Column(db.Float, nullable=False)
+    perimeter_mm = db.Column(db.Float, nullable=False)
+    equiv_diameter_mm = db.Column(db.Float, nullable=False)
+    orientation_deg = db.Column(db.Float, nullable=False)
+    center_x_px = db.Column(db.Float, nullable=False)
+    center_y_px = db.Column(db.Float, nullable=False)
+
+
+@event.listens_for(Sample, 'before_update')
+def _bump_revision(mapper, connection, sample):
+    # Also covers results written in place and marked with flag_modified.
+    if object_session(sample).is_modified(sample, include_collections=False):
+        # Incremented in SQL, as _bump_sample_revision may have moved the stored value past the loaded one.
+        sample.revision = Sample.revision + 1
+        sample.modified_at = datetime.utcnow()
+
+
+@event.listens_for(SampleContours, 'after_insert')
+@event.listens_for(SampleContours, 'after_update')
+def _bump_sample_revision(mapper, connection, contours):
+    connection.execute(Sample.__table__.update().where(Sample.__table__.c.id == contours.sample_id)
+                       .values(revision=Sample.__table__.c.revision + 1, modified_at=datetime.utcnow()))
+
+
+@event.listens_for(Sample, 'before_delete')
+def _delete_measurements(mapper, connection, sample):
+    # One bulk DELETE instead of loading every row through an ORM cascade.
+    connection.execute(Measurement.__table__.delete().where(Measurement.__table__.c.sample_id == sample.id))
+
+
+class SegmentationJob(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    sample_id = db.Column(db.Integer, db.ForeignKey('sample.id'), nullable=True, index=True)
+    # Set for jobs created by a bulk upload, which also records each job's uploaded file name.
+    batch_id = db.Column(db.String(36), nullable=True, index=True)
+    filename = db.Column(db.String(255), nullable=True)
+    # queued -> running -> done | failed | cancelled
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    stage = db.Column(db.String(50), nullable=True)
+    progress = db.Column(db.Float, nullable=False, default=0.0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+
+    @property
+    def is_finished(self):
+        return self.status in self.FINISHED_STATUSES
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'sample_id': self.sample_id,
+            'batch_id': self.batch_id,
+            'filename': self.filename,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': self.progress,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+
+class AppliedMigration(db.Model):
+    """Data migrations that have run, so upgrade() skips them on later starts."""
+    name = db.Column(db.String(100), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
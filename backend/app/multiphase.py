@@ -0,0 +1,80 @@
+"""Histogram-based phase fractions and threshold previews."""
+from functools import lru_cache
+
+import numpy as np
+
+from .image_cache import load_grayscale
+from .metrics import stage
+
+PREVIEW_MAX_SIZE = 512
+MAX_THRESHOLDS = 8
+
+
+# Rows per histogram band, so memory-mapped images are read a band at a time.
+HISTOGRAM_BAND_ROWS = 1024
+
+
+def image_histogram(img):
+    """256-bin intensity histogram of a grayscale image, as a list of ints."""
+    import cv2
+
+    histogram = np.zeros(256, dtype=np.int64)
+    for y in range(0, img.shape[0], HISTOGRAM_BAND_ROWS):
+        band = np.ascontiguousarray(img[y:y + HISTOGRAM_BAND_ROWS])
+        histogram += cv2.calcHist([band], [0], None, [256], [0, 256]).ravel().astype(np.int64)
+    return histogram.tolist()
+
+
+def parse_thresholds(values):
+    """Validates a list of thresholds and returns them sorted. Raises ValueError."""
+    thresholds = sorted(int(v) for v in values)
+    if not thresholds or len(thresholds) > MAX_THRESHOLDS:
+        raise ValueError()
+    if not all(0 <= t <= 255 for t in thresholds) or len(set(thresholds)) != len(thresholds):
+        raise ValueError()
+    return thresholds
+
+
+def phase_percents(histogram, thresholds):
+    """
+    Area percentage of each phase for sorted ``thresholds``, brightest phase
+    first. As with cv2.THRESH_BINARY, a pixel above a threshold belongs to the
+    brighter side. Only the cumulative histogram is needed, so any split costs O(1).
+    """
+    cumulative = np.cumsum(histogram)
+    total = cumulative[-1]
+    # Pixels <= each boundary, from the full range down to the lowest threshold.
+    at_or_below = np.concatenate([[total], cumulative[thresholds[::-1]], [0]])
+    return (-np.diff(at_or_below) / total * 100).tolist()
+
+
+def phase_lut(thresholds):
+    """Lookup table mapping each intensity to its phase's display gray, brightest phase white."""
+    phases = np.searchsorted(np.asarray(thresholds), np.arange(256), side='left')
+    return np.round(phases * 255 / len(thresholds)).astype(np.uint8)
+
+
+@lru_cache(maxsize=16)
+def reduced_image(filepath, max_size):
+    import cv2
+
+    img = load_grayscale(filepath)
+    if img is None:
+        return None
+    height, width = img.shape
+    scale = min(1.0, max_size / max(height, width))
+    if scale < 1.0:
+        img = cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def render_preview(filepath, thresholds, max_size=PREVIEW_MAX_SIZE):
+    """PNG of the phase map at reduced resolution, or None if the image cannot be read."""
+    import cv2
+
+    img = reduced_image(filepath, max_size)
+    if img is None:
+        return None
+    with stage('preview_render'):
+        _, png = cv2.imencode('.png', cv2.LUT(img, phase_lut(thresholds)))
+    return png.tobytes()
@@ -1,21 +1,90 @@
-from flask import current_app, request, jsonify, send_file, send_from_directory
-from .models import db, Project, Sample
-import cv2
+from flask import abort, current_app, request, jsonify, send_file, send_from_directory, stream_with_context
+from .models import db, Project, Sample, SegmentationJob
+from .contours import PackedContours
+from .astm_charts import get_chart_cache, chart_url, MIN_G, MAX_G, MAX_CHART_DIMENSION_PX
+from .multiphase import image_histogram, parse_thresholds, phase_percents, render_preview, PREVIEW_MAX_SIZE
+from .tiles import remove_pyramid, dzi_xml
+from .image_cache import load_grayscale, discard_decoded
+from .measurement import MEASUREMENT_FIELDS, measure_grains, remeasure
+from .measurement_store import (DEFAULT_HISTOGRAM_BINS, MAX_HISTOGRAM_BINS, DEFAULT_PERCENTILES, write_measurements,
+                                clear_measurements, records_to_columns, project_summary, sample_histogram,
+                                sample_statistics, apply_edit as apply_measurement_edit)
+from .contour_edits import ContourEditError, apply_edits, split_polygon
+from .spatial_index import QUERY_MODES, get_grain_index, discard_grain_index
+from .intercepts import GrainBoundaries, count_line_intercepts, count_circle_intercepts, DEFAULT_MAX_GAP_PX
+from .segmentation import (DEFAULT_PARAMS as DEFAULT_SEGMENTATION_PARAMS, SegmentationParamsError,
+                           parse_params as parse_segmentation_params, preview as preview_segmentation_pipeline)
+from .jobs import submit_segmentation, submit_segmentations, cancel_job, QueueFullError
+from .metrics import stage, observe_grain_count, metrics_response
+from .export import EXPORT_FORMATS, iter_sample_measurements, project_sample_ids
+from .bulk_upload import BulkUploadError, is_zip, save_stream, store_upload, extract_archive, remove_stored
 import numpy as np
 import os
 import uuid
 from werkzeug.utils import secure_filename
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import defer
 from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 import io
-import pandas as pd
+import math
+import time
+import json
 import base64
-from shapely.geometry import Polygon, LineString
-from datetime import datetime
-import matplotlib
-matplotlib.use('Agg') # Use a non-interactive backend
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-from scipy.spatial import Voronoi, voronoi_plot_2d
+from datetime import datetime, timezone
+from functools import wraps
+
+# For URLs whose content never changes once created.
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def send_immutable(directory, filename):
+    response = send_from_directory(directory, filename, max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+def sample_validators(sample_id):
+    """The weak ETag and Last-Modified of a sample's current revision, or None if it does not exist."""
+    row = db.session.execute(
+        db.select(Sample.image_filename, Sample.revision, Sample.created_at, Sample.modified_at)
+        .where(Sample.id == sample_id)
+    ).one_or_none()
+    if row is None:
+        return None
+    # The upload name guards against a deleted sample's id being reused.
+    return f'{row.image_filename}:{row.revision}', (row.modified_at or row.created_at).replace(microsecond=0, tzinfo=timezone.utc)
+
+def sample_revision_conditional(view):
+    """
+    Makes a per-sample GET view conditional on the sample's revision: the
+    validators come from a few small columns, so a matching If-None-Match or
+    If-Modified-Since is answered with 304 without loading the sample or its
+    results, and successful responses carry ETag and Last-Modified.
+    """
+    @wraps(view)
+    def conditional_view(sample_id, **kwargs):
+        validators = sample_validators(sample_id)
+        if validators is None:
+            abort(404)
+        etag, last_modified = validators
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+        if not_modified:
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.make_response(view(sample_id, **kwargs))
+            if response.status_code != 200:
+                return response
+            # Views may fill in derived results (see get_histogram), so the body matches the revision after the view.
+            etag, last_modified = sample_validators(sample_id) or validators
+        response.set_etag(etag, weak=True)
+        response.last_modified = last_modified
+        # Samples change in place, so clients revalidate before every reuse.
+        response.cache_control.no_cache = True
+        return response
+    return conditional_view
 
 # --- Project Routes ---
 @current_app.route('/api/projects', methods=['POST'])
@@ -28,12 +97,12 @@ def create_project():
     new_project = Project(name=data['name'], description=data.get('description', ''))
     db.session.add(new_project)
     db.session.commit()
-    return jsonify(new_project.to_dict()), 201
+    return jsonify(new_project.to_dict(sample_count=0)), 201
 
 @current_app.route('/api/projects', methods=['GET'])
 def get_projects():
-    projects = Project.query.order_by(Project.created_at.desc()).all()
-    return jsonify([p.to_dict() for p in projects])
+    rows = Project.query_with_sample_counts().order_by(Project.created_at.desc()).all()
+    return jsonify([p.to_dict(sample_count=count) for p, count in rows])
 
 @current_app.route('/api/projects/<int:id>', methods=['GET'])
 def get_project(id):
@@ -63,11 +132,50 @@ def delete_project(id):
     return jsonify({'message': 'Project deleted successfully'}), 200
 
 # --- Sample Routes ---
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(sample):
+    payload = json.dumps([sample.created_at.isoformat(), sample.id])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_cursor(cursor):
+    created_at, sample_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(created_at), int(sample_id)
+
+def sample_query(fields):
+    query = Sample.query
+    if not Sample.needs_results(fields):
+        query = query.options(defer(Sample.results))
+    return query
+
 @current_app.route('/api/projects/<int:project_id>/samples', methods=['GET'])
 def get_samples_for_project(project_id):
     Project.query.get_or_404(project_id)
-    samples = Sample.query.filter_by(project_id=project_id).order_by(Sample.created_at.desc()).all()
-    return jsonify([s.to_dict() for s in samples])
+    try:
+        fields = Sample.parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        if limit <= 0: raise ValueError()
+    except ValueError:
+        return jsonify({'error': 'Invalid limit value.'}), 400
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    # Keyset pagination over (created_at, id), newest first.
+    query = sample_query(fields).filter_by(project_id=project_id)
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            created_at, sample_id = decode_cursor(cursor)
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Invalid cursor.'}), 400
+        query = query.filter(or_(Sample.created_at < created_at,
+                                 and_(Sample.created_at == created_at, Sample.id < sample_id)))
+    samples = query.order_by(Sample.created_at.desc(), Sample.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(samples[limit - 1]) if len(samples) > limit else None
+    return jsonify({'items': [s.to_dict(fields) for s in samples[:limit]], 'next_cursor': next_cursor})
 
 @current_app.route('/api/projects/<int:project_id>/samples', methods=['POST'])
 def create_sample(project_id):
@@ -84,41 +192,213 @@ def create_sample(project_id):
         unique_filename = f"{uuid.uuid4()}{ext}"
         filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
         file.save(filepath)
-        # Note: cv2.imread may not support all TIFF formats (e.g., compressed or floating-point).
-        # For broader TIFF support, a library like tifffile might be necessary.
-        img = cv2.imread(filepath, cv2.IMREAD_GRAYSCALE)
-        if img is None:
+        # Only the header is checked here; decoding and segmentation happen in the job.
+        import cv2
+        if not cv2.haveImageReader(filepath):
             os.remove(filepath)
             return jsonify({'error': 'Could not read image file.'}), 400
-        image_height_px, image_width_px = img.shape
-        blurred = cv2.GaussianBlur(img, (5, 5), 0)
-        _, thresh = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        contours_json = [c.tolist() for c in contours]
-        new_sample = Sample(
-            name=sample_name,
-            image_filename=unique_filename,
-            project_id=project.id,
-            results={'contours': contours_json, 'image_width_px': image_width_px, 'image_height_px': image_height_px}
-        )
+        new_sample = Sample(name=sample_name, image_filename=unique_filename, project_id=project.id)
         db.session.add(new_sample)
-        db.session.commit()
-        return jsonify(new_sample.to_dict()), 201
+        try:
+            job = submit_segmentation(new_sample)
+        except QueueFullError:
+            db.session.rollback()
+            os.remove(filepath)
+            return jsonify({'error': 'Segmentation queue is full, please retry later.'}), 503, {'Retry-After': '10'}
+        if job.status == 'failed':
+            return jsonify({'error': job.error or 'Segmentation failed.'}), 400
+        return jsonify({'job': job.to_dict(), 'sample': new_sample.to_dict()}), 202
     return jsonify({'error': 'File upload failed'}), 400
 
+@current_app.route('/api/projects/<int:project_id>/samples/bulk', methods=['POST'])
+def create_samples_bulk(project_id):
+    """
+    Creates one sample per image from a ZIP request body, or from the ``files``
+    parts of a multipart request, each of which may itself be a ZIP archive.
+    All samples are inserted in one transaction and segmented in parallel;
+    progress is reported per file by GET /api/batches/<batch_id>.
+    """
+    project = Project.query.get_or_404(project_id)
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    max_files = current_app.config['BULK_UPLOAD_MAX_FILES']
+    max_bytes = current_app.config['BULK_UPLOAD_MAX_BYTES']
+
+    entries = []
+    archives = []
+    extracted_bytes = 0
+    try:
+        if is_zip('', request.mimetype):
+            archives.append(save_stream(request.stream, upload_folder))
+        else:
+            for file in request.files.getlist('files'):
+                if not file.filename:
+                    continue
+                if is_zip(file.filename, file.mimetype):
+                    archives.append(save_stream(file.stream, upload_folder))
+                elif len(entries) < max_files:
+                    entries.append(store_upload(file.stream, file.filename, upload_folder))
+                else:
+                    raise BulkUploadError(f'A batch is limited to {max_files} files.')
+        for path in archives:
+            archive_entries, archive_bytes = extract_archive(
+                path, upload_folder, max_files - len(entries), max_bytes - extracted_bytes)
+            entries.extend(archive_entries)
+            extracted_bytes += archive_bytes
+    except BulkUploadError as e:
+        remove_stored(entries, upload_folder)
+        return jsonify({'error': str(e)}), 400
+    finally:
+        for path in archives:
+            os.remove(path)
+
+    accepted = [entry for entry in entries if 'image_filename' in entry]
+    if not accepted:
+        return jsonify({'error': 'No readable images in the upload.', 'files': entries}), 400
+
+    samples = [
+        Sample(name=os.path.splitext(entry['filename'])[0], image_filename=entry['image_filename'], project_id=project.id)
+        for entry in accepted
+    ]
+    db.session.add_all(samples)
+    batch_id = str(uuid.uuid4())
+    try:
+        jobs = submit_segmentations(samples, batch_id=batch_id, filenames=[entry['filename'] for entry in accepted])
+    except QueueFullError:
+        db.session.rollback()
+        remove_stored(accepted, upload_folder)
+        return jsonify({'error': 'Segmentation queue is full, please retry later.'}), 503, {'Retry-After': '10'}
+
+    for entry, job in zip(accepted, jobs):
+        del entry['image_filename']
+        entry['job'] = job.to_dict()
+    return jsonify({'batch_id': batch_id, 'files': entries}), 202
+
+@current_app.route('/api/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    jobs = SegmentationJob.query.filter_by(batch_id=batch_id).order_by(SegmentationJob.created_at, SegmentationJob.filename).all()
+    if not jobs:
+        return jsonify({'error': 'Batch not found.'}), 404
+    counts = {status: 0 for status in ('queued', 'running', 'done', 'failed', 'cancelled')}
+    for job in jobs:
+        counts[job.status] = counts.get(job.status, 0) + 1
+    finished = sum(counts[status] for status in SegmentationJob.FINISHED_STATUSES)
+    return jsonify({
+        'batch_id': batch_id,
+        'total': len(jobs),
+        'finished': finished,
+        'counts': counts,
+        'progress': sum(1.0 if job.is_finished else job.progress for job in jobs) / len(jobs),
+        'files': [job.to_dict() for job in jobs],
+    })
+
+@current_app.route('/api/samples/<int:sample_id>', methods=['GET'])
+@sample_revision_conditional
+def get_sample(sample_id):
+    try:
+        fields = Sample.parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    sample = sample_query(fields).filter_by(id=sample_id).first_or_404()
+    return jsonify(sample.to_dict(fields))
+
 @current_app.route('/api/samples/<int:sample_id>', methods=['DELETE'])
 def delete_sample(sample_id):
     sample = Sample.query.get_or_404(sample_id)
+    for job in sample.jobs:
+        cancel_job(job)
+        job.sample = None
     try:
         filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], sample.image_filename)
         if os.path.exists(filepath):
             os.remove(filepath)
+        discard_decoded(filepath)
+        remove_pyramid(current_app.config['UPLOAD_FOLDER'], sample.image_filename)
     except Exception as e:
         current_app.logger.error(f"Error deleting file {sample.image_filename}: {e}")
+    discard_grain_index(sample.id)
     db.session.delete(sample)
     db.session.commit()
     return jsonify({'message': 'Sample deleted successfully'}), 200
 
+# --- Segmentation Job Routes ---
+@current_app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = SegmentationJob.query.get_or_404(job_id)
+    return jsonify(job.to_dict())
+
+@current_app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_segmentation_job(job_id):
+    job = SegmentationJob.query.get_or_404(job_id)
+    if not cancel_job(job):
+        return jsonify({'error': f'Job is already {job.status}.'}), 409
+    sample = job.sample
+    # A cancelled upload leaves no half-segmented sample behind; a cancelled refinement leaves the sample as it was.
+    if sample is not None and not sample.is_segmented:
+        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], sample.image_filename)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        discard_decoded(filepath)
+        remove_pyramid(current_app.config['UPLOAD_FOLDER'], sample.image_filename)
+        job.sample = None
+        db.session.delete(sample)
+    db.session.commit()
+    return jsonify(job.to_dict())
+
+# --- Segmentation Pipeline ---
+def posted_segmentation_params():
+    return parse_segmentation_params((request.get_json(silent=True) or {}).get('params'))
+
+@current_app.route('/api/samples/<int:sample_id>/segmentation/preview', methods=['POST'])
+def preview_segmentation(sample_id):
+    """Runs the pipeline with the posted parameters on a downsampled copy of the image, for tuning them."""
+    sample = Sample.query.options(defer(Sample.results)).filter_by(id=sample_id).first_or_404()
+    try:
+        params = posted_segmentation_params()
+    except SegmentationParamsError as e:
+        return jsonify({'error': str(e)}), 400
+    started = time.perf_counter()
+    with stage('segmentation_preview'):
+        preview = preview_segmentation_pipeline(os.path.join(current_app.config['UPLOAD_FOLDER'], sample.image_filename), params)
+    if preview is None:
+        return jsonify({'error': 'Could not read image file.'}), 400
+    contours, threshold, scale = preview
+    return jsonify({
+        'params': params,
+        'threshold': threshold,
+        'scale': scale,
+        'grain_count': len(contours),
+        'contours': contours.to_flat_json(),
+        'elapsed_ms': (time.perf_counter() - started) * 1000,
+    })
+
+@current_app.route('/api/samples/<int:sample_id>/segment', methods=['POST'])
+def refine_segmentation(sample_id):
+    """
+    Segments the full-resolution image again with the posted parameters, as
+    a job. The new contours replace the sample's and its measurements are cleared.
+    """
+    from .tiled_segmentation import TILED_SEGMENTATION_MIN_PIXELS
+
+    sample = Sample.query.get_or_404(sample_id)
+    try:
+        params = posted_segmentation_params()
+    except SegmentationParamsError as e:
+        return jsonify({'error': str(e)}), 400
+    busy = SegmentationJob.query.filter(SegmentationJob.sample_id == sample.id,
+                                        SegmentationJob.status.in_(('queued', 'running'))).first()
+    if not sample.is_segmented or busy is not None:
+        return jsonify({'error': 'Sample is already being segmented.'}), 409
+    pixels = sample.results.get('image_width_px', 0) * sample.results.get('image_height_px', 0)
+    if pixels >= TILED_SEGMENTATION_MIN_PIXELS and params != DEFAULT_SEGMENTATION_PARAMS:
+        return jsonify({'error': 'Images this large can only be segmented with the default parameters.'}), 400
+    try:
+        job = submit_segmentation(sample, params, refine=True)
+    except QueueFullError:
+        return jsonify({'error': 'Segmentation queue is full, please retry later.'}), 503, {'Retry-After': '10'}
+    if job.status == 'failed':
+        return jsonify({'error': job.error or 'Segmentation failed.'}), 400
+    return jsonify({'job': job.to_dict()}), 202
+
 # --- Analysis Routes ---
 @current_app.route('/api/samples/<int:sample_id>/calibrate', methods=['POST'])
 def calibrate_sample(sample_id):
@@ -140,23 +420,15 @@ def measure_sample(sample_id):
     sample = Sample.query.get_or_404(sample_id)
     if not sample.scale_pixels_per_mm:
         return jsonify({'error': 'Sample must be calibrated.'}), 400
-    if not sample.results or 'contours' not in sample.results:
+    contours = sample.get_contours()
+    if contours is None:
         return jsonify({'error': 'No contours found.'}), 400
-    scale = sample.scale_pixels_per_mm
-    contours = [np.array(c, dtype=np.int32) for c in sample.results['contours']]
-    measurements = []
-    for i, contour in enumerate(contours):
-        if len(contour) < 5: continue
-        area_px = cv2.contourArea(contour)
-        (x, y), (MA, ma), angle = cv2.fitEllipse(contour)
-        measurements.append({
-            'grain_id': i + 1, 'area_px': area_px, 'area_mm2': area_px / (scale ** 2),
-            'perimeter_mm': cv2.arcLength(contour, True) / scale,
-            'equiv_diameter_mm': 2 * np.sqrt((area_px / (scale ** 2)) / np.pi),
-            'orientation_deg': angle, 'center_x_px': x, 'center_y_px': y,
-        })
+    with stage('measure'):
+        measurements = measure_grains(contours, sample.scale_pixels_per_mm)
+    observe_grain_count('measure', len(measurements['grain_id']))
+    write_measurements(sample, measurements)
     if not isinstance(sample.results, dict): sample.results = {}
-    sample.results['measurements'] = measurements
+    sample.results['measurement_scale_pixels_per_mm'] = sample.scale_pixels_per_mm
     flag_modified(sample, "results")
     db.session.commit()
     return jsonify(sample.to_dict())
@@ -172,7 +444,7 @@ def astm_e112_planimetric(sample_id):
         if magnification <= 0: raise ValueError()
     except (ValueError, TypeError):
         return jsonify({'error': 'Invalid magnification value.'}), 400
-    if not sample.results or 'measurements' not in sample.results:
+    if not sample.has_measurements:
         return jsonify({'error': 'Measurements must be calculated first.'}), 400
     if not sample.scale_pixels_per_mm:
         return jsonify({'error': 'Sample must be calibrated first.'}), 400
@@ -181,7 +453,7 @@ def astm_e112_planimetric(sample_id):
     image_width_px = sample.results['image_width_px']
     image_height_px = sample.results['image_height_px']
     total_area_mm2 = (image_width_px * image_height_px) / (sample.scale_pixels_per_mm ** 2)
-    num_grains = len(sample.results['measurements'])
+    num_grains = sample.measurement_count
     n_mm2 = num_grains / total_area_mm2
     n_in2 = n_mm2 * 645.16
     N_A = n_in2 * ((magnification / 100.0) ** 2)
@@ -264,140 +536,172 @@ def astm_e112_intercept(sample_id):
     return jsonify(results)
 
 
-@current_app.route('/api/samples/<int:sample_id>/multiphase', methods=['POST'])
-def multiphase_analysis(sample_id):
-    sample = Sample.query.get_or_404(sample_id)
-    data = request.get_json()
-    if not data or 'threshold' not in data:
-        return jsonify({'error': 'Threshold value is required.'}), 400
-    try:
-        threshold_value = int(data['threshold'])
-        if not (0 <= threshold_value <= 255): raise ValueError()
-    except (ValueError, TypeError):
-        return jsonify({'error': 'Invalid threshold value.'}), 400
-    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], sample.image_filename)
-    img = cv2.imread(filepath, cv2.IMREAD_GRAYSCALE)
-    if img is None: return jsonify({'error': 'Could not read image file.'}), 400
-    _, binary_img = cv2.threshold(img, threshold_value, 255, cv2.THRESH_BINARY)
-    total_pixels = img.size
-    phase_1_pixels = cv2.countNonZero(binary_img)
-    _, buffer = cv2.imencode('.png', binary_img)
-    if not isinstance(sample.results, dict): sample.results = {}
-    sample.results['multiphase'] = {
-        'threshold': threshold_value,
-        'phase_1_percent': (phase_1_pixels / total_pixels) * 100,
-        'phase_2_percent': ((total_pixels - phase_1_pixels) / total_pixels) * 100,
-        'preview_image': f"data:image/png;base64,{base64.b64encode(buffer).decode('utf-8')}"
+AUTO_INTERCEPT_DEFAULT_PLACEMENTS = 25
+AUTO_INTERCEPT_MAX_PLACEMENTS = 500
+
+
+def g_statistics(g_values):
+    """Mean, standard deviation and 95% confidence half-width of per-placement G values."""
+    g_values = np.asarray([g for g in g_values if g is not None], dtype=np.float64)
+    if not len(g_values):
+        return {'g_mean': None, 'g_std': None, 'g_ci95': None}
+    std = float(g_values.std(ddof=1)) if len(g_values) > 1 else 0.0
+    return {
+        'g_mean': float(g_values.mean()),
+        'g_std': std,
+        'g_ci95': float(1.96 * std / np.sqrt(len(g_values))),
     }
-    flag_modified(sample, "results")
-    db.session.commit()
-    return jsonify(sample.to_dict())
 
 
-def lloyds_relaxation(points, bounds, iterations=5):
-    """Applies Lloyd's algorithm to a set of points."""
-    for _ in range(iterations):
-        vor = Voronoi(points)
-        new_points = []
-        for i in range(len(vor.points)):
-            region = vor.regions[vor.point_region[i]]
-            if -1 in region: # Some regions can be open
-                new_points.append(points[i])
-                continue
-
-            polygon = [vor.vertices[j] for j in region]
-
-            # Check if polygon is outside bounds, if so, keep original point
-            if not all(0 <= p[0] <= bounds[0] and 0 <= p[1] <= bounds[1] for p in polygon):
-                new_points.append(points[i])
-                continue
-
-            # Calculate centroid
-            sx, sy, area = 0.0, 0.0, 0.0
-            for k in range(len(polygon)):
-                x0, y0 = polygon[k]
-                x1, y1 = polygon[(k+1) % len(polygon)]
-                cross_product = (x0 * y1) - (x1 * y0)
-                area += cross_product
-                sx += (x0 + x1) * cross_product
-                sy += (y0 + y1) * cross_product
-
-            if area == 0:
-                new_points.append(points[i])
-                continue
-
-            area *= 0.5
-            sx /= (6.0 * area)
-            sy /= (6.0 * area)
-            new_points.append([sx, sy])
-
-        points = np.array(new_points)
-    return points
-
-def generate_individual_astm_charts(magnification, width_px, height_px, g_values=None):
+@current_app.route('/api/samples/<int:sample_id>/astm-e112-intercept/auto', methods=['POST'])
+def astm_e112_intercept_auto(sample_id):
     """
-    Generates individual visual comparison charts for a list of ASTM grain sizes,
-    sized to match the original image, with a more realistic appearance.
+    Counts intercepts of the test pattern against the segmented grain
+    boundaries at the standard centred placement plus random placements, and
+    stores the pooled G under the same keys as the manual count.
     """
-    if g_values is None:
-        g_values = [1, 2, 3, 4]
-
-    charts = {}
+    sample = Sample.query.get_or_404(sample_id)
+    data = request.get_json(silent=True) or {}
 
-    base_points_per_unit_area = 50
+    if not sample.scale_pixels_per_mm:
+        return jsonify({'error': 'Sample must be calibrated first.'}), 400
+    contours = sample.get_contours()
+    if contours is None:
+        return jsonify({'error': 'Sample has no contours.'}), 400
 
-    for G in g_values:
-        N_A_100x = 2**(G - 1)
-        point_density = N_A_100x * (magnification / 100.0)**2
-        num_points = int(point_density * (width_px * height_px) / (1000**2))
+    test_type = data.get('test_type', 'lines')
+    if test_type not in ('lines', 'circles'):
+        return jsonify({'error': 'Invalid test_type specified.'}), 400
+    try:
+        placements = int(data.get('placements', AUTO_INTERCEPT_DEFAULT_PLACEMENTS))
+        seed = int(data.get('seed', 0))
+        max_gap_px = float(data.get('max_gap_px', DEFAULT_MAX_GAP_PX))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid placements, seed or max_gap_px.'}), 400
+    if not 1 <= placements <= AUTO_INTERCEPT_MAX_PLACEMENTS:
+        return jsonify({'error': f'placements must be between 1 and {AUTO_INTERCEPT_MAX_PLACEMENTS}.'}), 400
+    if not max_gap_px >= 0:
+        return jsonify({'error': 'max_gap_px must be zero or more.'}), 400
+    if seed < 0:
+        return jsonify({'error': 'seed must be zero or more.'}), 400
+
+    width = sample.results.get('image_width_px') if isinstance(sample.results, dict) else None
+    height = sample.results.get('image_height_px') if isinstance(sample.results, dict) else None
+    if not width or not height:
+        img = load_grayscale(os.path.join(current_app.config['UPLOAD_FOLDER'], sample.image_filename))
+        if img is None:
+            return jsonify({'error': 'Could not read image.'}), 400
+        height, width = img.shape
 
-        if num_points < 4: num_points = 4
-        if num_points > 2000: num_points = 2000
+    scale = sample.scale_pixels_per_mm
+    boundaries = GrainBoundaries(contours, max_gap_px=max_gap_px)
 
-        # Generate points and relax them using Lloyd's algorithm
-        points = np.random.rand(num_points, 2) * np.array([width_px, height_px])
-        points = lloyds_relaxation(points, (width_px, height_px), iterations=3)
+    if test_type == 'lines':
+        counts = count_line_intercepts(boundaries, width, height, placements, seed)
+        h, v = counts['h_intercepts'], counts['v_intercepts']
+        h_length_mm = counts['h_length_px'] / scale
+        v_length_mm = counts['v_length_px'] / scale
+        per_placement = [calculate_g((hi + vi) / (h_length_mm + v_length_mm)) for hi, vi in zip(h, v)]
+        results = {
+            'astm_g_intercept_h': calculate_g(h.sum() / (h_length_mm * placements)),
+            'astm_g_intercept_v': calculate_g(v.sum() / (v_length_mm * placements)),
+            'astm_g_intercept_global': calculate_g((h.sum() + v.sum()) / ((h_length_mm + v_length_mm) * placements)),
+        }
+        intercepts = float(h.sum() + v.sum())
+    else:
+        counts = count_circle_intercepts(boundaries, width, height, placements, seed)
+        length_mm = counts['length_px'] / scale
+        per_placement = [calculate_g(c / length_mm) for c in counts['intercepts']]
+        results = {'astm_g_intercept_circles': calculate_g(counts['intercepts'].sum() / (length_mm * placements))}
+        intercepts = float(counts['intercepts'].sum())
 
-        dpi = 100
-        fig_width_in = width_px / dpi
-        fig_height_in = height_px / dpi
+    results = {key: (float(g) if g is not None else None) for key, g in results.items()}
+    stats = g_statistics(per_placement)
+    stats.update({'seed': seed, 'max_gap_px': max_gap_px, 'intercepts': intercepts, 'placements': placements})
 
-        fig, ax = plt.subplots(figsize=(fig_width_in, fig_height_in), dpi=dpi)
+    if not isinstance(sample.results, dict):
+        sample.results = {}
+    sample.results.update(results)
+    sample.results[f'astm_intercept_auto_{test_type}'] = stats
+    flag_modified(sample, "results")
+    db.session.commit()
 
-        # Plot the final, relaxed Voronoi diagram
-        vor = Voronoi(points)
+    return jsonify({**results, f'astm_intercept_auto_{test_type}': stats})
 
-        # Fill polygons (grains)
-        for region_index in vor.point_region:
-            region = vor.regions[region_index]
-            if -1 not in region:
-                polygon = [vor.vertices[i] for i in region]
-                # Use a random grayscale color for each grain
-                gray_level = np.random.uniform(0.6, 0.9)
-                ax.fill(*zip(*polygon), color=str(gray_level), edgecolor='none')
 
-        # Draw grain boundaries
-        voronoi_plot_2d(vor, ax=ax, show_vertices=False, line_colors='black', line_width=1.5, point_size=0)
+def get_histogram(sample):
+    """The sample's intensity histogram, computed from the image on first use for older samples."""
+    if isinstance(sample.results, dict) and 'histogram' in sample.results:
+        return sample.results['histogram']
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], sample.image_filename)
+    img = load_grayscale(filepath)
+    if img is None:
+        return None
+    if not isinstance(sample.results, dict): sample.results = {}
+    sample.results['histogram'] = image_histogram(img)
+    flag_modified(sample, "results")
+    db.session.commit()
+    return sample.results['histogram']
 
-        ax.set_title(f"G = {G} @ {magnification}X")
-        ax.set_xlim(0, width_px)
-        ax.set_ylim(0, height_px)
-        ax.set_xticks([])
-        ax.set_yticks([])
-        ax.set_aspect('equal', adjustable='box')
-        plt.axis('off')
-        fig.subplots_adjust(left=0, right=1, top=1, bottom=0)
+def preview_url(sample, thresholds):
+    return f"/api/samples/{sample.id}/multiphase/preview.png?thresholds={','.join(map(str, thresholds))}"
 
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', bbox_inches='tight', pad_inches=0)
-        buf.seek(0)
+@current_app.route('/api/samples/<int:sample_id>/histogram', methods=['GET'])
+@sample_revision_conditional
+def get_sample_histogram(sample_id):
+    sample = Sample.query.get_or_404(sample_id)
+    histogram = get_histogram(sample)
+    if histogram is None: return jsonify({'error': 'Could not read image file.'}), 400
+    return jsonify({'histogram': histogram, 'total_pixels': sum(histogram)})
 
-        img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-        charts[G] = f"data:image/png;base64,{img_base64}"
+@current_app.route('/api/samples/<int:sample_id>/multiphase', methods=['POST'])
+def multiphase_analysis(sample_id):
+    sample = Sample.query.get_or_404(sample_id)
+    data = request.get_json()
+    if not data or ('threshold' not in data and 'thresholds' not in data):
+        return jsonify({'error': 'Threshold value is required.'}), 400
+    try:
+        thresholds = parse_thresholds(data['thresholds'] if 'thresholds' in data else [data['threshold']])
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid threshold value.'}), 400
+    histogram = get_histogram(sample)
+    if histogram is None: return jsonify({'error': 'Could not read image file.'}), 400
+    percents = phase_percents(histogram, thresholds)
+    multiphase = {
+        'thresholds': thresholds,
+        'phase_percents': percents,
+        'preview_url': preview_url(sample, thresholds)
+    }
+    if len(thresholds) == 1:
+        multiphase.update(threshold=thresholds[0], phase_1_percent=percents[0], phase_2_percent=percents[1])
+    sample.results['multiphase'] = multiphase
+    flag_modified(sample, "results")
+    db.session.commit()
+    return jsonify(sample.to_dict())
 
-        plt.close(fig)
+@current_app.route('/api/samples/<int:sample_id>/multiphase/preview.png', methods=['GET'])
+def multiphase_preview(sample_id):
+    sample = Sample.query.get_or_404(sample_id)
+    try:
+        thresholds = parse_thresholds(request.args.get('thresholds', '').split(','))
+        max_size = int(request.args.get('max_size', PREVIEW_MAX_SIZE))
+        if not 0 < max_size <= PREVIEW_MAX_SIZE * 4: raise ValueError()
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid preview parameters.'}), 400
+    # The image never changes, so the preview is determined by the upload name and parameters.
+    etag = f"{sample.image_filename}:{','.join(map(str, thresholds))}:{max_size}"
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], sample.image_filename)
+        png = render_preview(filepath, tuple(thresholds), max_size)
+        if png is None: return jsonify({'error': 'Could not read image file.'}), 400
+        response = current_app.response_class(png, mimetype='image/png')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 24 * 3600
+    return response
 
-    return charts
 
 @current_app.route('/api/samples/<int:sample_id>/astm-chart', methods=['POST'])
 def get_astm_chart(sample_id):
@@ -408,28 +712,48 @@ def get_astm_chart(sample_id):
         return jsonify({'error': 'Magnification is required.'}), 400
 
     g_values = data.get('g_values', [1, 2, 3, 4])
-    width_px = sample.results.get('image_width_px')
-    height_px = sample.results.get('image_height_px')
+    width_px = (sample.results or {}).get('image_width_px')
+    height_px = (sample.results or {}).get('image_height_px')
 
     if not width_px or not height_px:
         return jsonify({'error': 'Image dimensions not found in sample data.'}), 400
+    # The same limit as get_astm_chart_image, which would reject the URLs returned for larger charts.
+    if width_px > MAX_CHART_DIMENSION_PX or height_px > MAX_CHART_DIMENSION_PX:
+        return jsonify({'error': f'Charts are limited to {MAX_CHART_DIMENSION_PX} px per side.'}), 400
 
     try:
         magnification = float(data['magnification'])
-        if magnification <= 0: raise ValueError()
+        # JSON accepts Infinity and NaN, which no chart can be drawn for.
+        if not math.isfinite(magnification) or magnification <= 0: raise ValueError()
+        seed = int(data.get('seed', 0))
+        if seed < 0: raise ValueError()
 
-        if not all(isinstance(g, int) and 0 < g < 15 for g in g_values):
+        if not all(isinstance(g, int) and MIN_G <= g <= MAX_G for g in g_values):
              raise ValueError("Invalid G values")
 
-        charts = generate_individual_astm_charts(magnification, width_px, height_px, g_values)
+        # Render misses now so the returned URLs are served straight from the cache.
+        get_chart_cache().get_or_render_many(g_values, magnification, width_px, height_px, seed)
+        charts = {G: chart_url(G, magnification, width_px, height_px, seed) for G in g_values}
         return jsonify(charts)
 
     except ValueError as e:
-        return jsonify({'error': 'Invalid magnification or G values.'}), 400
+        return jsonify({'error': 'Invalid magnification, seed or G values.'}), 400
     except Exception as e:
         current_app.logger.error(f"Error generating ASTM chart: {e}")
         return jsonify({'error': 'An internal error occurred while generating charts.'}), 500
 
+@current_app.route('/api/astm-charts/<int:g>/<magnification>/<int:width_px>x<int:height_px>/<int:seed>.png', methods=['GET'])
+def get_astm_chart_image(g, magnification, width_px, height_px, seed):
+    try:
+        magnification = float(magnification)
+        if not math.isfinite(magnification) or magnification <= 0 or not MIN_G <= g <= MAX_G: raise ValueError()
+        if not (0 < width_px <= MAX_CHART_DIMENSION_PX and 0 < height_px <= MAX_CHART_DIMENSION_PX): raise ValueError()
+    except ValueError:
+        return jsonify({'error': 'Invalid chart parameters.'}), 400
+    path = get_chart_cache().get_or_render(g, magnification, width_px, height_px, seed)
+    # Charts are deterministic in their URL parameters.
+    return send_immutable(os.path.dirname(path), os.path.basename(path))
+
 @current_app.route('/api/samples/<int:sample_id>/set-astm-comparison', methods=['POST'])
 def set_astm_comparison(sample_id):
     sample = Sample.query.get_or_404(sample_id)
@@ -452,7 +776,194 @@ def set_astm_comparison(sample_id):
     return jsonify(sample.to_dict())
 
 
+@current_app.route('/api/samples/<int:sample_id>/contours', methods=['GET'])
+@sample_revision_conditional
+def get_sample_contours(sample_id):
+    sample = Sample.query.get_or_404(sample_id)
+    contours = sample.get_contours()
+    if contours is None:
+        return jsonify({'error': 'No contours found.'}), 404
+    if request.args.get('format') == 'npz':
+        return send_file(io.BytesIO(contours.to_npz()), mimetype='application/octet-stream', as_attachment=True, download_name=f'sample_{sample.id}_contours.npz')
+    return jsonify({'contours': contours.to_json(), 'version': sample.contours_version})
+
+
+# --- Measurement Statistics ---
+STATISTIC_FIELDS = tuple(f for f in MEASUREMENT_FIELDS if f != 'grain_id')
+
+def statistic_field():
+    field = request.args.get('field', 'equiv_diameter_mm')
+    if field not in STATISTIC_FIELDS:
+        raise ValueError(f"Invalid field, expected one of {', '.join(STATISTIC_FIELDS)}.")
+    return field
+
+def requested_percentiles():
+    spec = request.args.get('percentiles')
+    if not spec:
+        return DEFAULT_PERCENTILES
+    percentiles = tuple(float(p) for p in spec.split(','))
+    if not all(0 <= p <= 100 for p in percentiles):
+        raise ValueError('Percentiles must be between 0 and 100.')
+    return percentiles
+
+@current_app.route('/api/samples/<int:sample_id>/measurements/histogram', methods=['GET'])
+@sample_revision_conditional
+def get_measurement_histogram(sample_id):
+    """Size distribution of ?field= over ?bins= bins, optionally limited to ?min=&max=."""
+    try:
+        field = statistic_field()
+        bins = int(request.args.get('bins', DEFAULT_HISTOGRAM_BINS))
+        if not 0 < bins <= MAX_HISTOGRAM_BINS: raise ValueError(f'bins must be between 1 and {MAX_HISTOGRAM_BINS}.')
+        value_range = None
+        if 'min' in request.args or 'max' in request.args:
+            value_range = (float(request.args['min']), float(request.args['max']))
+            if not value_range[0] < value_range[1]: raise ValueError('min must be below max.')
+    except KeyError:
+        return jsonify({'error': 'min and max must be given together.'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e) if e.args else 'Invalid histogram parameters.'}), 400
+    # The results blob is not needed for statistics.
+    sample = Sample.query.options(defer(Sample.results)).get_or_404(sample_id)
+    if not sample.has_measurements:
+        return jsonify({'error': 'Measurements must be calculated first.'}), 400
+    return jsonify(sample_histogram(sample, field, bins, value_range))
+
+@current_app.route('/api/samples/<int:sample_id>/measurements/statistics', methods=['GET'])
+@sample_revision_conditional
+def get_measurement_statistics(sample_id):
+    """Count, mean, standard deviation, extremes and ?percentiles= of ?field=."""
+    try:
+        field, percentiles = statistic_field(), requested_percentiles()
+    except ValueError as e:
+        return jsonify({'error': str(e) if e.args else 'Invalid percentiles.'}), 400
+    # The results blob is not needed for statistics.
+    sample = Sample.query.options(defer(Sample.results)).get_or_404(sample_id)
+    if not sample.has_measurements:
+        return jsonify({'error': 'Measurements must be calculated first.'}), 400
+    return jsonify(sample_statistics(sample, field, percentiles))
+
+@current_app.route('/api/projects/<int:project_id>/measurements/summary', methods=['GET'])
+def get_project_measurement_summary(project_id):
+    """The statistics of ?field= for every measured sample of a project, and over all of them."""
+    project = Project.query.get_or_404(project_id)
+    try:
+        field, percentiles = statistic_field(), requested_percentiles()
+    except ValueError as e:
+        return jsonify({'error': str(e) if e.args else 'Invalid percentiles.'}), 400
+    return jsonify(project_summary(project.id, field, percentiles))
+
+
+# --- Grain Queries ---
+def grain_query_response(index, indices):
+    """Ids and stored contours of the grains at 0-based ``indices``; ?geometry=false leaves out the contours."""
+    grains = [{'id': int(i) + 1} for i in indices]
+    if request.args.get('geometry', 'true') != 'false':
+        for grain, i in zip(grains, indices):
+            grain['contour'] = index.contours[i].reshape(-1, 2).tolist()
+    return jsonify({'version': index.version, 'grains': grains})
+
+def load_grain_index(sample_id):
+    try:
+        return get_grain_index(sample_id)
+    except LookupError:
+        abort(404)
+
+@current_app.route('/api/samples/<int:sample_id>/grains/at', methods=['GET'])
+def grains_at_point(sample_id):
+    """Grains under the point ?x=&y=, or within ?tolerance= pixels of it."""
+    try:
+        x, y = float(request.args['x']), float(request.args['y'])
+        tolerance = float(request.args.get('tolerance', 0))
+        if tolerance < 0: raise ValueError()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'x and y are required; tolerance must be non-negative.'}), 400
+    index = load_grain_index(sample_id)
+    if index is None: return jsonify({'error': 'No contours found.'}), 404
+    return grain_query_response(index, index.at_point(x, y, tolerance))
+
+@current_app.route('/api/samples/<int:sample_id>/grains/in-box', methods=['GET'])
+def grains_in_box(sample_id):
+    """Grains intersecting the box ?minx=&miny=&maxx=&maxy=, or inside it with ?mode=contains."""
+    import shapely
+
+    try:
+        bounds = [float(request.args[k]) for k in ('minx', 'miny', 'maxx', 'maxy')]
+        if bounds[0] > bounds[2] or bounds[1] > bounds[3]: raise ValueError()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'minx, miny, maxx and maxy are required, with min <= max.'}), 400
+    mode = request.args.get('mode', 'intersects')
+    if mode not in QUERY_MODES:
+        return jsonify({'error': f"Invalid mode, expected one of {', '.join(QUERY_MODES)}."}), 400
+    index = load_grain_index(sample_id)
+    if index is None: return jsonify({'error': 'No contours found.'}), 404
+    return grain_query_response(index, index.in_region(shapely.box(*bounds), mode))
+
+@current_app.route('/api/samples/<int:sample_id>/grains/in-polygon', methods=['POST'])
+def grains_in_polygon(sample_id):
+    """Grains intersecting the posted {"polygon": [[x, y], ...]}, or inside it with "mode": "contains"."""
+    import shapely
+
+    data = request.get_json(silent=True)
+    try:
+        region = shapely.make_valid(shapely.Polygon(np.asarray(data['polygon'], dtype=np.float64).reshape(-1, 2)))
+    except (KeyError, TypeError, ValueError, shapely.errors.GEOSException):
+        return jsonify({'error': 'Request must contain a polygon of at least 3 [x, y] points.'}), 400
+    mode = data.get('mode', 'intersects')
+    if mode not in QUERY_MODES:
+        return jsonify({'error': f"Invalid mode, expected one of {', '.join(QUERY_MODES)}."}), 400
+    index = load_grain_index(sample_id)
+    if index is None: return jsonify({'error': 'No contours found.'}), 404
+    return grain_query_response(index, index.in_region(region, mode))
+
+
 # --- Manual Editing Routes ---
+@current_app.route('/api/samples/<int:sample_id>/contours', methods=['PATCH'])
+def edit_sample_contours(sample_id):
+    """
+    Applies add/delete/replace/merge/split operations (see contour_edits) to
+    the stored contours and measures only the grains they produce. The
+    request names the contour ``version`` its grain ids refer to; edits of a
+    stale version are rejected with 409.
+    """
+    sample = Sample.query.get_or_404(sample_id)
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get('operations'), list) or 'version' not in data:
+        return jsonify({'error': 'Request must contain a version and a list of operations.'}), 400
+    contours = sample.get_contours()
+    if contours is None:
+        return jsonify({'error': 'No contours found.'}), 404
+    if data['version'] != sample.contours_version:
+        return jsonify({'error': 'Contours were changed by another edit.', 'version': sample.contours_version}), 409
+    try:
+        edit = apply_edits(contours, data['operations'])
+    except ContourEditError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if not isinstance(sample.results, dict): sample.results = {}
+    measured_scale = sample.results.get('measurement_scale_pixels_per_mm')
+    measurements = []
+    # As in retouch, measurements taken at another calibration are dropped rather than mixed.
+    if sample.has_measurements and measured_scale and measured_scale == sample.scale_pixels_per_mm:
+        measurements = apply_measurement_edit(sample, edit, measured_scale)
+    else:
+        clear_measurements(sample)
+    sample.set_contours(edit.contours)
+    # Legacy samples (version 0) have no contours row yet, so concurrent first edits collide on its insert instead.
+    try:
+        db.session.commit()
+    except (StaleDataError, IntegrityError):
+        db.session.rollback()
+        return jsonify({'error': 'Contours were changed by another edit.', 'version': sample.contours_version}), 409
+
+    return jsonify({
+        'version': sample.contours_version,
+        'count': len(edit.contours),
+        'removed': edit.removed,
+        'created': edit.created,
+        'contours': {i + 1: edit.contours[i].reshape(-1, 2).tolist() for i in edit.changed},
+        'measurements': measurements,
+    })
+
 @current_app.route('/api/samples/<int:sample_id>/retouch', methods=['POST'])
 def retouch_sample(sample_id):
     sample = Sample.query.get_or_404(sample_id)
@@ -460,45 +971,109 @@ def retouch_sample(sample_id):
     if not data or 'contours' not in data:
         return jsonify({'error': 'Request must contain contours.'}), 400
     if not isinstance(sample.results, dict): sample.results = {}
-    sample.results['contours'] = data['contours']
-    if 'measurements' in sample.results: del sample.results['measurements']
+    new_contours = PackedContours.from_list(data['contours'])
+    old_contours = sample.get_contours()
+    measurements = sample.get_measurement_records()
+    measured_scale = sample.results.get('measurement_scale_pixels_per_mm')
+    # Only grains whose contour changed are re-measured, as long as the calibration is unchanged.
+    if measurements is not None and old_contours is not None and measured_scale and measured_scale == sample.scale_pixels_per_mm:
+        write_measurements(sample, records_to_columns(remeasure(old_contours, measurements, new_contours, measured_scale)))
+    else:
+        clear_measurements(sample)
+    sample.set_contours(new_contours)
     flag_modified(sample, "results")
     db.session.commit()
     return jsonify(sample.to_dict())
 
 @current_app.route('/api/actions/split-contour', methods=['POST'])
 def split_contour():
+    from shapely.geometry import Polygon
+
     data = request.get_json()
     if not data or 'contour' not in data or 'line' not in data:
         return jsonify({'error': 'Request must contain a contour and a line.'}), 400
     try:
         contour_points = data['contour']
         if contour_points[0] != contour_points[-1]: contour_points.append(contour_points[0])
-        polygon = Polygon(contour_points)
-        line = LineString(data['line'])
-        split_polygons = polygon.difference(line.buffer(0.001))
-        if split_polygons.is_empty: return jsonify({'error': 'Splitting resulted in empty geometry.'}), 400
-        polygons = [split_polygons] if split_polygons.geom_type == 'Polygon' else list(split_polygons.geoms)
+        polygons = split_polygon(Polygon(contour_points), data['line'])
+        if not polygons: return jsonify({'error': 'Splitting resulted in empty geometry.'}), 400
         new_contours_json = [np.array(p.exterior.coords, dtype=np.int32).reshape((-1, 1, 2)).tolist() for p in polygons]
         return jsonify({'new_contours': new_contours_json})
     except Exception as e:
         current_app.logger.error(f"Error splitting contour: {e}")
         return jsonify({'error': 'An internal error occurred.'}), 500
 
+@current_app.route('/api/actions/geometry-batch', methods=['POST'])
+def geometry_batch():
+    """Runs many split/merge/simplify operations (see batch_geometry) in one request."""
+    from .batch_geometry import MAX_BATCH_OPERATIONS, run_batch
+
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get('operations'), list):
+        return jsonify({'error': 'Request must contain a list of operations.'}), 400
+    if len(data['operations']) > MAX_BATCH_OPERATIONS:
+        return jsonify({'error': f'At most {MAX_BATCH_OPERATIONS} operations per request.'}), 400
+    return jsonify({'results': run_batch(data['operations'])})
+
 # --- Export Routes ---
+def export_response(samples, export_format, filename, **options):
+    stream, mimetype = EXPORT_FORMATS[export_format]
+    return current_app.response_class(
+        stream_with_context(stream(samples, **options)), mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}.{export_format}'})
+
 @current_app.route('/api/samples/<int:sample_id>/export/csv', methods=['GET'])
 def export_csv(sample_id):
     sample = Sample.query.get_or_404(sample_id)
-    if not sample.results or 'measurements' not in sample.results:
+    if not sample.has_measurements:
         return jsonify({'error': 'No measurement data to export.'}), 404
-    df = pd.DataFrame(sample.results['measurements'])
-    buffer = io.StringIO()
-    df.to_csv(buffer, index=False)
-    buffer.seek(0)
-    return send_file(io.BytesIO(buffer.getvalue().encode()), mimetype='text/csv', as_attachment=True, download_name=f'sample_{sample.id}_measurements.csv')
+    # Per-sample exports keep their original columns, without the sample ones.
+    return export_response(iter_sample_measurements([sample.id]), 'csv', f'sample_{sample.id}_measurements',
+                           with_sample=False)
+
+@current_app.route('/api/projects/<int:project_id>/export', methods=['GET'])
+def export_project(project_id):
+    """Measurements of every sample of the project, streamed as CSV, Parquet or XLSX (?format=)."""
+    project = Project.query.get_or_404(project_id)
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Invalid format, expected one of {', '.join(EXPORT_FORMATS)}."}), 400
+    samples = iter_sample_measurements(project_sample_ids(project.id))
+    return export_response(samples, export_format, f'project_{project.id}_measurements')
+
+
+# --- Monitoring ---
+@current_app.route('/metrics', methods=['GET'])
+def get_metrics():
+    body, content_type = metrics_response()
+    return current_app.response_class(body, content_type=content_type)
 
 
 # --- File Serving ---
 @current_app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    # Uploads are stored under fresh uuid names and never rewritten.
+    return send_immutable(current_app.config['UPLOAD_FOLDER'], filename)
+
+@current_app.route('/api/samples/<int:sample_id>/tiles', methods=['GET'])
+@sample_revision_conditional
+def get_tile_descriptor(sample_id):
+    sample = Sample.query.get_or_404(sample_id)
+    descriptor = (sample.results or {}).get('tiles')
+    if not descriptor:
+        return jsonify({'error': 'No image pyramid for this sample.'}), 404
+    base_url = f"/api/tiles/{os.path.splitext(sample.image_filename)[0]}"
+    if request.args.get('format') == 'dzi':
+        return current_app.response_class(dzi_xml(descriptor), mimetype='application/xml')
+    return jsonify(dict(descriptor, tiles_url=f"{base_url}/", thumbnail_url=f"{base_url}/thumbnail.{descriptor['format']}"))
+
+# Tile URLs are keyed by the unique upload name, so their content never changes.
+@current_app.route('/api/tiles/<image_stem>/<int:level>/<int:col>_<int:row>.<ext>', methods=['GET'])
+def get_tile(image_stem, level, col, row, ext):
+    directory = os.path.join(current_app.config['UPLOAD_FOLDER'], 'tiles', secure_filename(image_stem), str(level))
+    return send_immutable(directory, f"{col}_{row}.{secure_filename(ext)}")
+
+@current_app.route('/api/tiles/<image_stem>/thumbnail.<ext>', methods=['GET'])
+def get_thumbnail(image_stem, ext):
+    directory = os.path.join(current_app.config['UPLOAD_FOLDER'], 'tiles', secure_filename(image_stem))
+    return send_immutable(directory, f"thumbnail.{secure_filename(ext)}")
@@ -0,0 +1,308 @@
+"""Configurable grain segmentation pipeline.
+
+A pipeline runs four stages, each configured by a dict of parameters:
+
+    denoise     {"method": "gaussian" | "median" | "bilateral" | "none", "size_px": 5}
+    threshold   {"method": "otsu" | "manual" | "adaptive", "value": 128,
+                 "block_size_px": 51, "offset": 0, "foreground": "dark" | "bright"}
+    morphology  {"open_px": 0, "close_px": 0, "min_area_px": 0}
+    watershed   {"enabled": false, "min_distance_px": 7, "compactness": 0}
+
+after which the external contour of every grain is traced. The defaults are
+the original blur, Otsu and external-contour sequence, which the tiled
+segmentation of very large images reproduces exactly.
+
+Neighbourhood stages run on horizontal strips in a thread pool. OpenCV
+releases the GIL, and every strip is read with a halo as wide as the kernel,
+so the result equals a single whole-image call.
+
+``preview`` runs the pipeline on a downsampled copy, with every length
+scaled along with the image, so parameters can be tuned interactively before
+a full-resolution run.
+"""
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .contours import PackedContours
+from .metrics import stage
+
+DEFAULT_PARAMS = {
+    'denoise': {'method': 'gaussian', 'size_px': 5},
+    'threshold': {'method': 'otsu', 'value': 128, 'block_size_px': 51, 'offset': 0, 'foreground': 'dark'},
+    'morphology': {'open_px': 0, 'close_px': 0, 'min_area_px': 0},
+    'watershed': {'enabled': False, 'min_distance_px': 7, 'compactness': 0.0},
+}
+DENOISE_METHODS = ('gaussian', 'median', 'bilateral', 'none')
+THRESHOLD_METHODS = ('otsu', 'manual', 'adaptive')
+MAX_KERNEL_PX = 101
+PREVIEW_MAX_PX = 1024
+# Strips shorter than this are not worth a thread.
+MIN_STRIP_ROWS = 256
+
+
+class SegmentationParamsError(ValueError):
+    pass
+
+
+def read_grayscale(filepath):
+    import cv2
+
+    # Note: cv2.imread may not support all TIFF formats (e.g., compressed or floating-point).
+    # Large TIFFs are decoded with tifffile by the image cache instead, see image_cache._stream_tiff.
+    return cv2.imread(filepath, cv2.IMREAD_GRAYSCALE)
+
+
+def _number(stage_params, key, kind, low, high):
+    value = stage_params[key]
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or (kind is int and value != int(value)):
+        raise SegmentationParamsError(f'{key} must be {"an integer" if kind is int else "a number"}.')
+    if not low <= value <= high:
+        raise SegmentationParamsError(f'{key} must be between {low:g} and {high:g}.')
+    return kind(value)
+
+
+def _choice(stage_params, key, choices):
+    if stage_params[key] not in choices:
+        raise SegmentationParamsError(f"{key} must be one of {', '.join(choices)}.")
+    return stage_params[key]
+
+
+def parse_params(data):
+    """
+    Complete, validated pipeline parameters from a partial dict such as
+    {"watershed": {"enabled": true}}; missing values take their defaults.
+    Raises SegmentationParamsError on unknown or invalid values.
+    """
+    data = data or {}
+    if not isinstance(data, dict):
+        raise SegmentationParamsError('Parameters must be an object.')
+    unknown = set(data) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise SegmentationParamsError(f"Unknown stages: {', '.join(sorted(unknown))}.")
+    params = copy.deepcopy(DEFAULT_PARAMS)
+    for name, given in data.items():
+        if not isinstance(given, dict):
+            raise SegmentationParamsError(f'{name} parameters must be an object.')
+        unknown = set(given) - set(params[name])
+        if unknown:
+            raise SegmentationParamsError(f"Unknown {name} parameters: {', '.join(sorted(unknown))}.")
+        params[name].update(given)
+
+    denoise, threshold = params['denoise'], params['threshold']
+    morphology, watershed = params['morphology'], params['watershed']
+    denoise['method'] = _choice(denoise, 'method', DENOISE_METHODS)
+    denoise['size_px'] = _number(denoise, 'size_px', int, 1, MAX_KERNEL_PX)
+    threshold['method'] = _choice(threshold, 'method', THRESHOLD_METHODS)
+    threshold['value'] = _number(threshold, 'value', int, 0, 255)
+    threshold['block_size_px'] = _number(threshold, 'block_size_px', int, 3, 1001)
+    threshold['offset'] = _number(threshold, 'offset', float, -255, 255)
+    threshold['foreground'] = _choice(threshold, 'foreground', ('dark', 'bright'))
+    morphology['open_px'] = _number(morphology, 'open_px', int, 0, MAX_KERNEL_PX)
+    morphology['close_px'] = _number(morphology, 'close_px', int, 0, MAX_KERNEL_PX)
+    morphology['min_area_px'] = _number(morphology, 'min_area_px', int, 0, 1 << 30)
+    if not isinstance(watershed['enabled'], bool):
+        raise SegmentationParamsError('enabled must be true or false.')
+    watershed['min_distance_px'] = _number(watershed, 'min_distance_px', int, 1, 1000)
+    watershed['compactness'] = _number(watershed, 'compactness', float, 0, 1e6)
+    # OpenCV kernels need odd sizes.
+    if denoise['method'] in ('gaussian', 'median'):
+        denoise['size_px'] |= 1
+    threshold['block_size_px'] |= 1
+    return params
+
+
+def scale_params(params, scale):
+    """Parameters for the image resized by ``scale``: lengths scale linearly, areas quadratically."""
+    scaled = copy.deepcopy(params)
+
+    def length(value, minimum=0):
+        return max(minimum, int(round(value * scale)))
+
+    scaled['denoise']['size_px'] = length(params['denoise']['size_px'], 1)
+    if params['denoise']['method'] in ('gaussian', 'median'):
+        scaled['denoise']['size_px'] |= 1
+    scaled['threshold']['block_size_px'] = length(params['threshold']['block_size_px'], 3) | 1
+    scaled['morphology']['open_px'] = length(params['morphology']['open_px'])
+    scaled['morphology']['close_px'] = length(params['morphology']['close_px'])
+    scaled['morphology']['min_area_px'] = int(round(params['morphology']['min_area_px'] * scale * scale))
+    scaled['watershed']['min_distance_px'] = length(params['watershed']['min_distance_px'], 1)
+    return scaled
+
+
+def _by_strips(func, img, halo_px, max_workers):
+    """
+    ``func(img)`` for a neighbourhood operation of radius at most ``halo_px``
+    that keeps shape and dtype, computed on horizontal strips in threads.
+    """
+    height = img.shape[0]
+    rows = max(MIN_STRIP_ROWS, -(-height // max_workers))
+    if rows >= height:
+        return func(img)
+    out = np.empty_like(img)
+
+    def run(y0):
+        y1 = min(y0 + rows, height)
+        # At the image edges the window edge is the image edge, so the border handling matches too.
+        w0, w1 = max(y0 - halo_px, 0), min(y1 + halo_px, height)
+        out[y0:y1] = func(img[w0:w1])[y0 - w0:y1 - w0]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(run, range(0, height, rows)))
+    return out
+
+
+def _denoise(img, params, max_workers):
+    import cv2
+
+    method, size = params['method'], params['size_px']
+    if method == 'none' or size <= 1:
+        return img
+    if method == 'gaussian':
+        func = lambda strip: cv2.GaussianBlur(strip, (size, size), 0)
+    elif method == 'median':
+        func = lambda strip: cv2.medianBlur(strip, size)
+    else:
+        func = lambda strip: cv2.bilateralFilter(strip, size, 50, size / 2)
+    return _by_strips(func, img, size // 2, max_workers)
+
+
+def _threshold(img, params, max_workers):
+    """Foreground mask (255) and the threshold used, None for adaptive thresholds."""
+    import cv2
+
+    flag = cv2.THRESH_BINARY_INV if params['foreground'] == 'dark' else cv2.THRESH_BINARY
+    if params['method'] == 'adaptive':
+        block_size, offset = params['block_size_px'], params['offset']
+        # The offset is towards the background, whichever side that is.
+        c = offset if params['foreground'] == 'bright' else -offset
+        mask = _by_strips(lambda strip: cv2.adaptiveThreshold(
+            strip, 255, cv2.ADAPTIVE_THRESH_MEAN_C, flag, block_size, c), img, block_size // 2, max_workers)
+        return mask, None
+    if params['method'] == 'otsu':
+        value, mask = cv2.threshold(img, 0, 255, flag + cv2.THRESH_OTSU)
+        return mask, int(value)
+    value, mask = cv2.threshold(img, params['value'], 255, flag)
+    return mask, int(value)
+
+
+def _morphology(mask, params, max_workers):
+    import cv2
+
+    for op, key in ((cv2.MORPH_OPEN, 'open_px'), (cv2.MORPH_CLOSE, 'close_px')):
+        size = params[key]
+        if size > 1:
+            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+            # Opening and closing apply two kernels in sequence, so the halo covers both.
+            mask = _by_strips(lambda strip: cv2.morphologyEx(strip, op, kernel), mask, size, max_workers)
+    if params['min_area_px'] > 0:
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8, ltype=cv2.CV_32S)
+        small = stats[:, cv2.CC_STAT_AREA] < params['min_area_px']
+        small[0] = False
+        if small.any():
+            mask = np.where(small[labels], np.uint8(0), mask)
+    return mask
+
+
+def _trace_labels(labels, max_workers):
+    """External contours of every labelled region, in label order."""
+    import cv2
+    from scipy.ndimage import find_objects
+
+    boxes = find_objects(labels)
+
+    def trace(chunk):
+        traced = []
+        for label in chunk:
+            box = boxes[label - 1]
+            if box is None:
+                continue
+            region = (labels[box] == label).astype(np.uint8)
+            contours, _ = cv2.findContours(region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                           offset=(box[1].start, box[0].start))
+            traced.extend(contours)
+        return traced
+
+    # One chunk of labels per thread, as a task per label would cost more than tracing it.
+    chunks = np.array_split(np.arange(1, len(boxes) + 1), max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return [contour for traced in pool.map(trace, chunks) for contour in traced]
+
+
+def _separate(mask, params, max_workers):
+    """Splits touching grains along the watershed of their distance transform. Returns contours."""
+    import cv2
+    from skimage.segmentation import watershed
+
+    distance = cv2.distanceTransform(mask, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    radius = params['min_distance_px']
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+    neighbourhood_max = _by_strips(lambda strip: cv2.dilate(strip, kernel), distance, radius, max_workers)
+    # Seeds are the distance maxima of their neighbourhood; the maxima of one plateau seed a single grain.
+    seeds = ((distance == neighbourhood_max) & (distance > 0)).astype(np.uint8)
+    seed_count, markers = cv2.connectedComponents(seeds, connectivity=8, ltype=cv2.CV_32S)
+    component_count, components = cv2.connectedComponents(mask, connectivity=8, ltype=cv2.CV_32S)
+    seeded = seeds > 0
+    seed_component = np.zeros(seed_count, dtype=np.int64)
+    seed_component[markers[seeded]] = components[seeded]
+    # Only components with several seeds are flooded; the others are single grains already.
+    touching = np.bincount(seed_component[1:], minlength=component_count) > 1
+    touching[0] = False
+    touching = touching[components]
+
+    single = np.where(touching, np.uint8(0), mask)
+    contours, _ = cv2.findContours(single, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not touching.any():
+        return list(contours)
+    labels = watershed(-distance, np.where(touching, markers, 0), mask=touching, compactness=params['compactness'])
+    return list(contours) + _trace_labels(labels, max_workers)
+
+
+def run_pipeline(img, params=None, max_workers=None):
+    """Segments a grayscale image. Returns (contours, threshold), the threshold being None for adaptive ones."""
+    import cv2
+
+    params = params or DEFAULT_PARAMS
+    max_workers = max_workers or os.cpu_count() or 1
+    with stage('denoise'):
+        denoised = _denoise(img, params['denoise'], max_workers)
+    with stage('threshold'):
+        mask, threshold = _threshold(denoised, params['threshold'], max_workers)
+    with stage('morphology'):
+        mask = _morphology(mask, params['morphology'], max_workers)
+    if params['watershed']['enabled']:
+        with stage('watershed'):
+            contours = _separate(mask, params['watershed'], max_workers)
+    else:
+        with stage('find_contours'):
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return list(contours), threshold
+
+
+def segment_grains(img, params=None):
+    """Runs the segmentation pipeline, by default blur / Otsu / external contours, on a grayscale image."""
+    return run_pipeline(img, params)[0]
+
+
+def preview(filepath, params, max_px=PREVIEW_MAX_PX):
+    """
+    Segments a copy of the image reduced to at most ``max_px`` on its longer
+    side. Returns (PackedContours in full-resolution coordinates, threshold,
+    scale), or None if the image cannot be read.
+    """
+    from .image_cache import load_grayscale
+    from .multiphase import reduced_image
+
+    full = load_grayscale(filepath)
+    img = reduced_image(filepath, max_px)
+    if full is None or img is None:
+        return None
+    scale = img.shape[1] / full.shape[1]
+    contours, threshold = run_pipeline(img, scale_params(params, scale) if scale < 1.0 else params)
+    packed = PackedContours.from_list(contours)
+    if scale < 1.0:
+        # Pixel centres map back to the centres of the pixels they were averaged from.
+        packed.points = np.round((packed.points + 0.5) / scale - 0.5).astype(np.int32)
+    return packed, threshold, scale
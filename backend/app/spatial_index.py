@@ -0,0 +1,121 @@
+"""Per-sample spatial index over grain contours for hit-testing and region queries.
+
+Each process keeps the STRtree of its most recently queried samples. An
+index is tagged with the contour version it was built from and rebuilt on
+the first query after the contours change, which is detected without
+loading the contour buffers.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .models import db, Sample, SampleContours
+
+DEFAULT_MAX_SAMPLES = 32
+QUERY_MODES = ('intersects', 'contains')
+
+
+class GrainIndex:
+    """STRtree over the grains of one contour version. Query results are 0-based contour indices."""
+
+    def __init__(self, contours, version):
+        import shapely
+
+        self.contours = contours
+        self.version = version
+        self.geometries = _grain_geometries(contours)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def at_point(self, x, y, tolerance=0.0):
+        """Grains containing (x, y) or, with a tolerance, lying within that distance of it."""
+        import shapely
+
+        point = shapely.points(x, y)
+        if tolerance > 0:
+            return np.sort(self.tree.query(point, predicate='dwithin', distance=tolerance))
+        return np.sort(self.tree.query(point, predicate='intersects'))
+
+    def in_region(self, region, mode='intersects'):
+        """Grains intersecting ``region`` or, with mode 'contains', lying entirely inside it."""
+        return np.sort(self.tree.query(region, predicate=mode))
+
+
+def _grain_geometries(contours):
+    """Polygons for every contour, built in one vectorized call; degenerate contours become multipoints."""
+    import shapely
+
+    lengths = contours.lengths
+    count = len(lengths)
+    geometries = np.empty(count, dtype=object)
+    ring_ids = np.repeat(np.arange(count), lengths)
+    rings = lengths >= 3
+    if rings.any():
+        selected = rings[ring_ids]
+        ring_index = np.cumsum(rings) - 1
+        polygons = shapely.polygons(shapely.linearrings(
+            contours.points[selected].astype(np.float64), indices=ring_index[ring_ids[selected]]))
+        # findContours output can touch itself; invalid polygons would make predicates unreliable.
+        invalid = ~shapely.is_valid(polygons)
+        if invalid.any():
+            polygons[invalid] = shapely.make_valid(polygons[invalid])
+        geometries[rings] = polygons
+    if not rings.all():
+        selected = ~rings[ring_ids]
+        point_index = np.cumsum(~rings) - 1
+        geometries[~rings] = shapely.multipoints(
+            contours.points[selected].astype(np.float64), indices=point_index[ring_ids[selected]])
+    return geometries
+
+
+class GrainIndexCache:
+    """Per-process LRU of grain indexes, keyed by sample and checked against the stored contour version."""
+
+    def __init__(self, max_samples=DEFAULT_MAX_SAMPLES):
+        self.max_samples = max_samples
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sample_id):
+        """The sample's index, or None if it has no contours. Raises LookupError for unknown samples."""
+        # The upload name guards against a deleted sample's id being reused.
+        row = db.session.execute(
+            db.select(Sample.image_filename, SampleContours.version, SampleContours.count)
+            .outerjoin(SampleContours, SampleContours.sample_id == Sample.id)
+            .where(Sample.id == sample_id)
+        ).one_or_none()
+        if row is None:
+            raise LookupError(sample_id)
+        key = tuple(row)
+        with self._lock:
+            cached = self._indexes.get(sample_id)
+            if cached is not None and cached[0] == key:
+                self._indexes.move_to_end(sample_id)
+                return cached[1]
+
+        sample = db.session.get(Sample, sample_id)
+        contours = sample.get_contours()
+        if contours is None:
+            return None
+        index = GrainIndex(contours, sample.contours_version)
+        with self._lock:
+            self._indexes[sample_id] = (key, index)
+            self._indexes.move_to_end(sample_id)
+            while len(self._indexes) > self.max_samples:
+                self._indexes.popitem(last=False)
+        return index
+
+    def discard(self, sample_id):
+        with self._lock:
+            self._indexes.pop(sample_id, None)
+
+
+_cache = GrainIndexCache()
+
+
+def get_grain_index(sample_id):
+    return _cache.get(sample_id)
+
+
+def discard_grain_index(sample_id):
+    _cache.discard(sample_id)
@@ -0,0 +1,278 @@
+"""Out-of-core segmentation of very large (stitched) micrographs.
+
+Produces the same contours as ``segment_grains`` while only ever holding a
+few tiles in memory. The image is a memory-mapped array, read tile by tile:
+
+1. Every tile is blurred with a halo of ``BLUR_HALO_PX`` pixels, so the blur
+   matches the full-image blur exactly. The tile histograms are summed and one
+   global Otsu threshold is computed from the total.
+2. Each tile is thresholded and its external contours traced, in parallel.
+   Contours of grains that stay inside their tile are final.
+3. Grains that touch an inner tile edge are matched with their neighbours'
+   labels along the shared edge. Grains spanning several tiles are traced
+   again on a window covering just their bounding box.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TILE_CORE_PX = 2048
+# Radius of the 5x5 Gaussian kernel of segment_grains.
+BLUR_HALO_PX = 2
+# Images with at least this many pixels are segmented tile by tile.
+TILED_SEGMENTATION_MIN_PIXELS = 1 << 26
+# Stitched grains are traced on a window of their bounding box, which is capped to bound memory.
+MAX_STITCHED_GRAIN_PIXELS = 1 << 26
+
+_FLT_EPSILON = np.finfo(np.float32).eps
+
+
+def otsu_threshold(histogram):
+    """Otsu threshold of a 256-bin histogram, computed exactly as cv2.threshold does for 8-bit images."""
+    total = float(sum(histogram))
+    scale = 1.0 / total
+    mu = sum(i * float(h) for i, h in enumerate(histogram)) * scale
+    q1 = mu1 = max_sigma = 0.0
+    max_val = 0
+    for i, h in enumerate(histogram):
+        p_i = float(h) * scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1.0 - q1
+        if min(q1, q2) < _FLT_EPSILON or max(q1, q2) > 1.0 - _FLT_EPSILON:
+            continue
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) ** 2
+        if sigma > max_sigma:
+            max_sigma = sigma
+            max_val = i
+    return max_val
+
+
+def _tiles(height, width, tile_px):
+    return [(y0, min(y0 + tile_px, height), x0, min(x0 + tile_px, width))
+            for y0 in range(0, height, tile_px) for x0 in range(0, width, tile_px)]
+
+
+def _blurred(img, y0, y1, x0, x1):
+    """The region [y0:y1, x0:x1] of the blurred image, without blurring anything but a small halo."""
+    height, width = img.shape
+    wy0, wy1 = max(y0 - BLUR_HALO_PX, 0), min(y1 + BLUR_HALO_PX, height)
+    wx0, wx1 = max(x0 - BLUR_HALO_PX, 0), min(x1 + BLUR_HALO_PX, width)
+    # At the image edges the window edge is the image edge, so the border handling matches too.
+    window = cv2.GaussianBlur(np.ascontiguousarray(img[wy0:wy1, wx0:wx1]), (5, 5), 0)
+    return window[y0 - wy0:y1 - wy0, x0 - wx0:x1 - wx0]
+
+
+def _histograms(img, region):
+    y0, y1, x0, x1 = region
+    raw = cv2.calcHist([np.ascontiguousarray(img[y0:y1, x0:x1])], [0], None, [256], [0, 256])
+    blurred = cv2.calcHist([_blurred(img, *region)], [0], None, [256], [0, 256])
+    return raw.ravel().astype(np.int64), blurred.ravel().astype(np.int64)
+
+
+# Reference kinds for the background pixel left of a grain's first pixel.
+_IN_TILE, _FRAME, _LEFT_TILE = 0, 1, 2
+
+
+def _edges(labels):
+    return {'top': labels[0].copy(), 'bottom': labels[-1].copy(), 'left': labels[:, 0].copy(), 'right': labels[:, -1].copy()}
+
+
+def _segment_tile(img, region, threshold):
+    """
+    Traces one tile. Grains are 8-connected and background regions 4-connected,
+    as in cv2.findContours. Besides the grains that stay inside the tile, returns
+    the first/last row and column of grain and background labels, the grains
+    touching an inner tile edge, and the background labels touching the image edge.
+
+    Whether a grain is nested in another grain's hole depends on the background
+    region left of its first pixel in raster order, which may extend beyond
+    the tile. Every external contour therefore carries a reference to that
+    pixel's background label, which is resolved once all tiles are known.
+    """
+    y0, y1, x0, x1 = region
+    height, width = img.shape
+    _, mask = cv2.threshold(_blurred(img, *region), threshold, 255, cv2.THRESH_BINARY_INV)
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8, ltype=cv2.CV_32S)
+    _, background = cv2.connectedComponents(cv2.bitwise_not(mask), connectivity=4, ltype=cv2.CV_32S)
+    edges = _edges(labels)
+    background_edges = _edges(background)
+    pixel = {
+        'top': lambda i: (x0 + i, y0), 'bottom': lambda i: (x0 + i, y1 - 1),
+        'left': lambda i: (x0, y0 + i), 'right': lambda i: (x1 - 1, y0 + i),
+    }
+    inner = {'top': y0 > 0, 'bottom': y1 < height, 'left': x0 > 0, 'right': x1 < width}
+
+    image_edge = [background_edges[name] for name, is_inner in inner.items() if not is_inner]
+    outer_background = np.unique(np.concatenate(image_edge)) if image_edge else np.zeros(0, dtype=np.int32)
+
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+    first = np.array([contour[0, 0] for contour in contours], dtype=np.int64).reshape(-1, 2)
+    kind = np.where(first[:, 0] > x0, _IN_TILE, np.where(x0 == 0, _FRAME, _LEFT_TILE))
+    # Background label left of the first pixel inside the tile, or the row to look up in the left tile.
+    ref = np.where(kind == _IN_TILE, background[first[:, 1] - y0, np.maximum(first[:, 0] - 1 - x0, 0)], first[:, 1] - y0)
+    grain_labels = labels[first[:, 1] - y0, first[:, 0] - x0]
+
+    border = {}
+    for name, is_inner in inner.items():
+        if not is_inner:
+            continue
+        found, index = np.unique(edges[name], return_index=True)
+        for label, i in zip(found.tolist(), index.tolist()):
+            if label and label not in border:
+                left, top, w, h = stats[label, :4].tolist()
+                border[label] = {'bbox': (x0 + left, y0 + top, x0 + left + w, y0 + top + h), 'seed': pixel[name](i)}
+
+    final = []
+    for i, contour in enumerate(contours):
+        grain = border.get(int(grain_labels[i]))
+        if grain is None:
+            final.append((contour, int(kind[i]), int(ref[i])))
+        else:
+            grain.update(contour=contour, first=(int(first[i, 1]), int(first[i, 0])), ref=(int(kind[i]), int(ref[i])))
+    return {
+        'final': final,
+        'edges': edges,
+        'background_edges': background_edges,
+        'outer_background': outer_background[outer_background > 0],
+        'border': border,
+    }
+
+
+def _edge_pairs(a, b, shifts=(-1, 0, 1)):
+    """Label pairs of two facing edges that are connected across the seam."""
+    pairs = []
+    for shift in shifts:
+        if shift >= 0:
+            left, right = a[:len(a) - shift], b[shift:]
+        else:
+            left, right = a[-shift:], b[:len(b) + shift]
+        n = min(len(left), len(right))
+        left, right = left[:n], right[:n]
+        both = (left > 0) & (right > 0)
+        pairs.append(np.column_stack([left[both], right[both]]))
+    return np.concatenate(pairs)
+
+
+def _tagged(index, labels):
+    """Makes tile labels global by tagging them with the tile's index; 0 stays 0."""
+    labels = np.asarray(labels, dtype=np.int64)
+    return np.where(labels > 0, (np.int64(index) << 32) | labels, 0)
+
+
+def _seam_pairs(tiles, rows, cols, key, diagonal):
+    """Global label pairs connected across all tile seams, with 8-connectivity if ``diagonal``."""
+    shifts = (-1, 0, 1) if diagonal else (0,)
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    for r in range(rows):
+        for c in range(cols):
+            index = r * cols + c
+            edges = tiles[index][key]
+            if c + 1 < cols:
+                pairs.append(_edge_pairs(_tagged(index, edges['right']), _tagged(index + 1, tiles[index + 1][key]['left']), shifts))
+            if r + 1 < rows:
+                below = index + cols
+                pairs.append(_edge_pairs(_tagged(index, edges['bottom']), _tagged(below, tiles[below][key]['top']), shifts))
+                # Diagonal neighbours only touch at the tile corners.
+                if diagonal and c + 1 < cols:
+                    pairs.append(_edge_pairs(_tagged(index, edges['bottom'][-1:]), _tagged(below + 1, tiles[below + 1][key]['top'][:1]), (0,)))
+                if diagonal and c > 0:
+                    pairs.append(_edge_pairs(_tagged(index, edges['bottom'][:1]), _tagged(below - 1, tiles[below - 1][key]['top'][-1:]), (0,)))
+    return np.concatenate(pairs)
+
+
+def _groups(keys, pairs):
+    """Connected-component id of every sorted key, given connected key pairs."""
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    a, b = np.searchsorted(keys, pairs[:, 0]), np.searchsorted(keys, pairs[:, 1])
+    graph = coo_matrix((np.ones(len(a), dtype=np.int8), (a, b)), shape=(len(keys), len(keys)))
+    return connected_components(graph, directed=False)[1]
+
+
+def _trace_window(img, threshold, bbox, seed):
+    """Traces the single grain containing ``seed`` within its bounding box."""
+    gx0, gy0, gx1, gy1 = bbox
+    _, mask = cv2.threshold(_blurred(img, gy0, gy1, gx0, gx1), threshold, 255, cv2.THRESH_BINARY_INV)
+    cv2.floodFill(mask, None, (seed[0] - gx0, seed[1] - gy0), 128, flags=8)
+    grain = np.where(mask == 128, np.uint8(255), np.uint8(0))
+    contours, _ = cv2.findContours(grain, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(gx0, gy0))
+    return contours
+
+
+def segment_grains_tiled(img, tile_px=TILE_CORE_PX, max_workers=None):
+    """
+    Segments a (memory-mapped) grayscale image tile by tile. Returns
+    (contours, histogram) with the contours ``segment_grains`` would find on the
+    whole image and the 256-bin histogram of the unblurred image.
+    """
+    height, width = img.shape
+    regions = _tiles(height, width, tile_px)
+    rows = -(-height // tile_px)
+    cols = -(-width // tile_px)
+    max_workers = max_workers or os.cpu_count() or 1
+
+    # cv2 releases the GIL, so tiles are processed in threads over the shared memory map.
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        histogram = np.zeros(256, dtype=np.int64)
+        blurred_histogram = np.zeros(256, dtype=np.int64)
+        for raw, blurred in pool.map(lambda region: _histograms(img, region), regions):
+            histogram += raw
+            blurred_histogram += blurred
+        threshold = otsu_threshold(blurred_histogram.tolist())
+        tiles = list(pool.map(lambda region: _segment_tile(img, region, threshold), regions))
+
+    # Background regions reaching the image edge surround top-level grains; all others are holes.
+    background_keys = np.unique(np.concatenate(
+        [_tagged(index, edge) for index, tile in enumerate(tiles) for edge in tile['background_edges'].values()]))
+    background_keys = background_keys[background_keys > 0]
+    background_group = _groups(background_keys, _seam_pairs(tiles, rows, cols, 'background_edges', diagonal=False))
+    outer_keys = np.concatenate([_tagged(index, tile['outer_background']) for index, tile in enumerate(tiles)])
+    outer_groups = set(background_group[np.searchsorted(background_keys, outer_keys)].tolist())
+
+    def is_top_level(index, kind, ref):
+        if kind == _FRAME:
+            return True
+        if kind == _LEFT_TILE:
+            index, ref = index - 1, tiles[index - 1]['background_edges']['right'][ref]
+        key = (np.int64(index) << 32) | ref
+        at = np.searchsorted(background_keys, key)
+        # Regions not touching any tile edge are enclosed within their tile.
+        return at < len(background_keys) and background_keys[at] == key and background_group[at] in outer_groups
+
+    contours = [contour for index, tile in enumerate(tiles)
+                for contour, kind, ref in tile['final'] if is_top_level(index, kind, ref)]
+
+    border = {(np.int64(index) << 32) | label: (index, grain)
+              for index, tile in enumerate(tiles) for label, grain in tile['border'].items()}
+    if not border:
+        return contours, histogram.tolist()
+    keys = np.fromiter(border.keys(), dtype=np.int64, count=len(border))
+    keys.sort()
+    group = _groups(keys, _seam_pairs(tiles, rows, cols, 'edges', diagonal=True))
+
+    order = np.argsort(group, kind='stable')
+    for members in np.split(order, np.flatnonzero(np.diff(group[order])) + 1):
+        grains = [border[keys[m]] for m in members]
+        # The grain's first pixel in raster order decides whether it is nested.
+        index, first = min(grains, key=lambda item: item[1]['first'])
+        if not is_top_level(index, *first['ref']):
+            continue
+        if len(grains) == 1:
+            contours.append(first['contour'])
+            continue
+        boxes = np.array([grain['bbox'] for _, grain in grains])
+        bbox = (boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max())
+        if (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) > MAX_STITCHED_GRAIN_PIXELS:
+            logger.warning(f'Skipping a grain spanning {len(grains)} tiles with bounding box {bbox}.')
+            continue
+        contours.extend(_trace_window(img, threshold, bbox, first['seed']))
+    return contours, histogram.tolist()
@@ -0,0 +1,125 @@
+"""DeepZoom-style image pyramids for the canvas viewer.
+
+Each sample image gets a directory ``<UPLOAD_FOLDER>/tiles/<image stem>/``
+holding ``<level>/<col>_<row>.jpg`` tiles and a thumbnail. Level ``max_level``
+is full resolution and every lower level halves the previous one (rounding
+up), down to a single pixel, as in the DeepZoom format.
+"""
+import math
+import os
+import shutil
+
+import numpy as np
+
+TILE_SIZE = 256
+TILE_OVERLAP = 1
+TILE_FORMAT = 'jpg'
+THUMBNAIL_SIZE = 256
+JPEG_QUALITY = 85
+# Levels larger than this are downsampled into scratch memory maps, band by band, instead of into RAM.
+PYRAMID_SCRATCH_MIN_PIXELS = 16 * 1024 * 1024
+# Source rows per band when downsampling; even, so bands halve exactly.
+PYRAMID_BAND_ROWS = 512
+
+
+def pyramid_dir(upload_folder, image_filename):
+    return os.path.join(upload_folder, 'tiles', os.path.splitext(image_filename)[0])
+
+
+def max_level(width, height):
+    return math.ceil(math.log2(max(width, height, 1)))
+
+
+def _write_tiles(level_img, level_dir):
+    import cv2
+
+    os.makedirs(level_dir, exist_ok=True)
+    height, width = level_img.shape[:2]
+    params = [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]
+    for row in range(math.ceil(height / TILE_SIZE)):
+        y0 = max(row * TILE_SIZE - TILE_OVERLAP, 0)
+        y1 = min((row + 1) * TILE_SIZE + TILE_OVERLAP, height)
+        for col in range(math.ceil(width / TILE_SIZE)):
+            x0 = max(col * TILE_SIZE - TILE_OVERLAP, 0)
+            x1 = min((col + 1) * TILE_SIZE + TILE_OVERLAP, width)
+            cv2.imwrite(os.path.join(level_dir, f'{col}_{row}.{TILE_FORMAT}'), level_img[y0:y1, x0:x1], params)
+
+
+def _halve(band):
+    """2x2 box average of ``band``; an odd last row or column is averaged with itself."""
+    import cv2
+
+    height, width = band.shape[:2]
+    if height % 2 or width % 2:
+        band = cv2.copyMakeBorder(band, 0, height % 2, 0, width % 2, cv2.BORDER_REPLICATE)
+    return cv2.resize(band, (band.shape[1] // 2, band.shape[0] // 2), interpolation=cv2.INTER_AREA)
+
+
+def _next_level(level_img, scratch_path):
+    """
+    The level below ``level_img``, halved in bands of source rows so that only
+    one band is in memory at a time. Large levels go to a memory map at
+    ``scratch_path``, as the full-resolution image of a large sample does.
+    """
+    height, width = level_img.shape[:2]
+    shape = ((height + 1) // 2, (width + 1) // 2) + level_img.shape[2:]
+    if shape[0] * shape[1] > PYRAMID_SCRATCH_MIN_PIXELS:
+        next_img = np.memmap(scratch_path, dtype=level_img.dtype, mode='w+', shape=shape)
+    else:
+        next_img = np.empty(shape, dtype=level_img.dtype)
+    for y in range(0, height, PYRAMID_BAND_ROWS):
+        next_img[y // 2:(y + PYRAMID_BAND_ROWS + 1) // 2] = _halve(level_img[y:y + PYRAMID_BAND_ROWS])
+    return next_img
+
+
+def build_pyramid(img, out_dir):
+    """Writes every pyramid level and a thumbnail of ``img`` and returns the pyramid descriptor."""
+    import cv2
+
+    height, width = img.shape[:2]
+    top = max_level(width, height)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+
+    thumb_scale = min(1.0, THUMBNAIL_SIZE / max(width, height))
+    thumbnail = cv2.resize(img, (max(1, round(width * thumb_scale)), max(1, round(height * thumb_scale))),
+                           interpolation=cv2.INTER_AREA)
+    os.makedirs(out_dir)
+    cv2.imwrite(os.path.join(out_dir, f'thumbnail.{TILE_FORMAT}'), thumbnail, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+
+    level_img = img
+    scratch_paths = [os.path.join(out_dir, f'.level-{i % 2}.raw') for i in range(2)]
+    try:
+        for level in range(top, -1, -1):
+            _write_tiles(level_img, os.path.join(out_dir, str(level)))
+            if level:
+                # Two scratch files alternate: one is read while the next level is written to the other.
+                level_img = _next_level(level_img, scratch_paths[level % 2])
+    finally:
+        del level_img
+        for path in scratch_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    return {
+        'width': width,
+        'height': height,
+        'tile_size': TILE_SIZE,
+        'overlap': TILE_OVERLAP,
+        'format': TILE_FORMAT,
+        'max_level': top,
+    }
+
+
+def remove_pyramid(upload_folder, image_filename):
+    shutil.rmtree(pyramid_dir(upload_folder, image_filename), ignore_errors=True)
+
+
+def dzi_xml(descriptor):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+        f'Format="{descriptor["format"]}" Overlap="{descriptor["overlap"]}" TileSize="{descriptor["tile_size"]}">'
+        f'<Size Width="{descriptor["width"]}" Height="{descriptor["height"]}"/>'
+        '</Image>'
+    )
@@ -0,0 +1,4 @@
+"""End-to-end benchmarks of the analysis API on synthetic micrographs.
+
+Run from ``backend/`` with ``python -m benchmarks``; see ``--help``.
+"""
@@ -0,0 +1,247 @@
+"""Benchmarks the analysis workflow end to end through the Flask test client.
+
+For every image size, fresh synthetic micrographs go through upload (with
+segmentation), calibration, measurement, the ASTM E112 planimetric and
+automatic intercept methods, multiphase analysis, a retouch and a project
+export, against a temporary SQLite database and upload folder. The report
+gives latency percentiles per step, pipeline throughput and peak RSS.
+
+Timings depend on the machine, so baselines are only comparable on the one
+that recorded them: record with ``--save-baseline``, then later runs flag
+steps whose median latency grew by more than ``--tolerance`` and exit with
+status 1.
+
+    python -m benchmarks --sizes 1024,2048 --repeat 5
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+DEFAULT_SIZES = '512,1024,2048,4096'
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baselines.json')
+# Grains per megapixel; 400 is a typical count at 100x.
+DEFAULT_GRAIN_DENSITY = 400
+PERCENTILES = (50, 90, 99)
+PIXELS_PER_MM = 1000.0
+MAGNIFICATION = 100
+JOB_POLL_INTERVAL_S = 0.02
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def _json(response):
+    if response.status_code >= 400:
+        raise BenchmarkError(f'{response.request.method} {response.request.path} returned '
+                             f'{response.status_code}: {response.get_data(as_text=True)[:200]}')
+    return response.get_json()
+
+
+class Workflow:
+    """The analysis steps of one sample, each timed through the test client."""
+
+    def __init__(self, client, project_id):
+        self.client = client
+        self.project_id = project_id
+        self.timings = {}
+
+    def timed(self, step, call):
+        start = time.perf_counter()
+        result = call()
+        self.timings.setdefault(step, []).append(time.perf_counter() - start)
+        return result
+
+    def upload(self, path):
+        """Uploads an image and waits for its segmentation job. Returns the sample id."""
+        def call():
+            with open(path, 'rb') as f:
+                data = _json(self.client.post(f'/api/projects/{self.project_id}/samples',
+                                              data={'name': os.path.basename(path), 'file': (f, os.path.basename(path))},
+                                              content_type='multipart/form-data'))
+            job = data['job']
+            while job['status'] not in ('done', 'failed', 'cancelled'):
+                time.sleep(JOB_POLL_INTERVAL_S)
+                job = _json(self.client.get(f"/api/jobs/{job['id']}"))
+            if job['status'] != 'done':
+                raise BenchmarkError(f"Segmentation of {path} {job['status']}: {job.get('error')}")
+            return job['sample_id']
+        return self.timed('upload', call)
+
+    def analyse(self, sample_id):
+        """Runs every analysis step on a segmented sample. Returns its measured grain count."""
+        url = f'/api/samples/{sample_id}'
+        post = self.client.post
+        self.timed('calibrate', lambda: _json(post(f'{url}/calibrate', json={'scale_pixels_per_mm': PIXELS_PER_MM})))
+        measured = self.timed('measure', lambda: _json(post(f'{url}/measure')))
+        self.timed('astm_planimetric', lambda: _json(post(f'{url}/astm-e112', json={'magnification': MAGNIFICATION})))
+        self.timed('astm_intercept', lambda: _json(post(f'{url}/astm-e112-intercept/auto', json={'test_type': 'lines'})))
+        self.timed('multiphase', lambda: _json(post(f'{url}/multiphase', json={'threshold': 128})))
+
+        def retouch():
+            # Deleting the first grain exercises the incremental re-measurement.
+            contours = _json(self.client.get(f'{url}/contours'))['contours']
+            return _json(post(f'{url}/retouch', json={'contours': contours[1:]}))
+        self.timed('retouch', retouch)
+        return len(measured['results']['measurements'])
+
+    def export(self, export_format):
+        def call():
+            response = self.client.get(f'/api/projects/{self.project_id}/export?format={export_format}')
+            if response.status_code >= 400:
+                raise BenchmarkError(f'Export returned {response.status_code}')
+            # Consumes the streamed body.
+            return len(response.get_data())
+        return self.timed(f'export_{export_format}', call)
+
+
+def _peak_rss_mb():
+    """Peak RSS of this process so far. With --workers, segmentation memory is in the pool processes instead."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _summary(durations):
+    durations = np.asarray(durations) * 1000.0
+    summary = {f'p{p}_ms': float(np.percentile(durations, p)) for p in PERCENTILES}
+    summary['mean_ms'] = float(durations.mean())
+    return summary
+
+
+def run_size(client, project_id, work_dir, size, grains, repeat, image_format):
+    from .synthetic import write_micrograph
+
+    workflow = Workflow(client, project_id)
+    paths = []
+    for i in range(repeat):
+        path = os.path.join(work_dir, f'synthetic_{size}_{i}.{image_format}')
+        write_micrograph(path, size, size, grains, seed=i)
+        paths.append(path)
+
+    start = time.perf_counter()
+    grain_counts = []
+    for path in paths:
+        grain_counts.append(workflow.analyse(workflow.upload(path)))
+    elapsed = time.perf_counter() - start
+    for export_format in ('csv', 'parquet'):
+        workflow.export(export_format)
+    for path in paths:
+        os.remove(path)
+
+    return {
+        'size_px': size,
+        'grains': grains,
+        'measured_grains': int(np.median(grain_counts)),
+        'samples_per_s': repeat / elapsed,
+        'megapixels_per_s': repeat * size * size / 1e6 / elapsed,
+        'peak_rss_mb': _peak_rss_mb(),
+        'steps': {step: _summary(durations) for step, durations in workflow.timings.items()},
+    }
+
+
+def run(sizes, repeat, grain_density, workers, image_format):
+    """Runs the benchmark in a throwaway database and upload folder and returns the results per size."""
+    work_dir = tempfile.mkdtemp(prefix='metallobox-bench-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(work_dir, 'bench.db')}"
+    os.environ['UPLOAD_FOLDER'] = os.path.join(work_dir, 'uploads')
+    os.environ['SEGMENTATION_WORKERS'] = str(workers)
+    os.environ['SEGMENTATION_MAX_PENDING'] = str(max(repeat, 32))
+    try:
+        from app import create_app
+
+        app = create_app()
+        client = app.test_client()
+        # One untimed pass loads lazily imported modules and warms the caches before measuring.
+        warmup_project_id = _json(client.post('/api/projects', json={'name': 'benchmark warm-up'}))['id']
+        run_size(client, warmup_project_id, work_dir, min(sizes), 4, 1, image_format)
+        results = {}
+        for size in sorted(sizes):
+            # A new project per size keeps each export to the samples of that size.
+            project_id = _json(client.post('/api/projects', json={'name': f'benchmark {size}px'}))['id']
+            grains = max(4, round(grain_density * size * size / 1e6))
+            results[f'{size}x{size}'] = run_size(client, project_id, work_dir, size, grains, repeat, image_format)
+            print(f'{size}x{size} done', file=sys.stderr)
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance):
+    """Steps whose median latency exceeds the baseline's by more than ``tolerance``, as messages."""
+    regressions = []
+    for size, result in results.items():
+        base = baseline.get(size)
+        if base is None:
+            continue
+        for step, summary in result['steps'].items():
+            base_p50 = base['steps'].get(step, {}).get('p50_ms')
+            if base_p50 and summary['p50_ms'] > base_p50 * (1 + tolerance):
+                regressions.append(f"{size} {step}: p50 {summary['p50_ms']:.1f} ms vs baseline {base_p50:.1f} ms")
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{size}: peak RSS {result['peak_rss_mb']:.0f} MiB vs baseline {base['peak_rss_mb']:.0f} MiB")
+    return regressions
+
+
+def print_report(results, baseline):
+    for size, result in results.items():
+        base = baseline.get(size, {}).get('steps', {})
+        print(f"\n{size}  {result['grains']} grains ({result['measured_grains']} measured)  "
+              f"{result['samples_per_s']:.2f} samples/s  {result['megapixels_per_s']:.1f} MP/s  "
+              f"peak RSS {result['peak_rss_mb']:.0f} MiB")
+        print(f"  {'step':<18}" + ''.join(f'{f"p{p} ms":>10}' for p in PERCENTILES) + f"{'baseline':>10}{'change':>9}")
+        for step, summary in result['steps'].items():
+            line = f'  {step:<18}' + ''.join(f"{summary[f'p{p}_ms']:>10.1f}" for p in PERCENTILES)
+            base_p50 = base.get(step, {}).get('p50_ms')
+            if base_p50:
+                line += f"{base_p50:>10.1f}{(summary['p50_ms'] / base_p50 - 1) * 100:>+8.0f}%"
+            print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help=f'Comma-separated square image sizes in pixels (default {DEFAULT_SIZES}).')
+    parser.add_argument('--repeat', type=int, default=5, help='Samples per size (default 5).')
+    parser.add_argument('--grain-density', type=float, default=DEFAULT_GRAIN_DENSITY,
+                        help=f'Grains per megapixel (default {DEFAULT_GRAIN_DENSITY}).')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Segmentation pool processes; 0 segments inline in the upload request (default 0).')
+    parser.add_argument('--format', dest='image_format', default='png', choices=('png', 'tif'), help='Upload image format.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline file to compare against or save to.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store this run as the baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown before a step is flagged (default 0.25).')
+    parser.add_argument('--json', dest='json_path', help='Also write the results to this file.')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = run(sizes, args.repeat, args.grain_density, args.workers, args.image_format)
+
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nBaseline saved to {args.baseline}')
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print('\nRegressions:\n  ' + '\n  '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
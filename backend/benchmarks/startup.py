@@ -0,0 +1,281 @@
+"""Measures cold-start time and per-worker memory of the production server.
+
+Cold start: fresh interpreters import the app and run create_app against an
+already migrated database, as production workers do (MIGRATE_ON_START=0).
+The report gives the median time, the RSS after startup and which heavy
+libraries startup loaded; the schema upgrade is timed on its own.
+
+Worker memory: gunicorn runs with gunicorn.conf.py, once preloading the app
+in the master and once loading it in every worker, and gets the same
+warm-up workflow (upload and segmentation, measurement, a watershed
+preview, a Parquet export, an ASTM chart and batch geometry), which
+imports the heavy libraries in every worker that serves it. The
+report gives the time until the server answers and the RSS, PSS and USS
+(private pages) of the master and every worker. PSS splits shared pages
+between the processes sharing them, so its total is the real footprint.
+Reading it needs Linux.
+
+    python -m benchmarks.startup --workers 4
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('cv2', 'shapely', 'scipy', 'skimage', 'pandas', 'matplotlib', 'pyarrow', 'tifffile')
+READY_TIMEOUT_S = 60
+READY_POLL_INTERVAL_S = 0.05
+WARMUP_ROUNDS_PER_WORKER = 3
+WARMUP_IMAGE_PX = 512
+WARMUP_GRAINS = 100
+JOB_POLL_INTERVAL_S = 0.02
+WARMUP_BATCH = {'operations': [
+    {'op': 'split', 'contour': [[0, 0], [40, 0], [40, 40], [0, 40]], 'line': [[20, -5], [20, 45]]},
+    {'op': 'simplify', 'contour': [[0, 0], [20, 1], [40, 0], [40, 40], [0, 40]], 'tolerance': 2.0},
+]}
+
+_COLD_START = '''
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app()
+done = time.perf_counter()
+with open('/proc/self/status') as f:
+    rss_kb = next((int(line.split()[1]) for line in f if line.startswith('VmRSS:')), 0)
+print(json.dumps({'import_s': imported - start, 'create_app_s': done - imported, 'rss_mb': rss_kb / 1024,
+                  'heavy_modules': sorted(m for m in sys.argv[1:] if m in sys.modules)}))
+'''
+
+
+class StartupBenchmarkError(Exception):
+    pass
+
+
+def _environment(work_dir, **extra):
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{os.path.join(work_dir, 'startup.db')}",
+               UPLOAD_FOLDER=os.path.join(work_dir, 'uploads'),
+               PROMETHEUS_MULTIPROC_DIR=os.path.join(work_dir, 'prometheus'),
+               # Inline segmentation keeps all request work inside the gunicorn workers being measured.
+               SEGMENTATION_WORKERS='0')
+    env.update(extra)
+    return env
+
+
+def _run(args, env):
+    result = subprocess.run(args, cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise StartupBenchmarkError(f"{' '.join(args)} failed: {result.stderr.strip()[-500:]}")
+    return result.stdout
+
+
+def measure_migration(work_dir):
+    """Time of the upgrade-db command on a fresh database, then on an up-to-date one."""
+    env = _environment(work_dir)
+    timings = {}
+    for label in ('fresh_s', 'up_to_date_s'):
+        start = time.perf_counter()
+        _run([sys.executable, '-m', 'flask', '--app', 'run', 'upgrade-db'], env)
+        timings[label] = time.perf_counter() - start
+    return timings
+
+
+def measure_cold_start(work_dir, repeat):
+    env = _environment(work_dir, MIGRATE_ON_START='0')
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = json.loads(_run([sys.executable, '-c', _COLD_START, *HEAVY_MODULES], env))
+        result['process_s'] = time.perf_counter() - start
+        runs.append(result)
+    return {
+        'process_s': statistics.median(r['process_s'] for r in runs),
+        'import_s': statistics.median(r['import_s'] for r in runs),
+        'create_app_s': statistics.median(r['create_app_s'] for r in runs),
+        'rss_mb': statistics.median(r['rss_mb'] for r in runs),
+        'heavy_modules': runs[-1]['heavy_modules'],
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _request(url, body=None, files=None):
+    """Sends a GET, a JSON POST or, with ``files``, a multipart POST; returns the decoded JSON or the raw body."""
+    headers, data = {}, None
+    if files is not None:
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in (body or {}).items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        for name, path in files.items():
+            with open(path, 'rb') as f:
+                parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                             f'filename="{os.path.basename(path)}"\r\n\r\n'.encode() + f.read() + b'\r\n')
+        data = b''.join(parts) + f'--{boundary}--\r\n'.encode()
+        headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+    elif body is not None:
+        data = json.dumps(body).encode()
+        headers['Content-Type'] = 'application/json'
+    with urllib.request.urlopen(urllib.request.Request(url, data=data, headers=headers), timeout=60) as response:
+        content = response.read()
+        return json.loads(content) if response.headers.get_content_type() == 'application/json' else content
+
+
+def _warm_up(base_url, project_id, image_path, round_index):
+    """One pass over the routes that import heavy libraries."""
+    job = _request(f'{base_url}/api/projects/{project_id}/samples',
+                   {'name': f'warm-up {round_index}'}, {'file': image_path})['job']
+    while job['status'] not in ('done', 'failed', 'cancelled'):
+        time.sleep(JOB_POLL_INTERVAL_S)
+        job = _request(f"{base_url}/api/jobs/{job['id']}")
+    if job['status'] != 'done':
+        raise StartupBenchmarkError(f"Warm-up segmentation {job['status']}: {job.get('error')}")
+    sample_url = f"{base_url}/api/samples/{job['sample_id']}"
+    _request(f'{sample_url}/calibrate', {'scale_pixels_per_mm': 1000.0})
+    _request(f'{sample_url}/measure', {})
+    _request(f'{sample_url}/astm-e112-intercept/auto', {'test_type': 'lines'})
+    _request(f'{sample_url}/segmentation/preview', {'params': {'watershed': {'enabled': True}}})
+    _request(f'{base_url}/api/projects/{project_id}/export?format=parquet')
+    # A new seed per pass, as cached charts are served without rendering.
+    _request(f'{base_url}/api/astm-charts/5/100/320x240/{round_index}.png')
+    _request(f'{base_url}/api/actions/geometry-batch', WARMUP_BATCH)
+    _request(f'{base_url}/metrics')
+
+
+def _memory_mb(pid):
+    """Rss, Pss and Uss of a process from /proc/<pid>/smaps_rollup, in MiB."""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {'rss_mb': fields['Rss'], 'pss_mb': fields['Pss'],
+            'uss_mb': fields['Private_Clean'] + fields['Private_Dirty']}
+
+
+def _children(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces, so fields are counted from its closing parenthesis.
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def measure_server(work_dir, workers, preload, image_path):
+    """Starts gunicorn, warms every worker up and reads the memory of each process."""
+    port = _free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    env = _environment(work_dir, MIGRATE_ON_START='0', GUNICORN_BIND=f'127.0.0.1:{port}',
+                       GUNICORN_WORKERS=str(workers), GUNICORN_PRELOAD='1' if preload else '0')
+    shutil.rmtree(env['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'run:app'],
+                              cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        while True:
+            if server.poll() is not None:
+                raise StartupBenchmarkError(f'gunicorn exited: {server.stderr.read().decode()[-500:]}')
+            try:
+                _request(f'{base_url}/api/projects')
+                break
+            except OSError:
+                if time.perf_counter() - start > READY_TIMEOUT_S:
+                    raise StartupBenchmarkError(f'gunicorn did not answer within {READY_TIMEOUT_S} s')
+                time.sleep(READY_POLL_INTERVAL_S)
+        ready_s = time.perf_counter() - start
+        project_id = _request(f'{base_url}/api/projects', {'name': f"startup warm-up{'' if preload else ' (no preload)'}"})['id']
+        # Connections are not kept alive, so the requests spread over the workers.
+        for round_index in range(WARMUP_ROUNDS_PER_WORKER * workers):
+            _warm_up(base_url, project_id, image_path, round_index)
+        master = _memory_mb(server.pid)
+        worker_memory = [_memory_mb(pid) for pid in _children(server.pid)]
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return {
+        'ready_s': ready_s,
+        'master': master,
+        'workers': worker_memory,
+        'total_pss_mb': master['pss_mb'] + sum(w['pss_mb'] for w in worker_memory),
+    }
+
+
+def run(workers, repeat):
+    work_dir = tempfile.mkdtemp(prefix='metallobox-startup-')
+    try:
+        from .synthetic import write_micrograph
+
+        image_path = os.path.join(work_dir, 'warm-up.png')
+        write_micrograph(image_path, WARMUP_IMAGE_PX, WARMUP_IMAGE_PX, WARMUP_GRAINS)
+        results = {'migration': measure_migration(work_dir), 'cold_start': measure_cold_start(work_dir, repeat)}
+        for label, preload in (('preload', True), ('no_preload', False)):
+            results[label] = measure_server(work_dir, workers, preload, image_path)
+            print(f'{label} done', file=sys.stderr)
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_report(results):
+    cold = results['cold_start']
+    migration = results['migration']
+    print(f"\ncold start (median)  process {cold['process_s'] * 1000:.0f} ms  import {cold['import_s'] * 1000:.0f} ms  "
+          f"create_app {cold['create_app_s'] * 1000:.0f} ms  RSS {cold['rss_mb']:.0f} MiB")
+    print(f"  heavy modules loaded at startup: {', '.join(cold['heavy_modules']) or 'none'}")
+    print(f"upgrade-db  fresh database {migration['fresh_s'] * 1000:.0f} ms  "
+          f"up to date {migration['up_to_date_s'] * 1000:.0f} ms")
+    for label in ('preload', 'no_preload'):
+        server = results[label]
+        print(f"\ngunicorn {label.replace('_', ' ')}  ready in {server['ready_s'] * 1000:.0f} ms  "
+              f"total PSS {server['total_pss_mb']:.0f} MiB")
+        print(f"  {'process':<10}{'RSS MiB':>10}{'PSS MiB':>10}{'USS MiB':>10}")
+        for name, memory in [('master', server['master'])] + [(f'worker {i}', w) for i, w in enumerate(server['workers'], 1)]:
+            print(f"  {name:<10}{memory['rss_mb']:>10.0f}{memory['pss_mb']:>10.0f}{memory['uss_mb']:>10.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.startup', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes (default 2).')
+    parser.add_argument('--repeat', type=int, default=5, help='Cold starts to take the median of (default 5).')
+    parser.add_argument('--json', dest='json_path', help='Also write the results to this file.')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        parser.error('reading per-process memory needs Linux (/proc/<pid>/smaps_rollup)')
+    try:
+        results = run(args.workers, args.repeat)
+    except StartupBenchmarkError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
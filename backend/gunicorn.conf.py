@@ -0,0 +1,73 @@
+"""Production gunicorn settings, used by the Docker image.
+
+The app is created once in the master (``preload_app``), which also imports
+the heavy libraries that the routes only import on first use. Workers are
+forked from it and share those pages copy-on-write instead of each loading
+its own copy. Run ``flask --app run upgrade-db`` before starting the server:
+the Docker image disables migrations at startup.
+
+Environment:
+    GUNICORN_BIND          listen address (default 0.0.0.0:5000)
+    GUNICORN_WORKERS       worker processes (default 2)
+    GUNICORN_THREADS       threads per worker (default 4)
+    GUNICORN_TIMEOUT       worker timeout in seconds (default 120)
+    GUNICORN_PRELOAD       1 to preload the app in the master (default), 0 to load it in every worker
+    GUNICORN_WARM_MODULES  comma-separated modules the master imports before forking
+
+Every worker runs its own segmentation pool and queue, so SEGMENTATION_WORKERS
+and SEGMENTATION_MAX_PENDING apply per worker. When they are not set, the
+budgets are split between the workers: half the CPUs for pool processes and
+32 queued jobs across the deployment.
+"""
+import gc
+import importlib
+import os
+import tempfile
+
+DEFAULT_WARM_MODULES = 'cv2,shapely,scipy.ndimage,scipy.spatial,scipy.sparse.csgraph,skimage.segmentation,pyarrow.parquet,tifffile'
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+# Requests mostly wait on SQLite, memory-mapped images and GIL-releasing kernels, so threads add concurrency cheaply.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# create_app reads these, in the master or in every worker, after this file has run.
+os.environ.setdefault('SEGMENTATION_WORKERS', str(max(1, (os.cpu_count() or 2) // (2 * workers))))
+os.environ.setdefault('SEGMENTATION_MAX_PENDING', str(max(1, 32 // workers)))
+
+# /metrics aggregates all workers through per-process files. prometheus_client reads this when the app imports it.
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+else:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='metallobox-prometheus-')
+
+
+def on_starting(server):
+    if not preload_app:
+        return
+    for name in filter(None, os.environ.get('GUNICORN_WARM_MODULES', DEFAULT_WARM_MODULES).split(',')):
+        try:
+            importlib.import_module(name.strip())
+        except ImportError as e:
+            server.log.warning(f'Not preloading {name}: {e}')
+    # Objects created so far are never collected, so collections in the workers do not write to the shared pages.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    from app.models import db
+
+    # Connections opened in the master must not be shared with the workers.
+    with worker.app.wsgi().app_context():
+        db.engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,20 @@
+import os
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """One app per session: routes register on the first app created in a process."""
+    work_dir = tmp_path_factory.mktemp('app')
+    os.environ['DATABASE_URL'] = f"sqlite:///{work_dir / 'test.db'}"
+    os.environ['UPLOAD_FOLDER'] = str(work_dir / 'uploads')
+    os.environ['SEGMENTATION_WORKERS'] = '0'
+    from app import create_app
+
+    return create_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,45 @@
+import pytest
+
+from benchmarks.synthetic import write_micrograph
+
+
+def _measured_sample(client, project_id, image_path):
+    with open(image_path, 'rb') as f:
+        response = client.post(f'/api/projects/{project_id}/samples',
+                               data={'name': 'sample', 'file': (f, 'sample.png')}, content_type='multipart/form-data')
+    job = response.get_json()['job']
+    assert job['status'] == 'done'
+    sample_id = job['sample_id']
+    assert client.post(f'/api/samples/{sample_id}/calibrate', json={'scale_pixels_per_mm': 1000.0}).status_code == 200
+    assert client.post(f'/api/samples/{sample_id}/measure').status_code == 200
+    return sample_id
+
+
+@pytest.fixture
+def images(tmp_path):
+    many, few = tmp_path / 'many.png', tmp_path / 'few.png'
+    write_micrograph(str(many), 256, 256, 40, seed=1)
+    write_micrograph(str(few), 256, 256, 4, seed=2)
+    return many, few
+
+
+def test_statistics_of_a_reused_sample_id_are_not_served_from_the_cache(client, images):
+    project_id = client.post('/api/projects', json={'name': 'reused sample id'}).get_json()['id']
+    summary_url = f'/api/projects/{project_id}/measurements/summary?field=area_mm2'
+
+    sample_id = _measured_sample(client, project_id, images[0])
+    statistics_url = f'/api/samples/{sample_id}/measurements/statistics?field=area_mm2'
+    histogram_url = f'/api/samples/{sample_id}/measurements/histogram?field=area_mm2'
+    before = client.get(statistics_url).get_json()
+    before_histogram = client.get(histogram_url).get_json()
+    before_summary = client.get(summary_url).get_json()
+    assert client.delete(f'/api/samples/{sample_id}').status_code == 200
+
+    # SQLite hands the highest id out again once its row is deleted.
+    assert _measured_sample(client, project_id, images[1]) == sample_id
+    after = client.get(statistics_url).get_json()
+    assert after['count'] != before['count']
+    assert after['mean'] != before['mean']
+    assert client.get(histogram_url).get_json()['count'] == after['count'] != before_histogram['count']
+    after_summary = client.get(summary_url).get_json()
+    assert after_summary['overall']['count'] == after['count'] != before_summary['overall']['count']
@@ -12,12 +12,14 @@ import EditorToolbar from './components/EditorToolbar';
 import HistogramChart from './components/HistogramChart';
 import MultiphaseAnalysis from './components/MultiphaseAnalysis';
 import AbaqueComparisonView from './components/AbaqueComparisonView';
+import { loadSampleImage } from './tiles';
 import './components/AbaqueComparisonView.css';
 import './components/Modal.css';
 import './components/FileMenu.css';
 
 
 const API_URL = "/api";
+const SAMPLE_DETAIL_FIELDS = 'id,name,image_filename,created_at,project_id,scale_pixels_per_mm,results';
 
 const generateColor = (index) => {
   const r = (index * 30) % 255;
@@ -29,6 +31,7 @@ const generateColor = (index) => {
 function App() {
   const [selectedProject, setSelectedProject] = useState(null);
   const [samples, setSamples] = useState([]);
+  const [nextSampleCursor, setNextSampleCursor] = useState(null);
   const [selectedSample, setSelectedSample] = useState(null);
   const [highlightedGrainId, setHighlightedGrainId] = useState(null);
   const [isLoading, setIsLoading] = useState(false);
@@ -36,6 +39,8 @@ function App() {
   const [isEditing, setIsEditing] = useState(false);
   const [activeTool, setActiveTool] = useState('delete');
   const [localContours, setLocalContours] = useState([]);
+  // Stored grain id of each local contour, to send deletions as edit operations.
+  const [localGrainIds, setLocalGrainIds] = useState([]);
   const [isInterceptToolActive, setIsInterceptToolActive] = useState(false);
   const [interceptTestType, setInterceptTestType] = useState('lines'); // 'lines' or 'circles'
   const [interceptMarks, setInterceptMarks] = useState([]);
@@ -52,36 +57,67 @@ function App() {
   const handleProjectSelect = (project) => {
     setSelectedProject(project);
     setSamples([]);
+    setNextSampleCursor(null);
     setSelectedSample(null);
     setIsEditing(false);
   };
 
+  const fetchSamplePage = useCallback((projectId, cursor) => {
+    const params = cursor ? { cursor } : {};
+    return axios.get(`${API_URL}/projects/${projectId}/samples`, { params })
+      .then(response => {
+        setSamples(prev => cursor ? [...prev, ...response.data.items] : response.data.items);
+        setNextSampleCursor(response.data.next_cursor);
+      });
+  }, []);
+
   useEffect(() => {
     if (selectedProject) {
       setIsLoading(true);
-      axios.get(`${API_URL}/projects/${selectedProject.id}/samples`)
-        .then(response => {
-          setSamples(response.data);
-          setIsLoading(false);
-        })
+      fetchSamplePage(selectedProject.id, null)
         .catch(err => {
           setError('Failed to fetch samples.');
           console.error(err);
-          setIsLoading(false);
-        });
+        })
+        .finally(() => setIsLoading(false));
     }
-  }, [selectedProject]);
+  }, [selectedProject, fetchSamplePage]);
+
+  const handleLoadMoreSamples = () => {
+    if (!selectedProject || !nextSampleCursor) return;
+    fetchSamplePage(selectedProject.id, nextSampleCursor).catch(err => {
+      setError('Failed to fetch samples.');
+      console.error(err);
+    });
+  };
 
-  const handleSampleSelect = (sample) => {
-    setSelectedSample(sample);
+  const handleSampleSelect = async (sample) => {
+    // The sample list only carries summaries; fetch the full sample for the workspace.
     setIsEditing(false);
+    setError('');
+    try {
+      const response = await axios.get(`${API_URL}/samples/${sample.id}`, { params: { fields: SAMPLE_DETAIL_FIELDS } });
+      setSelectedSample(response.data);
+    } catch (err) {
+      setError('Failed to fetch sample.');
+      console.error(err);
+    }
   };
 
   const handleSampleAdded = (addedSample) => {
-    setSamples([addedSample, ...samples]);
+    const { results, ...summary } = addedSample;
+    setSamples([summary, ...samples]);
     setSelectedSample(addedSample);
   };
 
+  const handleBatchUploaded = () => {
+    // A batch adds many samples at once; reload the first page rather than fetching each one.
+    fetchSamplePage(selectedProject.id, null).catch(err => {
+      setError('Failed to fetch samples.');
+      console.error(err);
+    });
+  };
+
   const handleSampleDeleted = (deletedSampleId) => {
     setSamples(samples.filter(s => s.id !== deletedSampleId));
     if (selectedSample && selectedSample.id === deletedSampleId) {
@@ -107,12 +143,12 @@ function App() {
     }
   };
 
-  const handleMultiphaseAnalysis = async (threshold) => {
+  const handleMultiphaseAnalysis = async (thresholds) => {
     if (!selectedSample) return;
     setIsLoading(true);
     setError('');
     try {
-      const response = await axios.post(`${API_URL}/samples/${selectedSample.id}/multiphase`, { threshold });
+      const response = await axios.post(`${API_URL}/samples/${selectedSample.id}/multiphase`, { thresholds });
       setSelectedSample(response.data);
     } catch (err) {
       setError(err.response?.data?.error || 'Failed to calculate phase ratio.');
@@ -173,6 +209,29 @@ function App() {
     }
   };
 
+  const handleAutoInterceptCalculation = async () => {
+    if (!selectedSample) return;
+    setIsLoading(true);
+    setError('');
+    try {
+      // The server counts the same pattern against the segmented boundaries, plus random placements.
+      const response = await axios.post(`${API_URL}/samples/${selectedSample.id}/astm-e112-intercept/auto`, {
+        test_type: interceptTestType,
+      });
+      setSelectedSample(prev => ({
+        ...prev,
+        results: {
+          ...prev.results,
+          ...response.data,
+        }
+      }));
+    } catch (err) {
+      setError(err.response?.data?.error || 'Failed to count intercepts automatically.');
+    } finally {
+      setIsLoading(false);
+    }
+  };
+
   const handleAstmCalculation = async () => {
     if (!selectedSample) return;
     const magnificationStr = prompt("Enter image magnification (e.g., 100):");
@@ -228,6 +287,7 @@ function App() {
   const handleEnterEditMode = () => {
     if (selectedSample?.results?.contours) {
       setLocalContours(JSON.parse(JSON.stringify(selectedSample.results.contours)));
+      setLocalGrainIds(selectedSample.results.contours.map((_, index) => index + 1));
       setIsEditing(true);
       setHighlightedGrainId(null);
     }
@@ -295,16 +355,35 @@ function App() {
   const handleCancelEdit = () => {
     setIsEditing(false);
     setLocalContours([]);
+    setLocalGrainIds([]);
   };
 
   const handleSaveEdit = async () => {
     setIsLoading(true);
     setError('');
     try {
-      const response = await axios.post(`${API_URL}/samples/${selectedSample.id}/retouch`, {
-        contours: localContours,
+      const kept = new Set(localGrainIds);
+      const operations = selectedSample.results.contours
+        .map((_, index) => index + 1)
+        .filter(id => !kept.has(id))
+        .map(id => ({ op: 'delete', id }));
+      const response = await axios.patch(`${API_URL}/samples/${selectedSample.id}/contours`, {
+        version: selectedSample.results.contours_version,
+        operations,
       });
-      setSelectedSample(response.data);
+      // Deletions only renumber the surviving grains, so the local contours already match the stored ones.
+      const renumber = new Map(localGrainIds.map((id, index) => [id, index + 1]));
+      const results = { ...selectedSample.results, contours: localContours, contours_version: response.data.version };
+      if (results.measurements) {
+        if (results.measurement_scale_pixels_per_mm === selectedSample.scale_pixels_per_mm) {
+          results.measurements = results.measurements
+            .filter(m => renumber.has(m.grain_id))
+            .map(m => ({ ...m, grain_id: renumber.get(m.grain_id) }));
+        } else {
+          delete results.measurements;
+        }
+      }
+      setSelectedSample(prev => ({ ...prev, results }));
       setIsEditing(false);
     } catch (err) {
       setError(err.response?.data?.error || 'Failed to save edits.');
@@ -328,6 +407,7 @@ function App() {
         const newContours = [...localContours];
         newContours.splice(clickedIndex, 1);
         setLocalContours(newContours);
+        setLocalGrainIds(localGrainIds.filter((_, index) => index !== clickedIndex));
       }
     }
   };
@@ -344,18 +424,20 @@ function App() {
 
     const hitCanvas = hitCanvasRef.current;
     const originalCtx = originalCanvas.getContext('2d');
-    const img = new Image();
-    img.crossOrigin = "Anonymous";
-    img.src = `/uploads/${selectedSample.image_filename}`;
-
-    img.onload = () => {
-      originalCanvas.width = img.width;
-      originalCanvas.height = img.height;
+    // Only fetch the pyramid level needed for the on-screen size of the canvas.
+    const displayWidth = (originalCanvas.parentElement?.clientWidth || window.innerWidth) * (window.devicePixelRatio || 1);
+
+    loadSampleImage(selectedSample, displayWidth).then(img => {
+      // The canvas keeps full-resolution coordinates, which contours and marks are expressed in.
+      const width = selectedSample.results?.image_width_px || img.width;
+      const height = selectedSample.results?.image_height_px || img.height;
+      originalCanvas.width = width;
+      originalCanvas.height = height;
       if (hitCanvas) {
-        hitCanvas.width = img.width;
-        hitCanvas.height = img.height;
+        hitCanvas.width = width;
+        hitCanvas.height = height;
       }
-      originalCtx.drawImage(img, 0, 0);
+      originalCtx.drawImage(img, 0, 0, width, height);
 
       const contoursToDraw = isEditing ? localContours : selectedSample?.results?.contours;
 
@@ -401,7 +483,6 @@ function App() {
       }
 
       if (isInterceptToolActive) {
-        const { width, height } = img;
         originalCtx.strokeStyle = 'red';
         originalCtx.lineWidth = 3;
         originalCtx.globalAlpha = 0.8;
@@ -444,7 +525,7 @@ function App() {
       } else {
         testLinesRef.current = [];
       }
-    };
+    });
   }, [selectedSample, isEditing, localContours, isInterceptToolActive, interceptMarks]);
 
   useEffect(() => {
@@ -480,13 +561,23 @@ function App() {
               <div className="project-workspace">
                 <div className="sample-sidebar">
                   <h3>{selectedProject.name}</h3>
-                  <AddSampleForm project={selectedProject} onSampleAdded={handleSampleAdded} />
+                  <AddSampleForm project={selectedProject} onSampleAdded={handleSampleAdded} onBatchUploaded={handleBatchUploaded} />
                   <SampleList
                     samples={samples}
                     onSampleSelect={handleSampleSelect}
                     selectedSample={selectedSample}
                     onSampleDeleted={handleSampleDeleted}
+                    hasMore={Boolean(nextSampleCursor)}
+                    onLoadMore={handleLoadMoreSamples}
                   />
+                  <div className="export-control">
+                    Export project:
+                    {['csv', 'parquet', 'xlsx'].map(format => (
+                      <button key={format} onClick={() => window.open(`${API_URL}/projects/${selectedProject.id}/export?format=${format}`)}>
+                        {format.toUpperCase()}
+                      </button>
+                    ))}
+                  </div>
                 </div>
                 <div className="canvas-area">
                     {showASTMViewer ? (
@@ -539,6 +630,9 @@ function App() {
                                 <button onClick={handleInterceptCalculation} disabled={interceptMarks.length === 0 || isLoading}>
                                     {isLoading ? 'Calculating...' : 'Calculate ASTM G'}
                                 </button>
+                                <button onClick={handleAutoInterceptCalculation} disabled={isLoading}>
+                                    Auto Count
+                                </button>
                                 <span>Total Intercepts: {interceptMarks.length}</span>
                               {selectedSample?.results?.astm_g_intercept_global != null && (
                                     <span className="astm-result">
@@ -560,6 +654,13 @@ function App() {
                                       G (Circles) = {selectedSample.results.astm_g_intercept_circles.toFixed(2)}
                                     </span>
                                 )}
+                                {selectedSample?.results?.[`astm_intercept_auto_${interceptTestType}`]?.g_mean != null && (
+                                    <span className="astm-result">
+                                      Auto ({selectedSample.results[`astm_intercept_auto_${interceptTestType}`].placements} placements):
+                                      G = {selectedSample.results[`astm_intercept_auto_${interceptTestType}`].g_mean.toFixed(2)}
+                                      {' '}± {selectedSample.results[`astm_intercept_auto_${interceptTestType}`].g_ci95.toFixed(2)}
+                                    </span>
+                                )}
                               </>
                             )}
                             <MultiphaseAnalysis sample={selectedSample} onCalculate={handleMultiphaseAnalysis} isLoading={isLoading} />
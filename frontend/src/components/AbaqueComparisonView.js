@@ -1,6 +1,7 @@
 import React, { useState, useEffect, useRef, useCallback } from 'react';
 import axios from 'axios';
 import './AbaqueComparisonView.css';
+import { loadSampleImage } from '../tiles';
 
 const API_URL = "/api";
 
@@ -18,11 +19,9 @@ function AbaqueComparisonView({ sample, magnification, onSelect, onClose }) {
     if (!canvas || !sample) return;
     const ctx = canvas.getContext('2d');
 
-    const sampleImg = new Image();
-    sampleImg.crossOrigin = "Anonymous";
-    sampleImg.src = `/uploads/${sample.image_filename}`;
+    const displayWidth = (canvas.parentElement?.clientWidth || window.innerWidth) * (window.devicePixelRatio || 1);
 
-    sampleImg.onload = () => {
+    loadSampleImage(sample, displayWidth).then(sampleImg => {
         canvas.width = sampleImg.width;
         canvas.height = sampleImg.height;
         ctx.drawImage(sampleImg, 0, 0);
@@ -53,7 +52,7 @@ function AbaqueComparisonView({ sample, magnification, onSelect, onClose }) {
                 ctx.globalAlpha = 1.0; // Reset alpha
             };
         }
-    };
+    });
   }, [sample, overlay, opacity]);
 
   useEffect(() => {
@@ -3,23 +3,86 @@ import axios from 'axios';
 import './AddSampleForm.css';
 
 const API_URL = "/api";
+const JOB_POLL_INTERVAL_MS = 500;
 
-function AddSampleForm({ project, onSampleAdded }) {
+const waitForJob = async (job, onProgress) => {
+  while (!['done', 'failed', 'cancelled'].includes(job.status)) {
+    onProgress(job);
+    await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    const response = await axios.get(`${API_URL}/jobs/${job.id}`);
+    job = response.data;
+  }
+  return job;
+};
+
+const waitForBatch = async (batchId, onProgress) => {
+  while (true) {
+    const response = await axios.get(`${API_URL}/batches/${batchId}`);
+    onProgress(response.data);
+    if (response.data.finished === response.data.total) return response.data;
+    await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+  }
+};
+
+function AddSampleForm({ project, onSampleAdded, onBatchUploaded }) {
   const [sampleName, setSampleName] = useState('');
   const [selectedFile, setSelectedFile] = useState(null);
   const [error, setError] = useState('');
   const [isUploading, setIsUploading] = useState(false);
+  const [activeJob, setActiveJob] = useState(null);
+  const [selectedFiles, setSelectedFiles] = useState([]);
+  const [batch, setBatch] = useState(null);
 
   const handleFileChange = (event) => {
+    setSelectedFiles(Array.from(event.target.files));
     setSelectedFile(event.target.files[0]);
   };
 
+  const isBatch = selectedFiles.length > 1 || selectedFiles.some(file => file.name.toLowerCase().endsWith('.zip'));
+
+  const handleBatchUpload = async () => {
+    const formData = new FormData();
+    selectedFiles.forEach(file => formData.append('files', file));
+    try {
+      setIsUploading(true);
+      setError('');
+      const response = await axios.post(`${API_URL}/projects/${project.id}/samples/bulk`, formData, {
+        headers: {
+          'Content-Type': 'multipart/form-data',
+        },
+      });
+      const rejected = response.data.files.filter(file => file.error);
+      const finished = await waitForBatch(response.data.batch_id, setBatch);
+      const failed = [...rejected, ...finished.files.filter(job => job.status === 'failed')];
+      if (failed.length > 0) {
+        setError(failed.map(file => `${file.filename}: ${file.error}`).join('; '));
+      }
+      onBatchUploaded();
+      setSelectedFiles([]);
+      setSelectedFile(null);
+      if (document.getElementById('file-input')) {
+        document.getElementById('file-input').value = '';
+      }
+    } catch (err) {
+      setError(err.response?.data?.error || 'Failed to upload batch.');
+      console.error(err);
+    } finally {
+      setIsUploading(false);
+      setBatch(null);
+    }
+  };
+
   const handleAddSample = async (e) => {
     e.preventDefault();
     if (!selectedFile) {
       setError('Please select an image file.');
       return;
     }
+    if (isBatch) {
+      // Samples of a batch are named after their files.
+      await handleBatchUpload();
+      return;
+    }
     if (!sampleName.trim()) {
       setError('Please enter a name for the sample.');
       return;
@@ -37,7 +100,19 @@ function AddSampleForm({ project, onSampleAdded }) {
           'Content-Type': 'multipart/form-data',
         },
       });
-      onSampleAdded(response.data);
+      // Segmentation runs in the background; poll the job until the sample is ready.
+      const job = await waitForJob(response.data.job, setActiveJob);
+      if (job.status === 'failed') {
+        setError(job.error || 'Segmentation failed.');
+        return;
+      }
+      if (job.status === 'cancelled') {
+        return;
+      }
+      const sampleResponse = await axios.get(`${API_URL}/samples/${job.sample_id}`, {
+        params: { fields: 'id,name,image_filename,created_at,project_id,scale_pixels_per_mm,results' },
+      });
+      onSampleAdded(sampleResponse.data);
       // Reset form
       setSampleName('');
       setSelectedFile(null);
@@ -49,6 +124,16 @@ function AddSampleForm({ project, onSampleAdded }) {
       console.error(err);
     } finally {
       setIsUploading(false);
+      setActiveJob(null);
+    }
+  };
+
+  const handleCancel = async () => {
+    if (!activeJob) return;
+    try {
+      await axios.post(`${API_URL}/jobs/${activeJob.id}/cancel`);
+    } catch (err) {
+      console.error(err);
     }
   };
 
@@ -61,18 +146,23 @@ function AddSampleForm({ project, onSampleAdded }) {
           placeholder="Sample Name"
           value={sampleName}
           onChange={(e) => setSampleName(e.target.value)}
-          required
+          required={!isBatch}
+          disabled={isBatch}
         />
         <input
           type="file"
           id="file-input"
           onChange={handleFileChange}
-          accept="image/jpeg,image/png,image/bmp,image/tiff"
+          accept="image/jpeg,image/png,image/bmp,image/tiff,.zip,application/zip"
+          multiple
           required
         />
         <button type="submit" disabled={isUploading}>
-          {isUploading ? 'Uploading...' : 'Add and Segment'}
+          {batch ? `Segmenting ${batch.finished}/${batch.total}... ${Math.round(batch.progress * 100)}%`
+            : activeJob ? `Segmenting... ${Math.round(activeJob.progress * 100)}%`
+            : isUploading ? 'Uploading...' : 'Add and Segment'}
         </button>
+        {activeJob && <button type="button" onClick={handleCancel}>Cancel</button>}
       </form>
       {error && <p className="error-message">{error}</p>}
     </div>
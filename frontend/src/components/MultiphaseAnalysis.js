@@ -1,49 +1,103 @@
-import React, { useState } from 'react';
+import React, { useState, useEffect, useMemo } from 'react';
+import axios from 'axios';
 import './MultiphaseAnalysis.css';
 
+const API_URL = "/api";
+const MAX_THRESHOLDS = 3;
+
+// Phase percentages for sorted thresholds, brightest phase first, from the cumulative histogram.
+const computePhasePercents = (cumulative, thresholds) => {
+  const total = cumulative[255];
+  const bounds = [total, ...[...thresholds].reverse().map(t => cumulative[t]), 0];
+  return bounds.slice(1).map((below, i) => ((bounds[i] - below) / total) * 100);
+};
+
 function MultiphaseAnalysis({ sample, onCalculate, isLoading }) {
-  const [threshold, setThreshold] = useState(128);
+  const [thresholds, setThresholds] = useState([128]);
+  const [cumulative, setCumulative] = useState(null);
+
+  useEffect(() => {
+    // The histogram is fetched once per sample; every slider move is then computed locally.
+    setCumulative(null);
+    axios.get(`${API_URL}/samples/${sample.id}/histogram`)
+      .then(response => {
+        let sum = 0;
+        setCumulative(response.data.histogram.map(count => (sum += count)));
+      })
+      .catch(err => console.error(err));
+  }, [sample.id]);
+
+  const sortedThresholds = useMemo(() => [...new Set(thresholds)].sort((a, b) => a - b), [thresholds]);
+  const livePercents = cumulative ? computePhasePercents(cumulative, sortedThresholds) : null;
+  const previewUrl = `${API_URL}/samples/${sample.id}/multiphase/preview.png?thresholds=${sortedThresholds.join(',')}`;
 
   const handleSubmit = (e) => {
     e.preventDefault();
-    onCalculate(threshold);
+    onCalculate(sortedThresholds);
+  };
+
+  const updateThreshold = (index, value) => {
+    setThresholds(prev => prev.map((t, i) => (i === index ? value : t)));
+  };
+
+  const addThreshold = () => {
+    setThresholds(prev => [...prev, Math.min(255, Math.max(...prev) + 32)]);
+  };
+
+  const removeThreshold = (index) => {
+    setThresholds(prev => prev.filter((_, i) => i !== index));
   };
 
   const multiphaseResults = sample.results?.multiphase;
+  const savedPercents = multiphaseResults?.phase_percents
+    || (multiphaseResults && [multiphaseResults.phase_1_percent, multiphaseResults.phase_2_percent]);
+  const savedThresholds = multiphaseResults?.thresholds || (multiphaseResults && [multiphaseResults.threshold]);
 
   return (
     <div className="multiphase-container">
       <h4>Multiphase Analysis</h4>
       <form onSubmit={handleSubmit}>
-        <div className="threshold-slider">
-          <label htmlFor="threshold">Threshold: {threshold}</label>
-          <input
-            type="range"
-            id="threshold"
-            min="0"
-            max="255"
-            value={threshold}
-            onChange={(e) => setThreshold(parseInt(e.target.value))}
-          />
+        {thresholds.map((threshold, index) => (
+          <div className="threshold-slider" key={index}>
+            <label htmlFor={`threshold-${index}`}>Threshold {index + 1}: {threshold}</label>
+            <input
+              type="range"
+              id={`threshold-${index}`}
+              min="0"
+              max="255"
+              value={threshold}
+              onChange={(e) => updateThreshold(index, parseInt(e.target.value))}
+            />
+            {thresholds.length > 1 && (
+              <button type="button" onClick={() => removeThreshold(index)}>Remove</button>
+            )}
+          </div>
+        ))}
+        {thresholds.length < MAX_THRESHOLDS && (
+          <button type="button" onClick={addThreshold}>Add Threshold</button>
+        )}
+        {livePercents && (
+          <p>
+            {livePercents.map((percent, i) => `Phase ${i + 1}: ${percent.toFixed(2)}%`).join(' | ')}
+          </p>
+        )}
+        <div className="preview-image">
+          <h6>Thresholded Preview</h6>
+          <img src={previewUrl} alt="Thresholded preview" />
         </div>
         <button type="submit" disabled={isLoading}>
-          {isLoading ? 'Calculating...' : 'Calculate Phase Ratio'}
+          {isLoading ? 'Saving...' : 'Save Phase Ratio'}
         </button>
       </form>
 
       {multiphaseResults && (
         <div className="multiphase-results">
-          <h5>Results (Threshold: {multiphaseResults.threshold})</h5>
-          <p>
-            <strong>Phase 1 (White):</strong> {multiphaseResults.phase_1_percent.toFixed(2)}%
-          </p>
-          <p>
-            <strong>Phase 2 (Black):</strong> {multiphaseResults.phase_2_percent.toFixed(2)}%
-          </p>
-          <div className="preview-image">
-            <h6>Thresholded Preview</h6>
-            <img src={multiphaseResults.preview_image} alt="Thresholded preview" />
-          </div>
+          <h5>Saved Results (Thresholds: {savedThresholds.join(', ')})</h5>
+          {savedPercents.map((percent, i) => (
+            <p key={i}>
+              <strong>Phase {i + 1}{i === 0 ? ' (Brightest)' : ''}:</strong> {percent.toFixed(2)}%
+            </p>
+          ))}
         </div>
       )}
     </div>
@@ -4,7 +4,7 @@ import './SampleList.css';
 
 const API_URL = "/api";
 
-function SampleList({ samples, onSampleSelect, selectedSample, onSampleDeleted }) {
+function SampleList({ samples, onSampleSelect, selectedSample, onSampleDeleted, hasMore, onLoadMore }) {
   const [error, setError] = useState('');
 
   const handleDeleteSample = async (e, id) => {
@@ -38,6 +38,7 @@ function SampleList({ samples, onSampleSelect, selectedSample, onSampleDeleted }
           </li>
         ))}
       </ul>
+      {hasMore && <button onClick={onLoadMore} className="load-more-btn">Load more</button>}
     </div>
   );
 }
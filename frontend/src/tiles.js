@@ -0,0 +1,60 @@
+// Loads a sample image from its tile pyramid at the resolution that is actually displayed,
+// falling back to the original upload for samples without a pyramid.
+
+const loadImage = (src) => new Promise((resolve, reject) => {
+  const img = new Image();
+  img.crossOrigin = "Anonymous";
+  img.onload = () => resolve(img);
+  img.onerror = reject;
+  img.src = src;
+});
+
+const pickLevel = (pyramid, displayWidth) => {
+  // Lowest level that is at least as wide as the display, so nothing is upscaled.
+  let level = pyramid.max_level;
+  while (level > 0 && Math.ceil(pyramid.width / 2 ** (pyramid.max_level - level + 1)) >= displayWidth) {
+    level -= 1;
+  }
+  return level;
+};
+
+const loadPyramidLevel = async (sampleId, displayWidth) => {
+  const response = await fetch(`/api/samples/${sampleId}/tiles`);
+  if (!response.ok) throw new Error('Failed to load tile descriptor.');
+  const pyramid = await response.json();
+  const level = pickLevel(pyramid, displayWidth);
+  const scale = 2 ** (pyramid.max_level - level);
+  const levelWidth = Math.ceil(pyramid.width / scale);
+  const levelHeight = Math.ceil(pyramid.height / scale);
+  const { tile_size: tileSize, overlap } = pyramid;
+
+  const canvas = document.createElement('canvas');
+  canvas.width = levelWidth;
+  canvas.height = levelHeight;
+  const ctx = canvas.getContext('2d');
+
+  const tiles = [];
+  for (let row = 0; row * tileSize < levelHeight; row++) {
+    for (let col = 0; col * tileSize < levelWidth; col++) {
+      const x = col * tileSize - (col > 0 ? overlap : 0);
+      const y = row * tileSize - (row > 0 ? overlap : 0);
+      tiles.push(
+        loadImage(`${pyramid.tiles_url}${level}/${col}_${row}.${pyramid.format}`)
+          .then(tile => ctx.drawImage(tile, x, y))
+      );
+    }
+  }
+  await Promise.all(tiles);
+  return canvas;
+};
+
+export const loadSampleImage = async (sample, displayWidth) => {
+  if (sample.results?.tiles) {
+    try {
+      return await loadPyramidLevel(sample.id, displayWidth);
+    } catch (err) {
+      console.error(err);
+    }
+  }
+  return loadImage(`/uploads/${sample.image_filename}`);
+};